@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from fpdf import FPDF
+
+import fluxo
+
+
+# Função para gerar uma planilha sintética de contas a receber/pagar, como exportada (valores e datas em texto)
+def synthetic_ledger(linhas, seed=0):
+    rng = np.random.default_rng(seed)
+    centavos = rng.integers(-10_000_00, 1_000_000_00, linhas)
+    reais = np.abs(centavos) // 100
+    valores = [
+        f"R$ {'-' if c < 0 else ''}{r:,}".replace(',', '.') + f",{abs(c) % 100:02d}"
+        for c, r in zip(centavos, reais)
+    ]
+    dias = pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 730, (3, linhas)).ravel(), unit='D')
+    datas = pd.Series(dias.strftime('%d/%m/%Y')).to_numpy().reshape(3, linhas)
+    return pd.DataFrame({
+        'Valor': valores,
+        'Pagamento': datas[0],
+        'Data': datas[1],
+        'Vencimento': datas[2],
+    })
+
+# Função com o caminho de normalização anterior (regex + astype(float) + um pd.to_datetime por coluna)
+def legacy_normalize(df):
+    df['Valor'] = df['Valor'].replace({r'R\$': '', r'\.': '', ',': '.'}, regex=True)
+    df['Valor'] = df['Valor'].astype(float)
+    for coluna in ['Pagamento', 'Data', 'Vencimento']:
+        df[coluna] = pd.to_datetime(df[coluna], format='%d/%m/%Y')
+    return df
+
+# Função para medir o menor tempo de várias execuções
+def best_time(func, df, repeticoes=3):
+    tempos = []
+    for _ in range(repeticoes):
+        copia = df.copy()
+        inicio = time.perf_counter()
+        func(copia)
+        tempos.append(time.perf_counter() - inicio)
+    return min(tempos)
+
+# Micro-benchmark da normalização de valores em reais e datas
+def benchmark_normalization(linhas):
+    df = synthetic_ledger(linhas)
+    antigo = best_time(legacy_normalize, df)
+    novo = best_time(lambda d: fluxo.normalize_ledger(d, 'Valor', fluxo.LEDGER_DATE_COLUMNS), df)
+
+    # Conferir que os dois caminhos chegam aos mesmos valores
+    esperado = legacy_normalize(df.copy())
+    obtido, relatorio = fluxo.normalize_ledger(df, 'Valor', fluxo.LEDGER_DATE_COLUMNS)
+    assert relatorio.empty
+    assert np.allclose(esperado['Valor'], obtido['Centavos'] / 100)
+    assert (esperado['Data'] == obtido['Data']).all()
+
+    print(f"Normalização de {linhas:,} linhas: anterior {antigo:.3f}s, normalize_ledger {novo:.3f}s ({antigo / novo:.1f}x)")
+
+# Função para gerar um fluxo de caixa diário sintético com a quantidade de dias pedida
+def synthetic_cash_flow(dias, seed=0):
+    rng = np.random.default_rng(seed)
+    date_range = pd.date_range('2020-01-01', periods=dias, freq='D')
+    recebimentos = rng.integers(0, 5_000_000, dias)
+    pagamentos = rng.integers(0, 5_000_000, dias)
+    return fluxo.cash_flow_from_centavos(date_range, recebimentos, pagamentos, 0.0)
+
+# Função com a geração de PDF anterior (quatro células com borda por dia, sem controle de páginas)
+def legacy_generate_pdf(cash_flow, recebimentos_por_conta, pagamentos_por_conta, unidade_selecionada, regime):
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("helvetica", size=12)
+    pdf.cell(200, 10, txt=f"Relatório Financeiro - Unidade: {unidade_selecionada} - Regime: {regime}", ln=True, align="C")
+    pdf.ln(10)
+    pdf.set_font("helvetica", size=10)
+    pdf.cell(200, 10, txt="Fluxo de Caixa Diário", ln=True)
+    pdf.ln(5)
+    for titulo in ["Data", "Recebimentos", "Pagamentos", "Saldo Acumulado"]:
+        pdf.cell(40, 10, txt=titulo, border=1)
+    pdf.ln()
+    for index, row in cash_flow.iterrows():
+        pdf.cell(40, 10, txt=index.strftime('%d/%m/%Y'), border=1)
+        pdf.cell(40, 10, txt=f"R$ {row['Recebimentos']:,.2f}", border=1)
+        pdf.cell(40, 10, txt=f"R$ {row['Pagamentos']:,.2f}", border=1)
+        pdf.cell(40, 10, txt=f"R$ {row['Saldo Acumulado']:,.2f}", border=1)
+        pdf.ln()
+    pdf.ln(10)
+    for index, row in recebimentos_por_conta.iterrows():
+        pdf.cell(100, 10, txt=f"{row['Conta Analítica']}: R$ {row['Recebimentos']:,.2f}", ln=True)
+    pdf.ln(10)
+    for index, row in pagamentos_por_conta.iterrows():
+        pdf.cell(100, 10, txt=f"{row['Conta Analítica']}: R$ {row['Pagamentos']:,.2f}", ln=True)
+    return pdf.output(dest='S')
+
+# Benchmark da geração do relatório em PDF para períodos longos
+def benchmark_pdf(dias):
+    cash_flow = synthetic_cash_flow(dias)
+    contas = ['Aluguel', 'Salários', 'Fornecedores', 'Impostos', 'Vendas']
+    recebimentos_por_conta = pd.DataFrame({'Conta Analítica': contas, 'Recebimentos': np.arange(len(contas), dtype=float)})
+    pagamentos_por_conta = pd.DataFrame({'Conta Analítica': contas, 'Pagamentos': np.arange(len(contas), dtype=float)})
+    argumentos = (cash_flow, recebimentos_por_conta, pagamentos_por_conta, 'Todas as Unidades', 'Caixa')
+
+    antigo = best_time(lambda _: legacy_generate_pdf(*argumentos), cash_flow)
+    resultados = [f"anterior {antigo:.3f}s"]
+    for resumo in fluxo.PDF_SUMMARIES:
+        tempo = best_time(lambda _: fluxo.generate_pdf(*argumentos, resumo=resumo), cash_flow)
+        resultados.append(f"{resumo} {tempo:.3f}s ({antigo / tempo:.1f}x)")
+    print(f"PDF de {dias:,} dias: " + ", ".join(resultados))
+
+# Limite de linhas de dados por aba no Excel (1.048.576 linhas menos o cabeçalho)
+EXCEL_MAX_ROWS = 1_048_575
+
+# Escalas padrão da suíte (total de lançamentos somando as cinco planilhas)
+DEFAULT_SCALES = [1_000, 10_000, 100_000]
+
+# Primeiro dia e quantidade de dias cobertos pelas planilhas sintéticas
+SYNTHETIC_START = pd.Timestamp('2023-01-01')
+SYNTHETIC_DAYS = 730
+
+# Função para gerar valores em reais no formato das planilhas exportadas ("R$ 1.234,56"). Os textos vêm de um
+# conjunto de valores distintos já formatados, para gerar milhões de linhas sem formatar uma a uma.
+def synthetic_brl(rng, linhas, prefixo='R$ ', distintos=100_000):
+    centavos = rng.integers(1_00, 50_000_00, distintos)
+    textos = np.array([f"{prefixo}{c // 100:,}".replace(',', '.') + f",{c % 100:02d}" for c in centavos], dtype=object)
+    return textos[rng.integers(0, distintos, linhas)]
+
+# Função para gerar datas no formato das planilhas exportadas (dd/mm/aaaa), com uma fração de células vazias
+def synthetic_dates(rng, linhas, vazias=0.05):
+    textos = pd.date_range(SYNTHETIC_START, periods=SYNTHETIC_DAYS, freq='D').strftime('%d/%m/%Y').to_numpy(dtype=object)
+    datas = textos[rng.integers(0, SYNTHETIC_DAYS, linhas)]
+    datas[rng.random(linhas) < vazias] = None
+    return datas
+
+# Função para gerar as cinco planilhas sintéticas (chaves de fluxo.BATCH_INPUTS) com as colunas esperadas pelas
+# funções process_*. Os lançamentos são divididos igualmente entre as cinco planilhas.
+def synthetic_workbook_frames(linhas, unidades=10, contas=40, seed=0):
+    rng = np.random.default_rng(seed)
+    nomes_unidades = np.array([f"UNIDADE {i:02d}" for i in range(1, unidades + 1)], dtype=object)
+    nomes_contas = np.array([f"Conta {i:03d}" for i in range(1, contas + 1)], dtype=object)
+    por_planilha = max(linhas // len(fluxo.BATCH_INPUTS), 1)
+
+    planilhas = {}
+    for chave, _, _ in fluxo.BATCH_INPUTS:
+        if chave == 'relatorio_caixa':
+            planilhas[chave] = pd.DataFrame({
+                'Entrada': synthetic_brl(rng, por_planilha, prefixo=''),
+                'Data': synthetic_dates(rng, por_planilha, vazias=0),
+                'Vencimento': synthetic_dates(rng, por_planilha),
+                'Unidade': nomes_unidades[rng.integers(0, unidades, por_planilha)],
+                'Conta Analítica': nomes_contas[rng.integers(0, contas, por_planilha)],
+            })
+        else:
+            planilhas[chave] = pd.DataFrame({
+                'Valor': synthetic_brl(rng, por_planilha),
+                'Pagamento': synthetic_dates(rng, por_planilha, vazias=0.3 if chave.endswith('pendentes') else 0.02),
+                'Data': synthetic_dates(rng, por_planilha),
+                'Vencimento': synthetic_dates(rng, por_planilha),
+                'Unidade': nomes_unidades[rng.integers(0, unidades, por_planilha)],
+                'Conta Analítica': nomes_contas[rng.integers(0, contas, por_planilha)],
+            })
+    return planilhas
+
+# Função para gravar as planilhas sintéticas em .xlsx (reaproveitando as já geradas com os mesmos parâmetros).
+# Devolve {chave: caminho}, ou None se as planilhas não cabem em uma aba do Excel.
+def synthetic_workbooks(planilhas, diretorio):
+    if max(len(df) for df in planilhas.values()) > EXCEL_MAX_ROWS:
+        return None
+    os.makedirs(diretorio, exist_ok=True)
+    caminhos = {}
+    for chave, df in planilhas.items():
+        caminho = os.path.join(diretorio, f"{chave}.xlsx")
+        if not os.path.exists(caminho):
+            fluxo.write_excel_report(caminho + '.tmp', [('Planilha1', df)])
+            os.replace(caminho + '.tmp', caminho)
+        caminhos[chave] = caminho
+    return caminhos
+
+# Função para medir o menor tempo de várias execuções; devolve (segundos, resultado da última execução)
+def timed(func, repeticoes=3):
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = func()
+        tempos.append(time.perf_counter() - inicio)
+    return min(tempos), resultado
+
+# Função para obter o commit atual do repositório (None fora de um repositório git)
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Suíte de benchmarks de uma escala: ingestão, cálculo do fluxo de caixa nos três regimes, agregações por
+# unidade e conta e geração dos relatórios. Devolve a lista de resultados ({'benchmark', 'segundos', 'linhas'}).
+def benchmark_suite(linhas, unidades=10, contas=40, leitores=('pandas',), processos=fluxo.INGESTION_WORKERS,
+                    repeticoes=3, diretorio_dados='benchmark_dados'):
+    resultados = []
+
+    def medir(nome, func, linhas_medidas=None, repeticoes=repeticoes):
+        segundos, resultado = timed(func, repeticoes)
+        if linhas_medidas is None:
+            linhas_medidas = fluxo._count_rows(resultado, ())
+        resultados.append({'benchmark': nome, 'segundos': segundos, 'linhas': linhas_medidas})
+        print(f"  {nome:<50} {segundos:9.4f}s")
+        return resultado
+
+    planilhas = synthetic_workbook_frames(linhas, unidades, contas)
+    total = sum(len(df) for df in planilhas.values())
+
+    # Ingestão das planilhas .xlsx (leitura + processamento) e só o processamento, a partir dos textos em memória
+    caminhos = synthetic_workbooks(planilhas, os.path.join(diretorio_dados, f"{linhas}_{unidades}_{contas}"))
+    if caminhos is None:
+        print(f"  (planilhas com mais de {EXCEL_MAX_ROWS:,} linhas não cabem no Excel: ingestão .xlsx não medida)")
+    else:
+        entradas = {chave: (caminhos[chave], func) for chave, _, func in fluxo.BATCH_INPUTS}
+        for leitor in leitores:
+            medir(f"ingestao[{leitor}]", lambda: fluxo.load_all_parallel(entradas, workers=processos, reader=leitor,
+                                                                        cache=fluxo.IngestionCache()),
+                  linhas_medidas=total, repeticoes=1)
+    funcoes = {chave: func for chave, _, func in fluxo.BATCH_INPUTS}
+    processadas = medir('processamento', lambda: {chave: funcoes[chave](df) for chave, df in planilhas.items()},
+                        linhas_medidas=total)
+
+    df_receivables = pd.concat([processadas['receber_quitadas'], processadas['receber_pendentes']], ignore_index=True)
+    df_payables = pd.concat([processadas['pagar_quitadas'], processadas['pagar_pendentes']], ignore_index=True)
+    df_cash_report = processadas['relatorio_caixa']
+
+    # Memória das planilhas processadas: bytes por linha no esquema compacto e no anterior
+    memoria = fluxo.ledger_memory_report({'receber': df_receivables, 'pagar': df_payables, 'caixa': df_cash_report})
+    for linha in memoria.to_dict('records'):
+        nome = f"memoria[{linha['Planilha']}]"
+        antes, depois = linha['Bytes/linha antes'], linha['Bytes/linha depois']
+        resultados.append({'benchmark': nome, 'linhas': linha['Linhas'],
+                           'bytes_por_linha_antes': antes, 'bytes_por_linha_depois': depois})
+        print(f"  {nome:<50} {antes:9.1f} -> {depois:.1f} bytes/linha")
+    inicio = SYNTHETIC_START
+    fim = SYNTHETIC_START + pd.Timedelta(days=SYNTHETIC_DAYS - 1)
+    saldos = {f"UNIDADE {i:02d}": 1000.0 for i in range(1, unidades + 1)}
+
+    # Fluxo de caixa direto dos DataFrames, nos três regimes
+    for regime in fluxo.REGIME_COLUMNS:
+        medir(f"calculate_cash_flow[{regime}]", lambda: fluxo.calculate_cash_flow(
+            df_receivables, df_payables, df_cash_report, inicio, fim, regime, saldos, "Todas as Unidades"))
+
+    # Cubo de agregados e as consultas do dashboard sobre ele
+    cube = medir('build_aggregate_cube', lambda: fluxo.build_aggregate_cube(df_receivables, df_payables, df_cash_report),
+                 linhas_medidas=total)
+    todas = ["Todas as Unidades"] + list(cube['units'])
+    for regime, coluna in fluxo.REGIME_COLUMNS.items():
+        medir(f"cube_cash_flow[{regime}]", lambda: fluxo.cube_cash_flow(
+            cube, inicio, fim, regime, saldos, "Todas as Unidades"))
+        medir(f"cube_unit_cash_flows[{regime}]", lambda: fluxo.cube_unit_cash_flows(cube, inicio, fim, regime, saldos),
+              linhas_medidas=SYNTHETIC_DAYS * (len(cube['units']) + 1))
+        medir(f"cube_unit_totals[{regime}]", lambda: fluxo.cube_unit_totals(cube, coluna, inicio, fim))
+        medir(f"compute_indicators[{regime}]", lambda: fluxo.compute_indicators(
+            cube, "Todas as Unidades", regime, inicio, fim), linhas_medidas=total)
+    medir('cube_account_totals[todas as unidades]', lambda: tuple(
+        fluxo.cube_account_totals(cube, ledger, unidade) for unidade in todas for ledger in ('receber', 'pagar')))
+
+    # Índice de detalhamento por dia e as consultas de um dia (top 20) e do período inteiro de uma unidade
+    indice = medir('build_drilldown_index', lambda: fluxo.build_drilldown_index(df_receivables, df_payables,
+                                                                               df_cash_report), linhas_medidas=total)
+    dia = inicio + pd.Timedelta(days=SYNTHETIC_DAYS // 2)
+    for regime in fluxo.REGIME_COLUMNS:
+        medir(f"drilldown_titles[{regime}, 1 dia, top 20]", lambda: fluxo.drilldown_titles(
+            indice, df_receivables, df_payables, df_cash_report, regime, "UNIDADE 01", dia, dia, top_n=20))
+    medir('drilldown_titles[Caixa, período inteiro]', lambda: fluxo.drilldown_titles(
+        indice, df_receivables, df_payables, df_cash_report, 'Caixa', "UNIDADE 01", inicio, fim))
+
+    # Projeção de caixa de todas as unidades a partir do fim do período sintético, no maior horizonte
+    horizonte = fluxo.FORECAST_HORIZONS[-1]
+    for metodo in fluxo.FORECAST_METHODS:
+        medir(f"forecast_cash_flow[{metodo}, {horizonte} meses]", lambda: fluxo.forecast_cash_flow(
+            df_receivables, df_payables, df_cash_report, fim, horizonte, metodo, saldos), linhas_medidas=total)
+
+    # Relatórios: PDF diário de um ano e mensal do período inteiro, Excel com uma aba por unidade e regime
+    ano = fluxo.cube_cash_flow(cube, inicio, inicio + pd.Timedelta(days=364), 'Caixa', saldos, "Todas as Unidades")
+    periodo = fluxo.cube_cash_flow(cube, inicio, fim, 'Caixa', saldos, "Todas as Unidades")
+    recebimentos_por_conta = fluxo.cube_account_totals(cube, 'receber', "Todas as Unidades")
+    pagamentos_por_conta = fluxo.cube_account_totals(cube, 'pagar', "Todas as Unidades")
+    medir('generate_pdf[Diário, 365 dias]', lambda: fluxo.generate_pdf(
+        ano, recebimentos_por_conta, pagamentos_por_conta, "Todas as Unidades", 'Caixa'))
+    medir(f'generate_pdf[Mensal, {SYNTHETIC_DAYS} dias]', lambda: fluxo.generate_pdf(
+        periodo, recebimentos_por_conta, pagamentos_por_conta, "Todas as Unidades", 'Caixa', resumo='Mensal'))
+    medir(f'generate_unit_pdfs[{len(cube["units"])} unidades, 365 dias]', lambda: fluxo.generate_unit_pdfs(
+        cube, list(cube['units']), 'Caixa', inicio, inicio + pd.Timedelta(days=364), saldos, workers=processos),
+          linhas_medidas=len(cube['units']) * 365)
+
+    def excel_unidades():
+        with tempfile.TemporaryFile() as f:
+            fluxo.write_excel_report(f, fluxo.cube_excel_sheets(cube, todas, list(fluxo.REGIME_COLUMNS),
+                                                                inicio, inicio + pd.Timedelta(days=364), saldos))
+    medir('write_excel_report[unidades x regimes, 365 dias]', excel_unidades,
+          linhas_medidas=len(todas) * len(fluxo.REGIME_COLUMNS) * 365)
+    return resultados
+
+# Função para executar a suíte em várias escalas e acrescentar os resultados (JSON Lines) ao arquivo de saída
+def run_benchmarks(escalas, unidades, contas, leitores, processos, repeticoes, saida, diretorio_dados):
+    execucao = {
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'commit': current_commit(),
+        'ambiente': fluxo.runtime_environment(),
+    }
+    with open(saida, 'a', encoding='utf-8') as f:
+        for linhas in escalas:
+            print(f"Escala de {linhas:,} lançamentos ({unidades} unidades, {contas} contas):")
+            parametros = {'escala': linhas, 'unidades': unidades, 'contas': contas, 'processos': processos,
+                          'repeticoes': repeticoes}
+            for resultado in benchmark_suite(linhas, unidades, contas, leitores, processos, repeticoes, diretorio_dados):
+                f.write(json.dumps({**execucao, **parametros, **resultado}, ensure_ascii=False) + '\n')
+    print(f"Resultados acrescentados a {saida}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks do fluxo de caixa com planilhas sintéticas.")
+    parser.add_argument('--escalas', type=int, nargs='+', default=DEFAULT_SCALES,
+                        help='Total de lançamentos nas cinco planilhas (ex.: 1000 100000 5000000)')
+    parser.add_argument('--unidades', type=int, default=10, help='Quantidade de unidades')
+    parser.add_argument('--contas', type=int, default=40, help='Quantidade de contas analíticas')
+    parser.add_argument('--leitores', nargs='+', choices=['pandas'] + fluxo.EXCEL_READERS, default=['pandas'],
+                        help='Leitores de planilha medidos na ingestão')
+    parser.add_argument('--processos', type=int, default=fluxo.INGESTION_WORKERS, help='Processos de leitura')
+    parser.add_argument('--repeticoes', type=int, default=3, help='Execuções por medida (vale a mais rápida)')
+    parser.add_argument('--saida', default='benchmark_resultados.jsonl', help='Arquivo JSON Lines de resultados')
+    parser.add_argument('--dados', default='benchmark_dados', help='Diretório das planilhas sintéticas geradas')
+    parser.add_argument('--comparar', action='store_true',
+                        help='Compara também a normalização e o PDF com as implementações anteriores')
+    args = parser.parse_args()
+
+    run_benchmarks(args.escalas, args.unidades, args.contas, args.leitores, max(1, args.processos),
+                   args.repeticoes, args.saida, args.dados)
+    if args.comparar:
+        benchmark_normalization(200_000)
+        for dias in (365, 3650):
+            benchmark_pdf(dias)
@@ -1,119 +1,1320 @@
-import base64
+import argparse
+import functools
+import hashlib
+import importlib
 import io
+import json
+import mmap
+import multiprocessing
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from urllib.parse import quote
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import plotly.express as px
 import plotly.graph_objects as go
 import streamlit as st
+import xlsxwriter
 from fpdf import FPDF
+from pandas.api.types import union_categoricals
 
 
+# Destino das mensagens de erro e aviso da ingestão: por padrão vão direto para o Streamlit; nos processos
+# de ingestão são coletadas em uma lista e exibidas depois. A lista é guardada por thread, porque o Streamlit
+# executa as sessões em threads paralelas e a ingestão também roda no próprio processo principal.
+_message_state = threading.local()
+
+# Função para exibir (ou coletar) uma mensagem de erro ou aviso da ingestão
+def report_message(level, message):
+    coletor = getattr(_message_state, 'sink', None)
+    if coletor is not None:
+        coletor.append((level, message))
+    elif st.runtime.exists():
+        getattr(st, level)(message)
+    else:
+        # Fora do Streamlit (modo em lote pela linha de comando) as mensagens vão para a saída de erro
+        print(f"{'ERRO' if level == 'error' else 'AVISO'}: {message}", file=sys.stderr)
+
+# Perfil de desempenho opcional: tempo, linhas e pico de memória (tracemalloc) de cada etapa do pipeline.
+# O perfil ativo é guardado por thread, porque o Streamlit executa cada sessão em uma thread própria.
+_profiler_state = threading.local()
+
+# O tracemalloc vale para o processo inteiro: conta os perfis ligados em qualquer thread e se foi um perfil que
+# ligou o tracemalloc, que só é desligado quando o último perfil termina (e nunca se já estava ligado antes)
+_tracemalloc_state = {'perfis': 0, 'ligado_pelo_perfil': False}
+_tracemalloc_lock = threading.Lock()
+
+class StageProfiler:
+    def __init__(self):
+        self.records = []
+        self._pilha = []
+        self._ativo = False
+
+    def start(self):
+        if self._ativo:
+            return
+        # O Streamlit executa o script como __main__ a cada execução: o estado fica no módulo importado
+        modulo = _importable_module()
+        with modulo._tracemalloc_lock:
+            estado = modulo._tracemalloc_state
+            if estado['perfis'] == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                estado['ligado_pelo_perfil'] = True
+            estado['perfis'] += 1
+        self._ativo = True
+
+    def stop(self):
+        if not self._ativo:
+            return
+        modulo = _importable_module()
+        with modulo._tracemalloc_lock:
+            estado = modulo._tracemalloc_state
+            estado['perfis'] -= 1
+            if estado['perfis'] == 0 and estado['ligado_pelo_perfil']:
+                tracemalloc.stop()
+                estado['ligado_pelo_perfil'] = False
+        self._ativo = False
+
+    # Mede uma etapa. O registro entra na lista ao começar (etapas internas aparecem depois da etapa que as
+    # chamou) e é completado ao terminar; quem mede pode preencher registro['linhas'].
+    @contextmanager
+    def stage(self, nome):
+        registro = {'etapa': nome, 'nivel': len(self._pilha), 'segundos': None, 'linhas': None, 'pico_memoria_mb': None}
+        self.records.append(registro)
+        # O pico de memória é zerado a cada etapa; o pico já visto pela etapa de fora é guardado antes
+        atual, pico = tracemalloc.get_traced_memory()
+        if self._pilha:
+            self._pilha[-1]['maximo'] = max(self._pilha[-1]['maximo'], pico)
+        tracemalloc.reset_peak()
+        quadro = {'inicio_memoria': atual, 'maximo': atual}
+        self._pilha.append(quadro)
+        inicio = time.perf_counter()
+        try:
+            yield registro
+        finally:
+            registro['segundos'] = time.perf_counter() - inicio
+            quadro['maximo'] = max(quadro['maximo'], tracemalloc.get_traced_memory()[1])
+            registro['pico_memoria_mb'] = (quadro['maximo'] - quadro['inicio_memoria']) / 1024 ** 2
+            self._pilha.pop()
+            if self._pilha:
+                self._pilha[-1]['maximo'] = max(self._pilha[-1]['maximo'], quadro['maximo'])
+
+    # Acrescenta registros medidos em outro processo (ingestão paralela), abaixo da etapa atual
+    def merge(self, registros, **extras):
+        for registro in registros:
+            self.records.append(dict(registro, nivel=registro['nivel'] + len(self._pilha), **extras))
+
+    def stats_frame(self):
+        tabela = pd.DataFrame(self.records, columns=['etapa', 'nivel', 'segundos', 'linhas', 'pico_memoria_mb', 'arquivo'])
+        tabela['etapa'] = ['  ' * nivel + etapa for etapa, nivel in zip(tabela['etapa'], tabela['nivel'])]
+        return tabela.drop(columns='nivel')
+
+    # Perfil em JSON, com o ambiente e o contexto da execução, para comparar versões
+    def to_json(self, contexto=None):
+        return json.dumps({
+            'gerado_em': datetime.now().isoformat(timespec='seconds'),
+            'ambiente': runtime_environment(),
+            'contexto': contexto or {},
+            'etapas': self.records,
+        }, ensure_ascii=False, indent=2, default=str)
+
+# Função com as versões do ambiente de execução (registradas nos perfis e nos benchmarks)
+def runtime_environment():
+    return {
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'pyarrow': pa.__version__,
+    }
+
+# Função para obter o perfil ativo da thread atual (None quando o perfil está desligado)
+def get_active_profiler():
+    return getattr(_profiler_state, 'active', None)
+
+# Função para ativar um perfil na thread atual (ou desligar, com None), encerrando o anterior
+def activate_profiler(profiler):
+    anterior = get_active_profiler()
+    if anterior is not None and anterior is not profiler:
+        anterior.stop()
+    if profiler is not None:
+        profiler.start()
+    _profiler_state.active = profiler
+
+# Função para contar as linhas de uma etapa: as do resultado (DataFrame, tupla ou dicionário de DataFrames) ou,
+# se o resultado não for tabela (PDF, Excel), as do primeiro DataFrame recebido
+def _count_rows(resultado, args):
+    if isinstance(resultado, pd.DataFrame):
+        return len(resultado)
+    itens = resultado.values() if isinstance(resultado, dict) else resultado if isinstance(resultado, tuple) else ()
+    tabelas = [item for item in itens if isinstance(item, pd.DataFrame)]
+    if tabelas:
+        return sum(len(tabela) for tabela in tabelas)
+    for arg in args:
+        if isinstance(arg, pd.DataFrame):
+            return len(arg)
+    return None
+
+# Decorador que mede a função como uma etapa do perfil ativo; sem perfil ativo, só chama a função
+def profiled(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = get_active_profiler()
+        if profiler is None:
+            return func(*args, **kwargs)
+        with profiler.stage(func.__name__) as registro:
+            resultado = func(*args, **kwargs)
+            registro['linhas'] = _count_rows(resultado, args)
+        return resultado
+    return wrapper
+
 # Função para carregar dados
+@profiled
 def load_data(uploaded_file):
     if uploaded_file is not None:
         try:
             df = pd.read_excel(uploaded_file)
             return df
         except Exception as e:
-            st.error(f"Erro ao carregar o arquivo: {e}")
+            report_message('error', f"Erro ao carregar o arquivo: {e}")
             return None
     return None
 
+# Colunas usadas pelo pipeline; na leitura em blocos as demais colunas da planilha são descartadas
+PIPELINE_COLUMNS = ['Valor', 'Entrada', 'Pagamento', 'Data', 'Vencimento', 'Unidade', 'Conta Analítica']
+
+# Quantidade de linhas por bloco na leitura em blocos
+EXCEL_CHUNK_ROWS = 50_000
+
+# Leitores disponíveis para a leitura em blocos: o openpyxl em modo somente leitura mantém a memória
+# limitada ao bloco; o python-calamine (opcional) é bem mais rápido, mas carrega a planilha inteira
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+EXCEL_READERS = ['openpyxl'] + (['calamine'] if CalamineWorkbook is not None else [])
+
+# Função para percorrer as linhas da primeira planilha sem carregar o arquivo inteiro em DataFrame
+def _iter_excel_rows(uploaded_file, reader='openpyxl'):
+    if hasattr(uploaded_file, 'seek'):
+        uploaded_file.seek(0)
+
+    if reader == 'calamine':
+        if hasattr(uploaded_file, 'read'):
+            workbook = CalamineWorkbook.from_filelike(uploaded_file)
+        else:
+            workbook = CalamineWorkbook.from_path(uploaded_file)
+        # O calamine devolve '' nas células vazias; o openpyxl e o pandas devolvem None
+        for linha in workbook.get_sheet_by_index(0).iter_rows():
+            yield [None if valor == '' else valor for valor in linha]
+        return
+
+    from openpyxl import load_workbook
+    workbook = load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        planilha = workbook.worksheets[0]
+        planilha.reset_dimensions()
+        yield from planilha.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+# Função para ler uma planilha em blocos de linhas, apenas com as colunas usadas pelo pipeline.
+# Cada bloco mantém a numeração de linhas da planilha inteira (para os relatórios de células inválidas).
+def iter_excel_chunks(uploaded_file, columns=PIPELINE_COLUMNS, chunk_rows=EXCEL_CHUNK_ROWS, reader='openpyxl'):
+    linhas = _iter_excel_rows(uploaded_file, reader)
+    cabecalho = next(linhas, None)
+    if cabecalho is None:
+        return
+    posicoes = [i for i, nome in enumerate(cabecalho) if nome in columns]
+    nomes = [cabecalho[i] for i in posicoes]
+
+    # O índice é a posição da linha na planilha (sem o cabeçalho), contando também as linhas vazias ignoradas
+    bloco, indices = [], []
+    enviados = 0
+    for numero, linha in enumerate(linhas):
+        valores = [linha[i] if i < len(linha) else None for i in posicoes]
+        # Linhas totalmente vazias são ignoradas
+        if all(valor is None for valor in valores):
+            continue
+        bloco.append(valores)
+        indices.append(numero)
+        if len(bloco) >= chunk_rows:
+            yield pd.DataFrame(bloco, columns=nomes, index=pd.Index(indices, dtype=np.int64))
+            enviados += 1
+            bloco, indices = [], []
+    if bloco or enviados == 0:
+        yield pd.DataFrame(bloco, columns=nomes, index=pd.Index(indices, dtype=np.int64))
+
+# Função para carregar e processar uma planilha em blocos, com memória de leitura limitada ao tamanho do bloco
+@profiled
+def load_data_chunked(uploaded_file, process_func, chunk_rows=EXCEL_CHUNK_ROWS, reader='openpyxl'):
+    if uploaded_file is None:
+        return None
+    try:
+        processados = []
+        for bloco in iter_excel_chunks(uploaded_file, chunk_rows=chunk_rows, reader=reader):
+            bloco = process_func(bloco)
+            if bloco is None:
+                return None
+            processados.append(bloco)
+    except Exception as e:
+        report_message('error', f"Erro ao carregar o arquivo: {e}")
+        return None
+    if not processados:
+        report_message('error', "O arquivo não contém uma planilha com cabeçalho.")
+        return None
+    return concat_ledgers(processados)
+
+# Formato das datas nas planilhas exportadas
+DATE_FORMAT = '%d/%m/%Y'
+
+# Datas seriais do Excel: dias contados a partir de 30/12/1899, válidos de 01/01/1900 (1) a 31/12/9999
+EXCEL_EPOCH = pd.Timestamp('1899-12-30')
+EXCEL_SERIAL_RANGE = (1, 2958465)
+
+# Colunas de data das planilhas de contas a receber e a pagar
+LEDGER_DATE_COLUMNS = ['Pagamento', 'Data', 'Vencimento']
+
+# Valor em reais no formato brasileiro: sinal antes ou depois do "R$", milhares com ponto, centavos com vírgula,
+# opcionalmente entre parênteses (valor negativo). Só um sinal é aceito: "--5,00" ou "(-5,00)" são inválidos.
+BRL_PATTERN = r'^\(?(?P<sinal>-?)(?:R\$)?(?P<sinal_r>-?)(?P<inteiro>\d[\d.]*)(?:,(?P<centavos>\d{1,2}))?(?P<sinal_final>-?)\)?$'
+
+# Função para converter valores em reais em centavos inteiros (sem erro de arredondamento de float).
+# Aceita texto ("R$ 1.234,56", "-R$ 10,00", "(10,00)"), números já convertidos pelo Excel e células vazias.
+# Retorna os centavos (0 nas células vazias ou inválidas), a máscara de células vazias e a de células inválidas.
+def parse_brl_centavos(values):
+    values = pd.Series(values)
+    centavos = np.zeros(len(values), dtype=np.int64)
+    vazias = values.isna().to_numpy()
+    invalidas = np.zeros(len(values), dtype=bool)
+
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        e_texto = np.zeros(len(values), dtype=bool)
+    else:
+        e_texto = values.str.len().notna().to_numpy()
+
+    # Valores que o Excel já entregou como número
+    numericos = ~e_texto & ~vazias
+    if numericos.any():
+        numeros = pd.to_numeric(values[numericos], errors='coerce').to_numpy(dtype=float)
+        validos = np.isfinite(numeros)
+        posicoes = np.flatnonzero(numericos)
+        centavos[posicoes[validos]] = np.rint(numeros[validos] * 100).astype(np.int64)
+        invalidas[posicoes[~validos]] = True
+
+    # Valores em texto no formato brasileiro, convertidos com as funções vetorizadas do pyarrow
+    if e_texto.any():
+        posicoes = np.flatnonzero(e_texto)
+        texto = pc.replace_substring_regex(pa.array(values.to_numpy()[e_texto], type=pa.string()), r'[\s\x{a0}]+', '')
+        em_branco = pc.equal(texto, '').to_numpy(zero_copy_only=False)
+        vazias[posicoes[em_branco]] = True
+
+        abre, fecha = pc.starts_with(texto, '('), pc.ends_with(texto, ')')
+        partes = pc.extract_regex(texto, BRL_PATTERN)
+        abre = abre.to_numpy(zero_copy_only=False)
+        # Sinais de menos encontrados (os parênteses contam como um sinal)
+        sinais = abre.astype(np.int64)
+        for grupo in ['sinal', 'sinal_r', 'sinal_final']:
+            sinais += pc.fill_null(pc.equal(pc.struct_field(partes, grupo), '-'), False).to_numpy(zero_copy_only=False)
+        validos = (
+            pc.is_valid(partes).to_numpy(zero_copy_only=False) &
+            (abre == fecha.to_numpy(zero_copy_only=False)) &
+            (sinais <= 1)
+        )
+        invalidas[posicoes[~validos & ~em_branco]] = True
+
+        partes = partes.filter(pa.array(validos))
+        inteiro = pc.cast(pc.replace_substring(pc.struct_field(partes, 'inteiro'), '.', ''), pa.int64())
+        fracao = pc.cast(pc.utf8_rpad(pc.struct_field(partes, 'centavos'), 2, '0'), pa.int64())
+        valor = inteiro.to_numpy() * 100 + fracao.to_numpy()
+        centavos[posicoes[validos]] = np.where(sinais[validos] == 1, -valor, valor)
+
+    return centavos, vazias, invalidas
+
+# Função para converter colunas de data dd/mm/aaaa de uma só vez.
+# As datas se repetem muito nas planilhas, então cada valor distinto é convertido uma única vez.
+# Retorna as colunas convertidas e, para cada coluna, a máscara de células inválidas.
+def parse_br_dates(df, columns):
+    colunas = [c for c in columns if c in df.columns and not pd.api.types.is_datetime64_any_dtype(df[c])]
+    convertidas = {c: df[c] for c in columns if c in df.columns and c not in colunas}
+    invalidas = {c: np.zeros(len(df), dtype=bool) for c in convertidas}
+    if not colunas:
+        return convertidas, invalidas
+
+    fatorados = {c: pd.factorize(df[c]) for c in colunas}
+    distintos = pd.Series(
+        pd.unique(np.concatenate([np.asarray(unicos, dtype=object) for _, unicos in fatorados.values()])),
+        dtype=object,
+    )
+
+    # Converter os valores distintos: texto no formato dd/mm/aaaa, números como datas seriais do Excel (dias desde
+    # 30/12/1899) e datas do Excel como estão
+    e_texto = distintos.str.len().notna().to_numpy()
+    e_numero = np.array([
+        isinstance(valor, (int, float, np.integer, np.floating)) and not isinstance(valor, (bool, np.bool_))
+        for valor in distintos
+    ], dtype=bool)
+    texto = distintos[e_texto].str.strip()
+    datas = pd.Series(pd.NaT, index=distintos.index, dtype='datetime64[ns]')
+    datas[e_texto] = pd.to_datetime(texto, format=DATE_FORMAT, errors='coerce')
+    if e_numero.any():
+        seriais = pd.to_numeric(distintos[e_numero]).astype(float)
+        # Fora de 01/01/1900 a 31/12/9999 o número não é uma data serial: a célula é inválida
+        seriais = seriais.where(seriais.between(EXCEL_SERIAL_RANGE[0], EXCEL_SERIAL_RANGE[1]))
+        datas[e_numero] = EXCEL_EPOCH + pd.to_timedelta(seriais, unit='D')
+    outros = ~e_texto & ~e_numero
+    datas[outros] = pd.to_datetime(distintos[outros], errors='coerce')
+    em_branco = np.zeros(len(distintos), dtype=bool)
+    em_branco[e_texto] = (texto == '').to_numpy()
+    tabela = pd.DataFrame({'data': datas.to_numpy(), 'invalida': datas.isna().to_numpy() & ~em_branco}, index=distintos.to_numpy())
+
+    for coluna, (codigos, unicos) in fatorados.items():
+        valores_unicos = tabela.reindex(np.asarray(unicos, dtype=object))
+        presentes = codigos >= 0
+        datas_coluna = np.full(len(df), np.datetime64('NaT'), dtype='datetime64[ns]')
+        datas_coluna[presentes] = valores_unicos['data'].to_numpy()[codigos[presentes]]
+        invalida = np.zeros(len(df), dtype=bool)
+        invalida[presentes] = valores_unicos['invalida'].to_numpy(dtype=bool)[codigos[presentes]]
+        convertidas[coluna] = pd.Series(datas_coluna, index=df.index)
+        invalidas[coluna] = invalida
+    return convertidas, invalidas
+
+# Função para normalizar uma planilha: a coluna de valores em reais vira a coluna 'Centavos' (inteiros) e as
+# colunas de data passam a datetime64. Células com formato inválido não interrompem o processamento: ficam
+# vazias (zero centavos) e são listadas no relatório. As demais colunas são reaproveitadas sem cópia.
+@profiled
+def normalize_ledger(df, value_column, date_columns):
+    colunas = {coluna: df[coluna] for coluna in df.columns if coluna != value_column}
+    relatorio = []
+
+    centavos, _, invalidas = parse_brl_centavos(df[value_column])
+    relatorio.append(pd.DataFrame({'Linha': df.index[invalidas], 'Coluna': value_column, 'Valor': df[value_column][invalidas].to_numpy()}))
+    colunas['Centavos'] = pd.Series(centavos, index=df.index)
+
+    datas, datas_invalidas = parse_br_dates(df, date_columns)
+    for coluna, valores in datas.items():
+        invalidas = datas_invalidas[coluna]
+        relatorio.append(pd.DataFrame({'Linha': df.index[invalidas], 'Coluna': coluna, 'Valor': df[coluna][invalidas].to_numpy()}))
+        colunas[coluna] = valores
+
+    relatorio = pd.concat(relatorio, ignore_index=True)
+    # Número da linha na planilha do Excel (o cabeçalho ocupa a linha 1)
+    relatorio['Linha'] = relatorio['Linha'] + 2
+    return pd.DataFrame(colunas, index=df.index, copy=False), relatorio
+
+# Colunas de texto das planilhas guardadas como categóricas (poucos valores distintos repetidos em milhões de linhas)
+LEDGER_CATEGORY_COLUMNS = ['Unidade', 'Conta Analítica']
+
+# Função para converter uma coluna em categórica, com as categorias em texto e em ordem alfabética.
+# As células vazias continuam vazias, ou recebem o texto de 'vazias' (a unidade vazia era o texto 'nan').
+def text_categorical(serie, vazias=None):
+    if isinstance(serie.dtype, pd.CategoricalDtype) and serie.cat.categories.inferred_type in ('string', 'empty'):
+        if vazias is None or not serie.isna().any():
+            return serie
+    codigos, unicos = pd.factorize(serie)
+    nomes = pd.Index(np.asarray(unicos, dtype=object)).astype(str)
+    if vazias is not None and (codigos < 0).any():
+        codigos = np.where(codigos < 0, len(nomes), codigos)
+        nomes = nomes.append(pd.Index([vazias]))
+    # Valores diferentes com o mesmo texto (ex.: 1 e "1") ficam na mesma categoria
+    categorias = nomes.unique().sort_values()
+    novos_codigos = np.where(codigos >= 0, categorias.get_indexer(nomes)[codigos], -1)
+    return pd.Series(pd.Categorical.from_codes(novos_codigos, categorias), index=serie.index, name=serie.name)
+
+# Função para deixar uma planilha processada no esquema compacto: valores só em centavos inteiros (int64),
+# unidade e conta analítica categóricas e datas em datetime64, sem copiar as demais colunas. Planilhas gravadas
+# antes (com a coluna de valores em reais) são convertidas pela 'value_column'.
+def compact_ledger(df, value_column=None):
+    colunas = {coluna: df[coluna] for coluna in df.columns if coluna != value_column}
+    if value_column in df.columns:
+        colunas['Centavos'] = pd.Series(ledger_centavos(df, value_column), index=df.index)
+    elif colunas['Centavos'].dtype != np.int64:
+        colunas['Centavos'] = colunas['Centavos'].astype(np.int64)
+    for coluna in LEDGER_CATEGORY_COLUMNS:
+        if coluna in colunas:
+            colunas[coluna] = text_categorical(colunas[coluna], vazias='nan' if coluna == 'Unidade' else None)
+    return pd.DataFrame(colunas, index=df.index, copy=False)
+
+# Função para juntar planilhas compactas mantendo as colunas categóricas (o pd.concat de categorias diferentes
+# voltaria a texto)
+def concat_ledgers(frames):
+    frames = list(frames)
+    for coluna in LEDGER_CATEGORY_COLUMNS:
+        if len(frames) > 1 and all(coluna in df.columns and isinstance(df[coluna].dtype, pd.CategoricalDtype) for df in frames):
+            categorias = union_categoricals([df[coluna] for df in frames], sort_categories=True).categories
+            frames = [df.assign(**{coluna: df[coluna].cat.set_categories(categorias)}) for df in frames]
+    return pd.concat(frames, ignore_index=True)
+
+# Função para montar a visualização de uma planilha compacta, com a coluna de valores em reais no lugar dos centavos
+def ledger_display_frame(df, value_column):
+    colunas = {coluna: df[coluna] for coluna in df.columns if coluna != 'Centavos'}
+    colunas[value_column] = df['Centavos'] / 100
+    return pd.DataFrame(colunas, index=df.index, copy=False)
+
+# Função para medir a memória das planilhas no esquema compacto e no esquema anterior (unidade e conta analítica
+# em texto e a coluna de valores em reais ao lado dos centavos), calculado sem montar as planilhas antigas.
+# Recebe {nome: DataFrame} e devolve uma linha por planilha, com os bytes por linha antes e depois.
+def ledger_memory_report(planilhas):
+    linhas_relatorio = []
+    for nome, df in planilhas.items():
+        linhas = len(df)
+        depois = int(df.memory_usage(index=True, deep=True).sum())
+        antes = depois + 8 * linhas
+        for coluna in LEDGER_CATEGORY_COLUMNS:
+            if coluna in df.columns and isinstance(df[coluna].dtype, pd.CategoricalDtype):
+                codigos = df[coluna].cat.codes.to_numpy()
+                tamanhos = np.array([sys.getsizeof(c) for c in df[coluna].cat.categories], dtype=np.int64)
+                # Em texto: um ponteiro por linha mais o objeto de cada célula
+                texto = 8 * linhas + tamanhos[codigos[codigos >= 0]].sum() + (codigos < 0).sum() * sys.getsizeof(np.nan)
+                antes += int(texto) - int(df[coluna].memory_usage(index=False, deep=True))
+        linhas_relatorio.append({
+            'Planilha': nome,
+            'Linhas': linhas,
+            'Bytes antes': antes,
+            'Bytes depois': depois,
+            'Bytes/linha antes': antes / linhas if linhas else 0.0,
+            'Bytes/linha depois': depois / linhas if linhas else 0.0,
+        })
+    relatorio = pd.DataFrame(linhas_relatorio, columns=['Planilha', 'Linhas', 'Bytes antes', 'Bytes depois',
+                                                        'Bytes/linha antes', 'Bytes/linha depois'])
+    relatorio['Redução'] = 1 - relatorio['Bytes depois'] / relatorio['Bytes antes']
+    return relatorio
+
+# Função para avisar sobre células com formato inválido em uma planilha
+def report_invalid_cells(relatorio, planilha):
+    if relatorio.empty:
+        return
+    exemplos = ", ".join(f"linha {r.Linha} ({r.Coluna}: {r.Valor!r})" for r in relatorio.head(5).itertuples())
+    report_message('warning', f"{planilha}: {len(relatorio)} célula(s) com formato inválido foram ignoradas. Ex.: {exemplos}")
+
 # Função para processar contas a receber (planilha original)
+@profiled
 def process_receivables(df_receivables):
-    # Remover caracteres não numéricos (como 'R$', '.', ',', etc.)
-    df_receivables['Valor'] = df_receivables['Valor'].replace({'R\$': '', '\.': '', ',': '.'}, regex=True)
-    
-    # Converter a coluna para float
-    df_receivables['Valor'] = df_receivables['Valor'].astype(float)
-    
-    # Converter as colunas de data para datetime
-    if 'Pagamento' in df_receivables.columns:
-        df_receivables['Pagamento'] = pd.to_datetime(df_receivables['Pagamento'], format='%d/%m/%Y')
-    if 'Data' in df_receivables.columns:
-        df_receivables['Data'] = pd.to_datetime(df_receivables['Data'], format='%d/%m/%Y')
-    if 'Vencimento' in df_receivables.columns:  # Adicionar processamento para "Vencimento"
-        df_receivables['Vencimento'] = pd.to_datetime(df_receivables['Vencimento'], format='%d/%m/%Y')
+    # Converter valores em reais e datas dd/mm/aaaa, listando as células inválidas
+    df_receivables, relatorio = normalize_ledger(df_receivables, 'Valor', LEDGER_DATE_COLUMNS)
+    report_invalid_cells(relatorio, "Contas a Receber")
     
-    # Converter a coluna 'Unidade' para string
-    df_receivables['Unidade'] = df_receivables['Unidade'].astype(str)
-    
-    # Renomear a coluna 'Valor' para 'Recebimentos'
-    df_receivables = df_receivables.rename(columns={'Valor': 'Recebimentos'})
-    
-    return df_receivables
+    # Esquema compacto: recebimentos em centavos inteiros, unidade (em texto) e conta analítica categóricas
+    return compact_ledger(df_receivables)
 
 # Função para processar contas a pagar (planilha original)
+@profiled
 def process_payables(df_payables):
-    # Remover caracteres não numéricos (como 'R$', '.', ',', etc.)
-    df_payables['Valor'] = df_payables['Valor'].replace({'R\$': '', '\.': '', ',': '.'}, regex=True)
-    
-    # Converter a coluna para float
-    df_payables['Valor'] = df_payables['Valor'].astype(float)
-    
-    # Converter as colunas de data para datetime
-    if 'Pagamento' in df_payables.columns:
-        df_payables['Pagamento'] = pd.to_datetime(df_payables['Pagamento'], format='%d/%m/%Y')
-    if 'Data' in df_payables.columns:
-        df_payables['Data'] = pd.to_datetime(df_payables['Data'], format='%d/%m/%Y')
-    if 'Vencimento' in df_payables.columns:  # Adicionar processamento para "Vencimento"
-        df_payables['Vencimento'] = pd.to_datetime(df_payables['Vencimento'], format='%d/%m/%Y')
+    # Converter valores em reais e datas dd/mm/aaaa, listando as células inválidas
+    df_payables, relatorio = normalize_ledger(df_payables, 'Valor', LEDGER_DATE_COLUMNS)
+    report_invalid_cells(relatorio, "Contas a Pagar")
     
-    # Converter a coluna 'Unidade' para string
-    df_payables['Unidade'] = df_payables['Unidade'].astype(str)
-    
-    # Renomear a coluna 'Valor' para 'Pagamentos'
-    df_payables = df_payables.rename(columns={'Valor': 'Pagamentos'})
-    
-    return df_payables
+    # Esquema compacto: pagamentos em centavos inteiros, unidade (em texto) e conta analítica categóricas
+    return compact_ledger(df_payables)
 
 # Função para processar o Relatório Caixa - Contas a Receber (nova planilha)
+@profiled
 def process_cash_report(df_cash_report):
     # Verificar se a planilha é do tipo "RELATÓRIO CAIXA - CONTAS A RECEBER"
     if 'Entrada' in df_cash_report.columns and 'Data' in df_cash_report.columns:
-        # Renomear a coluna 'Entrada' para 'Recebimentos'
-        df_cash_report = df_cash_report.rename(columns={'Entrada': 'Recebimentos'})
-        
-        # Remover pontos de milhares e substituir vírgula por ponto
-        df_cash_report['Recebimentos'] = (
-            df_cash_report['Recebimentos']
-            .str.replace('.', '', regex=False)  # Remove pontos de milhares
-            .str.replace(',', '.')  # Substitui vírgula por ponto
-            .astype(float)  # Converte para float
-        )
-        
-        # Verificar se todos os valores são numéricos após a substituição
-        if not df_cash_report['Recebimentos'].apply(lambda x: isinstance(x, (int, float))).all():
-            st.error("A coluna 'Recebimentos' contém valores não numéricos.")
-            return None
-        
-        # Converter a coluna 'Data' para datetime
-        df_cash_report['Data'] = pd.to_datetime(df_cash_report['Data'], format='%d/%m/%Y')
+        # Converter as entradas em reais e as datas ('Vencimento' é usada no regime "Caixa Projetado")
+        df_cash_report, relatorio = normalize_ledger(df_cash_report, 'Entrada', ['Data', 'Vencimento'])
+        report_invalid_cells(relatorio, "Relatório Caixa - Contas a Receber")
         
         # Adicionar uma coluna 'Conta Analítica' se não existir
         if 'Conta Analítica' not in df_cash_report.columns:
             df_cash_report['Conta Analítica'] = 'Outros'
         
-        # Adicionar uma coluna 'Unidade' se não existir
-        if 'Unidade' not in df_cash_report.columns:
-            df_cash_report['Unidade'] = 'UNIDADE SOMBRIO'  # Ou outra unidade padrão
-        
-        return df_cash_report
+        # A coluna 'Unidade', se não existir, é preenchida depois com a unidade padrão do cadastro
+        # (assign_default_unit), para o resultado do processamento não depender do cadastro
+        return compact_ledger(df_cash_report)
+    else:
+        report_message('error', "A planilha de Relatório Caixa - Contas a Receber não está no formato esperado.")
+        return None
+
+# Orçamento de memória do cache de ingestão (por sessão)
+INGESTION_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Função para calcular o hash do conteúdo de um arquivo carregado
+def file_content_hash(uploaded_file):
+    if hasattr(uploaded_file, 'getvalue'):
+        conteudo = uploaded_file.getvalue()
+    else:
+        with open(uploaded_file, 'rb') as f:
+            conteudo = f.read()
+    return hashlib.sha256(conteudo).hexdigest()
+
+# Cache LRU das planilhas já lidas e processadas, indexado pelo hash do conteúdo.
+# Os DataFrames armazenados são compartilhados entre execuções e não devem ser alterados.
+class IngestionCache:
+    def __init__(self, max_bytes=INGESTION_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+        self.misses += 1
+        return None
+
+    def put(self, key, df):
+        tamanho = int(df.memory_usage(deep=True).sum())
+        if key in self._entries:
+            self.current_bytes -= self._entries.pop(key)[1]
+        # Um DataFrame maior que o orçamento inteiro não é armazenado
+        if tamanho > self.max_bytes:
+            return
+        self._entries[key] = (df, tamanho)
+        self.current_bytes += tamanho
+        # Remove as entradas usadas há mais tempo até caber no orçamento
+        while self.current_bytes > self.max_bytes:
+            _, (_, tamanho_removido) = self._entries.popitem(last=False)
+            self.current_bytes -= tamanho_removido
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+# Função para obter o cache de ingestão da sessão atual (sobrevive aos reruns do Streamlit)
+def get_ingestion_cache():
+    if 'ingestion_cache' not in st.session_state:
+        st.session_state['ingestion_cache'] = IngestionCache()
+    return st.session_state['ingestion_cache']
+
+# Cache de dados compartilhado entre as sessões do servidor (opcional): 'memory' guarda os objetos no próprio
+# processo; 'disk' grava cada entrada em um arquivo lido com mapeamento de memória. Vazio desliga o cache.
+SHARED_CACHE_BACKEND = os.environ.get('FLUXO_SHARED_CACHE', '')
+
+# Diretório do cache compartilhado em disco
+SHARED_CACHE_DIR = os.environ.get('FLUXO_SHARED_CACHE_DIR', 'cache_compartilhado')
+
+# Tamanho máximo do cache compartilhado (MB) e validade de cada entrada (segundos; 0 = sem validade)
+SHARED_CACHE_MAX_BYTES = int(os.environ.get('FLUXO_SHARED_CACHE_MAX_MB', '2048')) * 1024 * 1024
+SHARED_CACHE_TTL = float(os.environ.get('FLUXO_SHARED_CACHE_TTL', str(24 * 3600)))
+
+# Alinhamento dos arrays dentro dos arquivos do cache em disco
+SHARED_CACHE_ALIGNMENT = 64
+
+# Função para preparar um objeto para o cache em disco: cada DataFrame vira um dicionário com um array numpy por
+# coluna (códigos e categorias nas colunas categóricas), para o pickle gravar os arrays fora da banda e a leitura
+# usá-los direto do arquivo mapeado, sem cópia. Tuplas, listas e dicionários (ex.: o cubo) são percorridos.
+def _to_shared(obj):
+    if isinstance(obj, pd.DataFrame):
+        colunas = []
+        for coluna in obj.columns:
+            serie = obj[coluna]
+            if isinstance(serie.dtype, pd.CategoricalDtype):
+                colunas.append(('categorical', serie.cat.codes.to_numpy(), serie.cat.categories, serie.cat.ordered))
+            elif isinstance(serie.dtype, np.dtype):
+                # Datas vão como int64: o numpy só grava fora da banda arrays de tipos numéricos
+                valores = serie.to_numpy()
+                colunas.append(('array', valores.view(np.int64) if valores.dtype.kind in 'mM' else valores, valores.dtype.str))
+            else:
+                colunas.append(('series', serie))
+        return {'__dataframe__': True, 'index': obj.index, 'columns': list(obj.columns), 'data': colunas}
+    if isinstance(obj, tuple):
+        return tuple(_to_shared(item) for item in obj)
+    if isinstance(obj, list):
+        return [_to_shared(item) for item in obj]
+    if isinstance(obj, dict):
+        return {chave: _to_shared(valor) for chave, valor in obj.items()}
+    return obj
+
+# Função para remontar um objeto lido do cache em disco (as colunas continuam apontando para o arquivo mapeado)
+def _from_shared(obj):
+    if isinstance(obj, dict) and obj.get('__dataframe__'):
+        colunas = {}
+        for nome, dados in zip(obj['columns'], obj['data']):
+            if dados[0] == 'categorical':
+                valores = pd.Categorical.from_codes(dados[1], dados[2], ordered=dados[3])
+            elif dados[0] == 'array':
+                valores = dados[1].view(dados[2])
+            else:
+                valores = dados[1].array
+            colunas[nome] = pd.Series(valores, index=obj['index'], copy=False)
+        return pd.DataFrame(colunas, index=obj['index'], columns=obj['columns'], copy=False)
+    if isinstance(obj, tuple):
+        return tuple(_from_shared(item) for item in obj)
+    if isinstance(obj, list):
+        return [_from_shared(item) for item in obj]
+    if isinstance(obj, dict):
+        return {chave: _from_shared(valor) for chave, valor in obj.items()}
+    return obj
+
+# Função para estimar a memória ocupada por um objeto guardado no cache compartilhado em memória
+def _shared_nbytes(obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series, pd.Index)):
+        tamanho = obj.memory_usage(deep=True)
+        return int(tamanho.sum()) if isinstance(obj, pd.DataFrame) else int(tamanho)
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(_shared_nbytes(item) for item in obj)
+    if isinstance(obj, dict):
+        return sum(_shared_nbytes(valor) for valor in obj.values())
+    return sys.getsizeof(obj)
+
+# Cache de dados compartilhado por todas as sessões do servidor, indexado pelo hash do conteúdo dos arquivos.
+# Guarda planilhas processadas e cubos de agregados, calculados uma vez e usados só para leitura pelas sessões.
+# Quando passa do tamanho máximo, remove as entradas usadas há mais tempo; entradas mais antigas que o prazo de
+# validade são descartadas. As sessões rodam em threads diferentes, por isso o acesso é protegido por uma trava.
+class SharedDataCache:
+    def __init__(self, backend='memory', directory=SHARED_CACHE_DIR, max_bytes=SHARED_CACHE_MAX_BYTES, ttl=SHARED_CACHE_TTL):
+        if backend not in ('memory', 'disk'):
+            raise ValueError(f"Cache compartilhado desconhecido: {backend!r} (use 'memory' ou 'disk')")
+        self.backend = backend
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if backend == 'disk':
+            os.makedirs(directory, exist_ok=True)
+
+    # Nome da entrada: hash da chave (a chave é uma tupla com os hashes dos arquivos e os parâmetros)
+    @staticmethod
+    def _name(chave):
+        return hashlib.sha256(repr(chave).encode('utf-8')).hexdigest()
+
+    def _expired(self, criado):
+        return self.ttl > 0 and time.time() - criado > self.ttl
+
+    def get(self, chave):
+        nome = self._name(chave)
+        with self._lock:
+            obj = self._get_memory(nome) if self.backend == 'memory' else self._get_disk(nome)
+            if obj is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return obj
+
+    def put(self, chave, obj):
+        nome = self._name(chave)
+        with self._lock:
+            if self.backend == 'memory':
+                self._put_memory(nome, obj)
+            else:
+                self._put_disk(nome, obj)
+
+    def _get_memory(self, nome):
+        entrada = self._entries.get(nome)
+        if entrada is None:
+            return None
+        if self._expired(entrada[2]):
+            self.current_bytes -= self._entries.pop(nome)[1]
+            return None
+        self._entries.move_to_end(nome)
+        return entrada[0]
+
+    def _put_memory(self, nome, obj):
+        tamanho = _shared_nbytes(obj)
+        if nome in self._entries:
+            self.current_bytes -= self._entries.pop(nome)[1]
+        if tamanho > self.max_bytes:
+            return
+        self._entries[nome] = (obj, tamanho, time.time())
+        self.current_bytes += tamanho
+        while self.current_bytes > self.max_bytes:
+            _, (_, tamanho_removido, _) = self._entries.popitem(last=False)
+            self.current_bytes -= tamanho_removido
+
+    def _path(self, nome):
+        return os.path.join(self.directory, f"{nome}.cache")
+
+    # Arquivo de cada entrada: tamanho do cabeçalho (8 bytes), cabeçalho JSON com a data de criação e o tamanho
+    # do pickle e a posição de cada array (contadas a partir do fim do cabeçalho), o pickle e os arrays,
+    # alinhados para serem usados direto do mapeamento
+    @staticmethod
+    def _read_header(f):
+        tamanho = int.from_bytes(f.read(8), 'little')
+        return json.loads(f.read(tamanho)), 8 + tamanho
+
+    def _get_disk(self, nome):
+        caminho = self._path(nome)
+        try:
+            with open(caminho, 'rb') as f:
+                cabecalho, inicio = self._read_header(f)
+                if self._expired(cabecalho['criado']):
+                    self._remove(caminho)
+                    return None
+                mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        # A data de modificação marca o último uso (ordem de remoção quando o cache passa do tamanho máximo)
+        os.utime(caminho)
+        dados = memoryview(mapa)[inicio:]
+        buffers = [dados[posicao:posicao + tamanho] for posicao, tamanho in cabecalho['buffers']]
+        return _from_shared(pickle.loads(dados[:cabecalho['pickle']], buffers=buffers))
+
+    def _put_disk(self, nome, obj):
+        buffers = []
+        conteudo = pickle.dumps(_to_shared(obj), protocol=5, buffer_callback=buffers.append)
+        buffers = [buffer.raw() for buffer in buffers]
+        posicoes, posicao = [], len(conteudo)
+        for buffer in buffers:
+            posicao += -posicao % SHARED_CACHE_ALIGNMENT
+            posicoes.append([posicao, buffer.nbytes])
+            posicao += buffer.nbytes
+        # O cabeçalho é completado com espaços até o alinhamento, para os arrays ficarem alinhados no arquivo
+        texto = json.dumps({'criado': time.time(), 'pickle': len(conteudo), 'buffers': posicoes}).encode('utf-8')
+        texto = texto.ljust(len(texto) + (-(8 + len(texto)) % SHARED_CACHE_ALIGNMENT))
+
+        caminho = self._path(nome)
+        temporario = f"{caminho}.{uuid.uuid4().hex}.tmp"
+        with open(temporario, 'wb') as f:
+            f.write(len(texto).to_bytes(8, 'little'))
+            f.write(texto)
+            f.write(conteudo)
+            inicio = f.tell() - len(conteudo)
+            for (posicao, _), buffer in zip(posicoes, buffers):
+                f.write(b'\0' * (inicio + posicao - f.tell()))
+                f.write(buffer)
+        os.replace(temporario, caminho)
+        self._evict_disk()
+
+    def _remove(self, caminho):
+        try:
+            os.remove(caminho)
+        except OSError:
+            pass
+
+    # Remove as entradas vencidas e, se o cache passar do tamanho máximo, as usadas há mais tempo
+    def _evict_disk(self):
+        entradas = []
+        for nome in os.listdir(self.directory):
+            if not nome.endswith('.cache'):
+                continue
+            caminho = os.path.join(self.directory, nome)
+            try:
+                with open(caminho, 'rb') as f:
+                    criado = self._read_header(f)[0]['criado']
+                info = os.stat(caminho)
+            except (OSError, ValueError):
+                continue
+            if self._expired(criado):
+                self._remove(caminho)
+            else:
+                entradas.append((info.st_mtime, info.st_size, caminho))
+        total = sum(tamanho for _, tamanho, _ in entradas)
+        for _, tamanho, caminho in sorted(entradas):
+            if total <= self.max_bytes:
+                break
+            self._remove(caminho)
+            total -= tamanho
+
+    def stats(self):
+        with self._lock:
+            if self.backend == 'memory':
+                entradas, tamanho = len(self._entries), self.current_bytes
+            else:
+                arquivos = [os.path.join(self.directory, nome) for nome in os.listdir(self.directory) if nome.endswith('.cache')]
+                entradas = len(arquivos)
+                tamanho = sum(os.path.getsize(caminho) for caminho in arquivos if os.path.exists(caminho))
+        return {
+            'backend': self.backend,
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': entradas,
+            'bytes': tamanho,
+            'max_bytes': self.max_bytes,
+        }
+
+# Cache compartilhado do servidor (criado na primeira vez, se configurado)
+_shared_cache = None
+
+# Função para obter o cache compartilhado do servidor, ou None se ele estiver desligado
+def get_shared_cache():
+    global _shared_cache
+    if _shared_cache is None and SHARED_CACHE_BACKEND:
+        _shared_cache = SharedDataCache(SHARED_CACHE_BACKEND)
+    return _shared_cache
+
+# Função para ler uma entrada do cache compartilhado (None se não houver, ou se o cache estiver desligado)
+def shared_cache_get(chave):
+    cache = _importable_module().get_shared_cache()
+    return cache.get(chave) if cache is not None else None
+
+# Função para guardar uma entrada no cache compartilhado (se ele estiver ligado)
+def shared_cache_put(chave, obj):
+    cache = _importable_module().get_shared_cache()
+    if cache is not None:
+        cache.put(chave, obj)
+
+# Função para obter um resultado do cache compartilhado, calculando-o e guardando-o na primeira vez. Sem cache
+# compartilhado, apenas calcula. O resultado pode ser usado por outras sessões e não deve ser alterado.
+def shared_cached(chave, calcular):
+    resultado = shared_cache_get(chave)
+    if resultado is None:
+        resultado = calcular()
+        if resultado is not None:
+            shared_cache_put(chave, resultado)
+    return resultado
+
+# Quantidade padrão de processos da ingestão paralela
+INGESTION_WORKERS = min(5, os.cpu_count() or 1)
+
+# Pools de processos da ingestão, reaproveitados entre as execuções do script (um por quantidade de processos)
+_process_pools = {}
+
+# Função para obter o módulo importável deste arquivo. O Streamlit executa o script como __main__, e funções
+# de __main__ não podem ser enviadas para outros processos; o módulo importado também mantém os pools vivos.
+def _importable_module():
+    if __name__ != '__main__':
+        return sys.modules[__name__]
+    return importlib.import_module(os.path.splitext(os.path.basename(__file__))[0])
+
+# Função para obter (ou criar) o pool de processos da ingestão
+def get_process_pool(workers):
+    if workers not in _process_pools:
+        # 'spawn' evita copiar com fork as threads do servidor do Streamlit
+        _process_pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    return _process_pools[workers]
+
+# Função executada nos processos da ingestão: carrega e processa uma planilha a partir do seu conteúdo
+# e devolve o DataFrame junto com as mensagens de erro e aviso geradas e, com perfil, as etapas medidas
+# (no próprio processo principal as etapas já vão direto para o perfil ativo)
+def _ingest_worker(conteudo, process_name, reader, perfil=False):
+    anterior = getattr(_message_state, 'sink', None)
+    mensagens = _message_state.sink = []
+    profiler = None
+    if perfil and get_active_profiler() is None:
+        profiler = StageProfiler()
+        activate_profiler(profiler)
+    try:
+        process_func = globals()[process_name]
+        arquivo = io.BytesIO(conteudo)
+        if reader in EXCEL_READERS:
+            df = load_data_chunked(arquivo, process_func, reader=reader)
+        else:
+            df = load_data(arquivo)
+            if df is not None:
+                df = process_func(df)
+        return df, mensagens, (profiler.records if profiler is not None else [])
+    finally:
+        _message_state.sink = anterior
+        if profiler is not None:
+            activate_profiler(None)
+
+# Função para obter o conteúdo de um arquivo carregado (ou de um caminho)
+def _file_content(uploaded_file):
+    if hasattr(uploaded_file, 'getvalue'):
+        return uploaded_file.getvalue()
+    with open(uploaded_file, 'rb') as f:
+        return f.read()
+
+# Função para carregar e processar várias planilhas ao mesmo tempo, em um pool de processos.
+# Recebe {nome: (arquivo, process_func)} e devolve {nome: DataFrame ou None}; os erros de cada arquivo
+# são exibidos com o nome do arquivo, e arquivos sem alteração continuam vindo do cache de ingestão.
+@profiled
+def load_processed_parallel(planilhas, workers=INGESTION_WORKERS, reader='pandas', cache=None):
+    if cache is None:
+        cache = get_ingestion_cache()
+
+    resultados = {}
+    pendentes = {}
+    for nome, (uploaded_file, process_func) in planilhas.items():
+        if uploaded_file is None:
+            resultados[nome] = None
+            continue
+        chave = (file_content_hash(uploaded_file), process_func.__name__, reader)
+        df = cache.get(chave)
+        if df is None:
+            # Outra sessão pode já ter processado o mesmo arquivo
+            df = shared_cache_get(('planilha',) + chave)
+            if df is not None:
+                cache.put(chave, df)
+        if df is not None:
+            resultados[nome] = df
+        else:
+            pendentes[nome] = (chave, uploaded_file, process_func)
+
+    # Com um único arquivo (ou um único processo) não compensa enviar o trabalho para outro processo
+    profiler = get_active_profiler()
+    if workers <= 1 or len(pendentes) <= 1:
+        for nome, (chave, uploaded_file, process_func) in pendentes.items():
+            nome_arquivo = getattr(uploaded_file, 'name', str(uploaded_file))
+            primeiro_registro = len(profiler.records) if profiler is not None else 0
+            df, mensagens, _ = _ingest_worker(_file_content(uploaded_file), process_func.__name__, reader)
+            if profiler is not None:
+                for registro in profiler.records[primeiro_registro:]:
+                    registro['arquivo'] = nome_arquivo
+            for nivel, mensagem in mensagens:
+                report_message(nivel, f"{nome_arquivo}: {mensagem}")
+            if df is not None:
+                cache.put(chave, df)
+                shared_cache_put(('planilha',) + chave, df)
+            resultados[nome] = df
+        return resultados
+
+    modulo = _importable_module()
+    pool = modulo.get_process_pool(workers)
+    tarefas = {
+        nome: pool.submit(modulo._ingest_worker, _file_content(uploaded_file), process_func.__name__, reader, profiler is not None)
+        for nome, (_, uploaded_file, process_func) in pendentes.items()
+    }
+    for nome, tarefa in tarefas.items():
+        chave, uploaded_file, _ = pendentes[nome]
+        nome_arquivo = getattr(uploaded_file, 'name', str(uploaded_file))
+        try:
+            df, mensagens, registros = tarefa.result()
+            if profiler is not None:
+                profiler.merge(registros, arquivo=nome_arquivo)
+        except BrokenProcessPool as e:
+            # Um processo morreu (ex.: falta de memória): o pool é descartado e recriado na próxima leitura
+            modulo._process_pools.pop(workers, None)
+            df, mensagens = None, [('error', f"Erro ao carregar o arquivo: {e}")]
+        except Exception as e:
+            df, mensagens = None, [('error', f"Erro ao carregar o arquivo: {e}")]
+        for nivel, mensagem in mensagens:
+            report_message(nivel, f"{nome_arquivo}: {mensagem}")
+        if df is not None:
+            cache.put(chave, df)
+            shared_cache_put(('planilha',) + chave, df)
+        resultados[nome] = df
+    return resultados
+
+# Função para carregar as cinco planilhas em paralelo e agregar contas a receber e contas a pagar.
+# O Relatório Caixa sem a coluna Unidade é atribuído à unidade padrão do cadastro.
+# Devolve (df_receivables, df_payables, df_cash_report), ou None se alguma planilha não pôde ser carregada.
+def load_all_parallel(planilhas, workers=INGESTION_WORKERS, reader='pandas', cache=None, unidade_padrao=None):
+    dados = load_processed_parallel(planilhas, workers=workers, reader=reader, cache=cache)
+    if any(df is None for df in dados.values()):
+        return None
+    df_receivables = concat_ledgers([dados['receber_quitadas'], dados['receber_pendentes']])
+    df_payables = concat_ledgers([dados['pagar_quitadas'], dados['pagar_pendentes']])
+    df_cash_report = assign_default_unit(dados['relatorio_caixa'], unidade_padrao or default_unit(DEFAULT_UNIT_BALANCES))
+    return df_receivables, df_payables, df_cash_report
+
+# Diretório do histórico local das planilhas processadas (Parquet particionado por unidade e mês)
+LEDGER_STORE_DIR = os.environ.get('FLUXO_STORE_DIR', 'historico')
+
+# Modo de gravação de cada planilha no histórico: as quitadas e o relatório de caixa acumulam
+# linhas novas; as pendentes são uma fotografia dos títulos em aberto e substituem a anterior
+LEDGER_STORE_MODES = {
+    'receber_quitadas': 'append',
+    'receber_pendentes': 'replace',
+    'pagar_quitadas': 'append',
+    'pagar_pendentes': 'replace',
+    'relatorio_caixa': 'append',
+}
+
+# Coluna de valores em reais de cada planilha no histórico (gravada ao lado dos centavos, como antes do
+# esquema compacto, para as chaves das linhas já gravadas continuarem valendo)
+LEDGER_VALUE_COLUMNS = {
+    'receber_quitadas': 'Recebimentos',
+    'receber_pendentes': 'Recebimentos',
+    'pagar_quitadas': 'Pagamentos',
+    'pagar_pendentes': 'Pagamentos',
+    'relatorio_caixa': 'Recebimentos',
+}
+
+# Colunas de data usadas para definir o mês da partição (a primeira existente na planilha)
+PARTITION_DATE_COLUMNS = ['Data', 'Vencimento', 'Pagamento']
+
+# Colunas de data com mínimo e máximo registrados no manifesto, para descartar arquivos fora do período
+STORE_DATE_COLUMNS = ['Pagamento', 'Data', 'Vencimento']
+
+# Colunas do pipeline que identificam um título no histórico, além do valor em centavos
+LEDGER_KEY_COLUMNS = ['Pagamento', 'Data', 'Vencimento', 'Unidade', 'Conta Analítica']
+
+# Função para calcular uma chave estável por linha (o mesmo título gera sempre a mesma chave). Só entram as
+# colunas usadas pelo pipeline (datas, unidade, conta analítica e centavos): a chave não depende do modo de
+# leitura, que mantém ou não as demais colunas da planilha, nem de edições nessas outras colunas.
+def ledger_row_keys(df, value_column):
+    colunas = {}
+    for coluna in LEDGER_KEY_COLUMNS:
+        if coluna not in df.columns:
+            continue
+        serie = df[coluna]
+        if pd.api.types.is_datetime64_any_dtype(serie):
+            colunas[coluna] = serie.to_numpy(dtype='datetime64[ns]')
+        else:
+            # Textos e categorias são comparados como texto (células vazias como texto vazio)
+            colunas[coluna] = serie.astype(object).where(serie.notna(), '').astype(str).to_numpy()
+    colunas['Centavos'] = ledger_centavos(df, value_column)
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(colunas), index=False)
+    # Linhas idênticas dentro do mesmo arquivo são diferenciadas pela ordem de ocorrência
+    ocorrencia = hashes.groupby(hashes).cumcount()
+    chaves = pd.DataFrame({'hash': hashes.to_numpy(), 'ocorrencia': ocorrencia.to_numpy()})
+    return pd.util.hash_pandas_object(chaves, index=False).to_numpy()
+
+# Função para ler o manifesto de uma planilha do histórico
+def _read_ledger_manifest(store_dir, ledger):
+    caminho = os.path.join(store_dir, ledger, '_manifest.json')
+    if not os.path.exists(caminho):
+        return {'files': []}
+    with open(caminho, encoding='utf-8') as f:
+        return json.load(f)
+
+# Função para gravar o manifesto de uma planilha do histórico
+def _write_ledger_manifest(store_dir, ledger, manifest):
+    caminho = os.path.join(store_dir, ledger, '_manifest.json')
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    temporario = caminho + '.tmp'
+    with open(temporario, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(temporario, caminho)
+
+# Função para preparar uma planilha processada para gravação em Parquet
+def _prepare_for_store(df, value_column):
+    # Valores em reais ao lado dos centavos, como nos arquivos gravados antes do esquema compacto
+    df = df.assign(**{value_column: df['Centavos'] / 100})
+    # Colunas texto com tipos misturados (ex.: números e textos) são gravadas como texto
+    for coluna in df.columns:
+        if df[coluna].dtype == object:
+            df[coluna] = df[coluna].where(df[coluna].isna(), df[coluna].astype(str))
+    return df
+
+# Função para acrescentar ao histórico apenas as linhas ainda não gravadas
+@profiled
+def append_to_ledger_store(df, ledger, store_dir=LEDGER_STORE_DIR):
+    manifest = _read_ledger_manifest(store_dir, ledger)
+    pasta_ledger = os.path.join(store_dir, ledger)
+
+    if LEDGER_STORE_MODES.get(ledger) == 'replace':
+        for arquivo in manifest['files']:
+            caminho = os.path.join(pasta_ledger, arquivo['path'])
+            if os.path.exists(caminho):
+                os.remove(caminho)
+        manifest['files'] = []
+
+    df = _prepare_for_store(df, LEDGER_VALUE_COLUMNS[ledger])
+    df['_row_key'] = ledger_row_keys(df, LEDGER_VALUE_COLUMNS[ledger])
+
+    coluna_mes = next((c for c in PARTITION_DATE_COLUMNS if c in df.columns), None)
+    if coluna_mes is None:
+        meses = pd.Series('sem-data', index=df.index)
     else:
-        st.error("A planilha de Relatório Caixa - Contas a Receber não está no formato esperado.")
+        meses = df[coluna_mes].dt.strftime('%Y-%m').fillna('sem-data')
+
+    linhas_novas = 0
+    for (unidade, mes), grupo in df.groupby([df['Unidade'], meses], sort=False, observed=True):
+        # Descartar as linhas cuja chave já existe na partição
+        existentes = [a for a in manifest['files'] if a['unidade'] == unidade and a['mes'] == mes]
+        if existentes:
+            # As chaves das linhas gravadas são recalculadas a partir das colunas do pipeline, o que vale também
+            # para arquivos gravados com outra chave (ex.: com todas as colunas da planilha)
+            gravadas = pd.concat([pd.read_parquet(os.path.join(pasta_ledger, a['path'])) for a in existentes],
+                                 ignore_index=True)
+            chaves = ledger_row_keys(gravadas, LEDGER_VALUE_COLUMNS[ledger])
+            grupo = grupo[~grupo['_row_key'].isin(chaves)]
+        if grupo.empty:
+            continue
+
+        particao = os.path.join(f"unidade={quote(unidade, safe='')}", f"mes={mes}")
+        os.makedirs(os.path.join(pasta_ledger, particao), exist_ok=True)
+        caminho = os.path.join(particao, f"part-{uuid.uuid4().hex}.parquet")
+        grupo.to_parquet(os.path.join(pasta_ledger, caminho), index=False)
+
+        estatisticas = {}
+        for coluna in STORE_DATE_COLUMNS:
+            if (coluna in grupo.columns and pd.api.types.is_datetime64_any_dtype(grupo[coluna])
+                    and grupo[coluna].notna().any()):
+                estatisticas[coluna] = [grupo[coluna].min().isoformat(), grupo[coluna].max().isoformat()]
+        manifest['files'].append({
+            'path': caminho,
+            'unidade': unidade,
+            'mes': mes,
+            'rows': len(grupo),
+            'dates': estatisticas,
+        })
+        linhas_novas += len(grupo)
+
+    _write_ledger_manifest(store_dir, ledger, manifest)
+    return linhas_novas
+
+# Função para listar as unidades presentes no histórico
+def ledger_store_units(store_dir=LEDGER_STORE_DIR):
+    unidades = set()
+    for ledger in LEDGER_STORE_MODES:
+        unidades.update(a['unidade'] for a in _read_ledger_manifest(store_dir, ledger)['files'])
+    return sorted(unidades)
+
+# Função para obter uma assinatura do histórico (muda sempre que algum manifesto é regravado)
+def ledger_store_signature(store_dir=LEDGER_STORE_DIR):
+    assinatura = []
+    for ledger in LEDGER_STORE_MODES:
+        caminho = os.path.join(store_dir, ledger, '_manifest.json')
+        assinatura.append(os.path.getmtime(caminho) if os.path.exists(caminho) else None)
+    return tuple(assinatura)
+
+# Função para ler do histórico apenas as partições de uma unidade e de um período
+@profiled
+def read_ledger_store(ledgers, unidade_selecionada, start_date, end_date, date_columns, store_dir=LEDGER_STORE_DIR):
+    frames = []
+    for ledger in ledgers:
+        manifest = _read_ledger_manifest(store_dir, ledger)
+        if not manifest['files']:
+            continue
+        pasta_ledger = os.path.join(store_dir, ledger)
+
+        arquivos = manifest['files']
+        if unidade_selecionada != "Todas as Unidades":
+            arquivos = [a for a in arquivos if a['unidade'] == unidade_selecionada]
+
+        # Manter apenas os arquivos com alguma data do período em uma das colunas usadas
+        arquivos = [
+            a for a in arquivos
+            if any(
+                coluna in a['dates']
+                and pd.Timestamp(a['dates'][coluna][0]) <= end_date
+                and pd.Timestamp(a['dates'][coluna][1]) >= start_date
+                for coluna in date_columns
+            )
+        ]
+
+        if arquivos:
+            df = pd.concat([pd.read_parquet(os.path.join(pasta_ledger, a['path'])) for a in arquivos], ignore_index=True)
+            # Filtrar as linhas do período
+            no_periodo = np.zeros(len(df), dtype=bool)
+            for coluna in date_columns:
+                if coluna in df.columns and pd.api.types.is_datetime64_any_dtype(df[coluna]):
+                    no_periodo |= df[coluna].between(start_date, end_date).to_numpy()
+            df = df[no_periodo]
+        else:
+            # Nenhum arquivo no período: DataFrame vazio com o esquema da planilha
+            df = pd.read_parquet(os.path.join(pasta_ledger, manifest['files'][0]['path'])).iloc[0:0]
+        # No histórico os valores também estão em reais; na memória ficam só os centavos
+        frames.append(compact_ledger(df.drop(columns='_row_key'), LEDGER_VALUE_COLUMNS[ledger]))
+
+    if not frames:
         return None
+    return concat_ledgers(frames)
+
+# Função para somar valores por dia dentro de um intervalo de datas (vetorizada)
+def sum_by_day(dates, values, date_range):
+    if len(date_range) == 0:
+        return np.zeros(0)
+
+    # Deslocamento de cada lançamento, em nanossegundos, a partir do primeiro dia do intervalo
+    um_dia = pd.Timedelta(days=1).value
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        # Colunas ainda em texto (dd/mm/aaaa); células que não são datas ficam de fora, como NaT
+        dates = pd.to_datetime(dates, format=DATE_FORMAT, errors='coerce')
+    datas = pd.Series(dates).to_numpy(dtype='datetime64[ns]')
+    validas = ~np.isnat(datas)
+    deslocamento = datas.astype(np.int64) - date_range[0].value
+
+    # Apenas datas que caem exatamente em um dia do intervalo entram na soma (NaT e datas fora do período são ignoradas)
+    dias = deslocamento // um_dia
+    mascara = validas & (deslocamento % um_dia == 0) & (dias >= 0) & (dias < len(date_range))
+
+    return np.bincount(
+        dias[mascara],
+        weights=np.asarray(values, dtype=float)[mascara],
+        minlength=len(date_range),
+    )
+
+# Função para obter os valores de uma planilha em centavos inteiros
+def ledger_centavos(df, value_column):
+    if 'Centavos' in df.columns and df['Centavos'].notna().all():
+        return df['Centavos'].to_numpy(dtype=np.int64)
+    # Planilhas sem a coluna 'Centavos' (ou com lacunas) são convertidas a partir dos valores em reais
+    reais = np.rint(pd.to_numeric(df[value_column]).fillna(0).to_numpy(dtype=float) * 100).astype(np.int64)
+    if 'Centavos' not in df.columns:
+        return reais
+    return np.where(df['Centavos'].isna(), reais, df['Centavos'].fillna(0)).astype(np.int64)
+
+# Função para montar o DataFrame do fluxo de caixa a partir das somas diárias em centavos.
+# O saldo acumulado é somado em centavos inteiros, sem acúmulo de erro de arredondamento.
+def cash_flow_from_centavos(date_range, recebimentos, pagamentos, saldo_inicial):
+    recebimentos = np.rint(recebimentos).astype(np.int64)
+    pagamentos = np.rint(pagamentos).astype(np.int64)
+    saldo = recebimentos - pagamentos
+    saldo_acumulado = np.cumsum(saldo) + int(round(saldo_inicial * 100))
+    return pd.DataFrame({
+        'Recebimentos': recebimentos / 100,
+        'Pagamentos': pagamentos / 100,
+        'Saldo': saldo / 100,
+        'Saldo Acumulado': saldo_acumulado / 100,
+    }, index=date_range)
+
+# Cadastro de unidades padrão (usado quando não há arquivo de cadastro): unidade -> saldo inicial em reais.
+# A primeira unidade do cadastro recebe os lançamentos do Relatório Caixa quando a planilha não tem a coluna Unidade.
+DEFAULT_UNIT_BALANCES = {"UNIDADE SOMBRIO": 0.0, "UNIDADE MORRO DA FUMAÇA": 0.0}
+
+# Arquivo de cadastro de unidades lido do servidor quando nenhum é carregado (.csv ou .xlsx com as colunas
+# "Unidade" e "Saldo Inicial", valores no formato brasileiro)
+UNIT_REGISTRY_FILE = os.environ.get('FLUXO_UNIDADES', 'unidades.csv')
+
+# Função para carregar o cadastro de unidades com os saldos iniciais. Sem arquivo, usa UNIT_REGISTRY_FILE se
+# existir, senão o cadastro padrão. Devolve {unidade: saldo inicial em reais}, na ordem do arquivo.
+def load_unit_registry(arquivo=None):
+    if arquivo is None:
+        if not os.path.exists(UNIT_REGISTRY_FILE):
+            return dict(DEFAULT_UNIT_BALANCES)
+        arquivo = UNIT_REGISTRY_FILE
+
+    nome = getattr(arquivo, 'name', str(arquivo))
+    try:
+        if nome.lower().endswith('.xlsx'):
+            # Sem dtype=str: um saldo numérico (1500.5) viraria o texto "1500.5", lido como R$ 15.005,00
+            df = pd.read_excel(arquivo)
+        else:
+            # Separador detectado automaticamente (planilhas brasileiras costumam usar ';')
+            df = pd.read_csv(arquivo, sep=None, engine='python', dtype=str)
+    except Exception as e:
+        report_message('error', f"Erro ao carregar o cadastro de unidades: {e}")
+        return dict(DEFAULT_UNIT_BALANCES)
+    df.columns = df.columns.str.strip()
+    if 'Unidade' not in df.columns or 'Saldo Inicial' not in df.columns:
+        report_message('error', "O cadastro de unidades precisa das colunas 'Unidade' e 'Saldo Inicial'.")
+        return dict(DEFAULT_UNIT_BALANCES)
+
+    df = df.dropna(subset=['Unidade'])
+    df['Unidade'] = df['Unidade'].astype(str)
+    centavos, _, invalidas = parse_brl_centavos(df['Saldo Inicial'])
+    if invalidas.any():
+        report_message('warning', "Saldos iniciais inválidos (considerados zero) no cadastro de unidades: " +
+                       ", ".join(df['Unidade'][invalidas].str.strip()))
+    return {unidade.strip(): saldo / 100 for unidade, saldo in zip(df['Unidade'], centavos)}
+
+# Função para obter a unidade padrão do Relatório Caixa (a primeira do cadastro)
+def default_unit(saldos_iniciais):
+    return next(iter(saldos_iniciais), next(iter(DEFAULT_UNIT_BALANCES)))
 
-# Adicionar campos de entrada para os saldos das contas bancárias no sidebar
-st.sidebar.header("Saldos Bancários Iniciais")
-saldo_sombrio = st.sidebar.number_input("Saldo Inicial - Conta Sombrio", value=0.0)
-saldo_fumaca = st.sidebar.number_input("Saldo Inicial - Conta Fumaça", value=0.0)
+# Função para preencher a unidade padrão no Relatório Caixa quando a planilha não tem a coluna Unidade
+def assign_default_unit(df_cash_report, unidade_padrao):
+    if 'Unidade' in df_cash_report.columns:
+        return df_cash_report
+    return df_cash_report.assign(Unidade=pd.Categorical.from_codes(np.zeros(len(df_cash_report), dtype=np.int8), [unidade_padrao]))
+
+# Função para obter o saldo inicial com base na unidade selecionada ("Todas as Unidades" soma o cadastro inteiro)
+def initial_balance(unidade_selecionada, saldos_iniciais):
+    if unidade_selecionada == "Todas as Unidades":
+        return sum(saldos_iniciais.values())
+    return saldos_iniciais.get(unidade_selecionada, 0)
 
 # Função para calcular o fluxo de caixa com saldos iniciais
-def calculate_cash_flow(df_receivables, df_payables, df_cash_report, start_date, end_date, regime, saldo_sombrio, saldo_fumaca, unidade_selecionada):
+@profiled
+def calculate_cash_flow(df_receivables, df_payables, df_cash_report, start_date, end_date, regime, saldos_iniciais, unidade_selecionada):
     date_range = pd.date_range(start=start_date, end=end_date, freq='D')
-    cash_flow = pd.DataFrame(index=date_range, columns=['Recebimentos', 'Pagamentos', 'Saldo'])
-    cash_flow = cash_flow.fillna(0)
 
     # Definir a coluna de data com base no regime
     if regime == 'Caixa':
@@ -123,107 +1324,1170 @@ def calculate_cash_flow(df_receivables, df_payables, df_cash_report, start_date,
     elif regime == 'Caixa Projetado':  # Novo regime
         coluna_data = 'Vencimento'
     else:
-        st.error("Regime inválido selecionado.")
+        report_message('error', "Regime inválido selecionado.")
         return None
 
-    # Soma os recebimentos por dia (das duas planilhas de recebimentos)
-    for index, row in df_receivables.iterrows():
-        if row[coluna_data] in cash_flow.index:
-            cash_flow.loc[row[coluna_data], 'Recebimentos'] += row['Recebimentos']
+    # Soma os recebimentos por dia (das duas planilhas de recebimentos), em centavos
+    recebimentos = sum_by_day(df_receivables[coluna_data], ledger_centavos(df_receivables, 'Recebimentos'), date_range)
 
     # Soma os recebimentos da terceira planilha (Relatório Caixa - Contas a Receber)
-    for index, row in df_cash_report.iterrows():
-        if regime == 'Caixa Projetado':
-            # No regime "Caixa Projetado", usamos a coluna 'Vencimento' para a planilha de Caixa - Contas a Receber
-            if 'Vencimento' in df_cash_report.columns:
-                if row['Vencimento'] in cash_flow.index:
-                    cash_flow.loc[row['Vencimento'], 'Recebimentos'] += row['Recebimentos']
-        else:
-            # Nos outros regimes, usamos a coluna 'Data'
-            if row['Data'] in cash_flow.index:
-                cash_flow.loc[row['Data'], 'Recebimentos'] += row['Recebimentos']
+    # No regime "Caixa Projetado", usamos a coluna 'Vencimento' para a planilha de Caixa - Contas a Receber;
+    # nos outros regimes, usamos a coluna 'Data'
+    coluna_data_caixa = 'Vencimento' if regime == 'Caixa Projetado' else 'Data'
+    if coluna_data_caixa in df_cash_report.columns:
+        recebimentos = recebimentos + sum_by_day(df_cash_report[coluna_data_caixa], ledger_centavos(df_cash_report, 'Recebimentos'), date_range)
 
     # Soma os pagamentos por dia
-    for index, row in df_payables.iterrows():
-        if row[coluna_data] in cash_flow.index:
-            cash_flow.loc[row[coluna_data], 'Pagamentos'] += row['Pagamentos']
+    pagamentos = sum_by_day(df_payables[coluna_data], ledger_centavos(df_payables, 'Pagamentos'), date_range)
+
+    # Calcula o saldo diário e o saldo acumulado a partir do saldo inicial da unidade selecionada
+    saldo_inicial = initial_balance(unidade_selecionada, saldos_iniciais)
+    return cash_flow_from_centavos(date_range, recebimentos, pagamentos, saldo_inicial)
+
+# Função para obter a posição de cada valor de uma coluna em um índice de textos (-1 se ausente). Em colunas
+# categóricas só as categorias são convertidas e procuradas, não cada linha.
+def _index_codes(indice, serie):
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        codigos = serie.cat.codes.to_numpy()
+        return np.where(codigos >= 0, indice.get_indexer(serie.cat.categories.astype(str))[codigos], -1)
+    return indice.get_indexer(serie.astype(str))
+
+# Distância máxima (em anos) entre uma data e a mediana das datas das planilhas para entrar no eixo de dias do
+# cubo. Datas mais distantes são quase sempre erros de digitação (ex.: 2203 em vez de 2023) e fariam as séries
+# diárias do cubo ocuparem gigabytes.
+CUBE_MAX_YEARS_FROM_MEDIAN = 10
+
+# Função para obter a janela de datas plausíveis do cubo (início e fim) e avisar quantas datas ficam de fora
+def cube_date_window(frames, colunas_data):
+    datas = [
+        frames[ledger][c].dropna().to_numpy(dtype='datetime64[ns]')
+        for ledger, colunas in colunas_data.items() for c in colunas
+    ]
+    datas = np.concatenate(datas) if datas else np.empty(0, dtype='datetime64[ns]')
+    if len(datas) == 0:
+        return pd.Timestamp.min, pd.Timestamp.max
+    mediana = pd.Timestamp(int(np.median(datas.view(np.int64)))).normalize()
+    inicio = mediana - pd.DateOffset(years=CUBE_MAX_YEARS_FROM_MEDIAN)
+    fim = mediana + pd.DateOffset(years=CUBE_MAX_YEARS_FROM_MEDIAN)
+    fora = int(((datas < inicio.to_datetime64()) | (datas > fim.to_datetime64())).sum())
+    if fora:
+        report_message('warning', f"{fora} data(s) fora do intervalo de {inicio:%d/%m/%Y} a {fim:%d/%m/%Y} "
+                                  f"foram ignoradas nas séries diárias (provável erro de digitação).")
+    return inicio, fim
+
+# Planilhas do cubo de agregados e a coluna de valor de cada uma
+CUBE_LEDGERS = {'receber': 'Recebimentos', 'pagar': 'Pagamentos', 'caixa': 'Recebimentos'}
+
+# Função para montar o cubo diário de agregados (dia × unidade × conta analítica × coluna de data).
+# O cubo é montado uma vez por conjunto de dados; indicadores, gráficos e fluxo de caixa são
+# calculados a partir de fatias e somas acumuladas dele, sem percorrer as linhas novamente.
+@profiled
+def build_aggregate_cube(df_receivables, df_payables, df_cash_report):
+    frames = {'receber': df_receivables, 'pagar': df_payables, 'caixa': df_cash_report}
+
+    # Dimensão de unidades, comum a todas as planilhas
+    unidades = pd.Index(sorted(set().union(*(map(str, df['Unidade'].unique()) for df in frames.values()))))
+
+    # Dimensão de dias: do primeiro ao último dia presente em qualquer coluna de data, dentro da janela de datas
+    # plausíveis (as datas fora dela ficam fora das séries diárias e são avisadas)
+    colunas_data = {
+        ledger: [c for c in STORE_DATE_COLUMNS if c in df.columns and pd.api.types.is_datetime64_any_dtype(df[c])]
+        for ledger, df in frames.items()
+    }
+    janela = cube_date_window(frames, colunas_data)
+    limites = [
+        (datas.min(), datas.max())
+        for ledger, colunas in colunas_data.items() for c in colunas
+        for datas in [frames[ledger][c][frames[ledger][c].between(*janela)]] if len(datas)
+    ]
+    if limites:
+        inicio = min(l[0] for l in limites).normalize()
+        dias = (max(l[1] for l in limites).normalize() - inicio).days + 1
+    else:
+        inicio, dias = pd.Timestamp.today().normalize(), 0
 
-    # Calcula o saldo diário
-    cash_flow['Saldo'] = cash_flow['Recebimentos'] - cash_flow['Pagamentos']
+    n_unidades = len(unidades)
+    cube = {'units': unidades, 'start': inicio, 'days': dias, 'ledgers': {}}
 
-    # Adicionar saldo inicial com base na unidade selecionada
+    for ledger, df in frames.items():
+        # As somas são feitas em centavos inteiros (exatas em float64 até 2**53 centavos)
+        somas = ledger_centavos(df, CUBE_LEDGERS[ledger]).astype(float)
+        valores = somas / 100
+        cod_unidade = _index_codes(unidades, df['Unidade'])
+        cod_conta, contas = pd.factorize(df['Conta Analítica'], sort=True)
+        contas = pd.Index(np.asarray(contas, dtype=object))
+        n_contas = len(contas)
+
+        # Totais por unidade × conta analítica, com todas as linhas (independentemente das datas)
+        com_conta = cod_conta >= 0
+        celula_conta = cod_unidade[com_conta] * n_contas + cod_conta[com_conta]
+        entry = {
+            'value_column': CUBE_LEDGERS[ledger],
+            'accounts': contas,
+            'account_codes': cod_conta,
+            'values': valores,
+            'unit_counts': np.bincount(cod_unidade, minlength=n_unidades),
+            'account_totals': np.bincount(celula_conta, weights=somas[com_conta], minlength=n_unidades * n_contas).reshape(n_unidades, n_contas),
+            'account_counts': np.bincount(celula_conta, minlength=n_unidades * n_contas).reshape(n_unidades, n_contas),
+            'dates': {},
+        }
+
+        for coluna in colunas_data[ledger]:
+            datas = df[coluna]
+            validas = datas.between(*janela).to_numpy()
+            dia = (datas - inicio).dt.days.to_numpy(dtype=float)
+            dia = np.where(validas, dia, 0).astype(np.int64)
+            celula = dia[validas] * n_unidades + cod_unidade[validas]
+
+            # Somas e contagens diárias por unidade, com as somas acumuladas ao longo dos dias
+            diario = np.bincount(celula, weights=somas[validas], minlength=dias * n_unidades).reshape(dias, n_unidades)
+            contagens = np.bincount(celula, minlength=dias * n_unidades).reshape(dias, n_unidades)
+            acumulado = np.zeros((dias + 1, n_unidades))
+            np.cumsum(diario, axis=0, out=acumulado[1:])
+            contagens_acumuladas = np.zeros((dias + 1, n_unidades), dtype=np.int64)
+            np.cumsum(contagens, axis=0, out=contagens_acumuladas[1:])
+
+            # Linha de maior valor em cada dia × unidade (a primeira, em caso de empate)
+            candidatas = np.flatnonzero(validas)
+            maior_linha = np.full(dias * n_unidades, -1, dtype=np.int64)
+            if len(candidatas):
+                celula_candidata = dia[candidatas] * n_unidades + cod_unidade[candidatas]
+                ordem = np.lexsort((candidatas, -valores[candidatas], celula_candidata))
+                _, primeiras = np.unique(celula_candidata[ordem], return_index=True)
+                escolhidas = ordem[primeiras]
+                maior_linha[celula_candidata[escolhidas]] = candidatas[escolhidas]
+
+            entry['dates'][coluna] = {
+                'daily': diario,
+                'prefix': acumulado,
+                'prefix_counts': contagens_acumuladas,
+                'max_row': maior_linha.reshape(dias, n_unidades),
+            }
+        cube['ledgers'][ledger] = entry
+    return cube
+
+# Função para obter as colunas de unidade do cubo correspondentes à unidade selecionada
+def _cube_units(cube, unidade_selecionada):
     if unidade_selecionada == "Todas as Unidades":
-        saldo_inicial = saldo_sombrio + saldo_fumaca
-    elif unidade_selecionada == "UNIDADE SOMBRIO":
-        saldo_inicial = saldo_sombrio
-    elif unidade_selecionada == "UNIDADE MORRO DA FUMAÇA":
-        saldo_inicial = saldo_fumaca
+        return np.arange(len(cube['units']))
+    posicoes = cube['units'].get_indexer([unidade_selecionada])
+    return posicoes[posicoes >= 0]
+
+# Função para converter um período em índices de dia do cubo (limitados ao intervalo do cubo)
+def _cube_day_bounds(cube, start_date, end_date):
+    inicio = min(max((pd.Timestamp(start_date) - cube['start']).days, 0), cube['days'])
+    fim = min(max((pd.Timestamp(end_date) - cube['start']).days + 1, 0), cube['days'])
+    return inicio, max(inicio, fim)
+
+# Função para obter a matriz dia x unidade (em centavos) de uma planilha no período, a partir do cubo
+# (dias fora do intervalo dos dados ficam zerados)
+def cube_daily_matrix(cube, ledger, coluna, start_date, end_date):
+    deslocamento = (pd.Timestamp(start_date) - cube['start']).days
+    matriz = np.zeros(((pd.Timestamp(end_date) - pd.Timestamp(start_date)).days + 1, len(cube['units'])))
+    datas = cube['ledgers'][ledger]['dates'].get(coluna)
+    if datas is None:
+        return matriz
+    inicio, fim = _cube_day_bounds(cube, start_date, end_date)
+    if inicio < fim:
+        matriz[inicio - deslocamento:fim - deslocamento] = datas['daily'][inicio:fim]
+    return matriz
+
+# Função para obter a série diária (em centavos) de uma planilha no período, a partir do cubo
+def cube_daily_centavos(cube, ledger, coluna, unidade_selecionada, start_date, end_date):
+    deslocamento = (pd.Timestamp(start_date) - cube['start']).days
+    serie = np.zeros((pd.Timestamp(end_date) - pd.Timestamp(start_date)).days + 1)
+    datas = cube['ledgers'][ledger]['dates'].get(coluna)
+    if datas is None:
+        return serie
+    inicio, fim = _cube_day_bounds(cube, start_date, end_date)
+    if inicio < fim:
+        serie[inicio - deslocamento:fim - deslocamento] = datas['daily'][inicio:fim][:, _cube_units(cube, unidade_selecionada)].sum(axis=1)
+    return serie
+
+# Função para obter os totais (em centavos) e a quantidade de lançamentos por unidade no período (somas acumuladas)
+def cube_period_totals(cube, ledger, coluna, start_date, end_date):
+    datas = cube['ledgers'][ledger]['dates'].get(coluna)
+    if datas is None:
+        n_unidades = len(cube['units'])
+        return np.zeros(n_unidades), np.zeros(n_unidades, dtype=np.int64)
+    inicio, fim = _cube_day_bounds(cube, start_date, end_date)
+    totais = datas['prefix'][fim] - datas['prefix'][inicio]
+    contagens = datas['prefix_counts'][fim] - datas['prefix_counts'][inicio]
+    return totais, contagens
+
+# Função para obter o total de uma planilha no período para a unidade selecionada
+def cube_period_total(cube, ledger, coluna, unidade_selecionada, start_date, end_date):
+    totais, _ = cube_period_totals(cube, ledger, coluna, start_date, end_date)
+    return totais[_cube_units(cube, unidade_selecionada)].sum() / 100
+
+# Função para obter as séries diárias (em centavos) de recebimentos e pagamentos de um regime, a partir do cubo
+def cube_daily_flows(cube, start_date, end_date, regime, unidade_selecionada):
+    if regime == 'Caixa':
+        coluna_data = 'Pagamento'
+    elif regime == 'Competência':
+        coluna_data = 'Data'
+    elif regime == 'Caixa Projetado':
+        coluna_data = 'Vencimento'
     else:
-        saldo_inicial = 0
+        report_message('error', "Regime inválido selecionado.")
+        return None
+
+    coluna_data_caixa = 'Vencimento' if regime == 'Caixa Projetado' else 'Data'
+    recebimentos = (
+        cube_daily_centavos(cube, 'receber', coluna_data, unidade_selecionada, start_date, end_date) +
+        cube_daily_centavos(cube, 'caixa', coluna_data_caixa, unidade_selecionada, start_date, end_date)
+    )
+    pagamentos = cube_daily_centavos(cube, 'pagar', coluna_data, unidade_selecionada, start_date, end_date)
+    return recebimentos, pagamentos
+
+# Função para calcular o fluxo de caixa a partir do cubo (mesmo resultado de calculate_cash_flow)
+@profiled
+def cube_cash_flow(cube, start_date, end_date, regime, saldos_iniciais, unidade_selecionada):
+    series = cube_daily_flows(cube, start_date, end_date, regime, unidade_selecionada)
+    if series is None:
+        return None
+    recebimentos, pagamentos = series
+    date_range = pd.date_range(start=start_date, end=end_date, freq='D')
+    saldo_inicial = initial_balance(unidade_selecionada, saldos_iniciais)
+    return cash_flow_from_centavos(date_range, recebimentos, pagamentos, saldo_inicial)
+
+# Função para consolidar o fluxo de caixa de todas as unidades de uma vez: as séries diárias de cada unidade saem
+# de matrizes dia x unidade do cubo e o saldo acumulado é uma única soma acumulada por coluna, em centavos.
+# Devolve {'Recebimentos', 'Pagamentos', 'Saldo', 'Saldo Acumulado'}, cada um um DataFrame dia x unidade com a
+# coluna "Todas as Unidades" (consolidado, com o saldo inicial do cadastro inteiro) ao final. Unidades do cadastro
+# sem lançamentos entram como colunas sem movimento, só com o saldo inicial.
+@profiled
+def cube_unit_cash_flows(cube, start_date, end_date, regime, saldos_iniciais):
+    if regime not in REGIME_COLUMNS:
+        report_message('error', "Regime inválido selecionado.")
+        return None
+    coluna_data = REGIME_COLUMNS[regime]
+    coluna_data_caixa = 'Vencimento' if regime == 'Caixa Projetado' else 'Data'
+    recebimentos = (
+        cube_daily_matrix(cube, 'receber', coluna_data, start_date, end_date) +
+        cube_daily_matrix(cube, 'caixa', coluna_data_caixa, start_date, end_date)
+    )
+    pagamentos = cube_daily_matrix(cube, 'pagar', coluna_data, start_date, end_date)
+
+    # Acrescentar as unidades sem lançamentos e a coluna do consolidado, somando em centavos inteiros
+    sem_lancamentos = [unidade for unidade in saldos_iniciais if unidade not in cube['units']]
+    vazias = np.zeros((len(recebimentos), len(sem_lancamentos)))
+    recebimentos = np.rint(np.column_stack([recebimentos, vazias, recebimentos.sum(axis=1)])).astype(np.int64)
+    pagamentos = np.rint(np.column_stack([pagamentos, vazias, pagamentos.sum(axis=1)])).astype(np.int64)
+    colunas = list(cube['units']) + sem_lancamentos + ["Todas as Unidades"]
+    saldos = np.array([int(round(initial_balance(unidade, saldos_iniciais) * 100)) for unidade in colunas], dtype=np.int64)
+    saldo = recebimentos - pagamentos
+    saldo_acumulado = np.cumsum(saldo, axis=0) + saldos
+
+    date_range = pd.date_range(start=start_date, end=end_date, freq='D')
+    return {
+        nome: pd.DataFrame(valores / 100, index=date_range, columns=colunas)
+        for nome, valores in [('Recebimentos', recebimentos), ('Pagamentos', pagamentos),
+                              ('Saldo', saldo), ('Saldo Acumulado', saldo_acumulado)]
+    }
+
+# Função para obter o fluxo de caixa de uma unidade a partir do fluxo consolidado (mesmas colunas de cube_cash_flow;
+# unidade desconhecida fica zerada)
+def unit_cash_flow(fluxos, unidade):
+    return pd.DataFrame({nome: fluxos[nome].get(unidade, 0.0) for nome in ['Recebimentos', 'Pagamentos', 'Saldo', 'Saldo Acumulado']},
+                        index=fluxos['Saldo'].index)
 
-    # Calcular o saldo acumulado
-    cash_flow['Saldo Acumulado'] = cash_flow['Saldo'].cumsum() + saldo_inicial
+# Função para obter os totais por conta analítica da unidade selecionada (todas as datas)
+def cube_account_totals(cube, ledger, unidade_selecionada):
+    entry = cube['ledgers'][ledger]
+    unidades = _cube_units(cube, unidade_selecionada)
+    totais = entry['account_totals'][unidades].sum(axis=0)
+    presentes = entry['account_counts'][unidades].sum(axis=0) > 0
+    return pd.DataFrame({
+        'Conta Analítica': entry['accounts'][presentes],
+        entry['value_column']: totais[presentes] / 100,
+    })
 
+# Função para obter a quantidade de lançamentos da unidade selecionada em uma planilha
+def cube_row_count(cube, ledger, unidade_selecionada):
+    return int(cube['ledgers'][ledger]['unit_counts'][_cube_units(cube, unidade_selecionada)].sum())
+
+# Função para obter o maior lançamento do período (conta analítica e valor), ou None se não houver
+def cube_largest(cube, ledger, coluna, unidade_selecionada, start_date, end_date):
+    entry = cube['ledgers'][ledger]
+    datas = entry['dates'].get(coluna)
+    if datas is None:
+        return None
+    inicio, fim = _cube_day_bounds(cube, start_date, end_date)
+    linhas = datas['max_row'][inicio:fim][:, _cube_units(cube, unidade_selecionada)].ravel()
+    linhas = linhas[linhas >= 0]
+    if len(linhas) == 0:
+        return None
+    valores = entry['values'][linhas]
+    # Entre valores iguais, vale a primeira linha da planilha (como em idxmax)
+    linha = linhas[valores == valores.max()].min()
+    codigo = entry['account_codes'][linha]
+    conta = entry['accounts'][codigo] if codigo >= 0 else np.nan
+    return conta, entry['values'][linha]
+
+# Função para obter os totais por unidade no período (Análise por Unidade)
+def cube_unit_totals(cube, coluna, start_date, end_date):
+    recebimentos, contagem_recebimentos = cube_period_totals(cube, 'receber', coluna, start_date, end_date)
+    pagamentos, contagem_pagamentos = cube_period_totals(cube, 'pagar', coluna, start_date, end_date)
+    presentes = (contagem_recebimentos > 0) | (contagem_pagamentos > 0)
+    return pd.DataFrame({
+        'Unidade': cube['units'][presentes],
+        'Recebimentos': recebimentos[presentes] / 100,
+        'Pagamentos': pagamentos[presentes] / 100,
+    })
+
+# Memória das etapas do dashboard (dados, cubo, fluxo de caixa, indicadores, totais por conta...). Cada etapa
+# guarda só o último resultado junto com as entradas de que depende, e é recalculada apenas quando alguma delas
+# muda: trocar o tipo de gráfico não refaz nenhuma etapa, e mudar o período não refaz os totais por conta.
+class StageMemo:
+    def __init__(self):
+        self._etapas = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Devolve o resultado guardado da etapa se as entradas forem as mesmas; senão calcula e guarda.
+    # Resultados None (falha ao carregar) não são guardados, para que o erro volte a aparecer.
+    def get(self, nome, entradas, calcular):
+        guardado = self._etapas.get(nome)
+        if guardado is not None and guardado[0] == entradas:
+            self.hits += 1
+            return guardado[1]
+        self.misses += 1
+        resultado = calcular()
+        if resultado is not None:
+            self._etapas[nome] = (entradas, resultado)
+        return resultado
+
+    # Devolve (entradas, resultado) guardados da etapa, ou None (para etapas que aproveitam o resultado anterior)
+    def peek(self, nome):
+        return self._etapas.get(nome)
+
+    def put(self, nome, entradas, resultado):
+        self._etapas[nome] = (entradas, resultado)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'stages': len(self._etapas)}
+
+# Função para obter a memória das etapas da sessão
+def get_stage_memo():
+    if 'stage_memo' not in st.session_state:
+        st.session_state['stage_memo'] = StageMemo()
+    return st.session_state['stage_memo']
+
+# Função para obter o cubo de agregados da sessão, montando-o apenas quando os dados mudam
+def get_aggregate_cube(chave, df_receivables, df_payables, df_cash_report):
+    return get_stage_memo().get('cubo', chave, lambda: shared_cached(
+        ('cubo', chave), lambda: build_aggregate_cube(df_receivables, df_payables, df_cash_report)))
+
+# Função para obter o fluxo de caixa da sessão de forma incremental. Se só a data final mudou, o fluxo guardado
+# é recortado (período menor) ou estendido: apenas os dias novos são calculados, e o saldo acumulado continua
+# do último saldo guardado. Qualquer outra mudança (dados, unidade, regime, saldos, data inicial) recalcula tudo.
+@profiled
+def incremental_cash_flow(memo, chave_dados, cube, start_date, end_date, regime, saldos_iniciais, unidade_selecionada):
+    entradas = (chave_dados, unidade_selecionada, regime, initial_balance(unidade_selecionada, saldos_iniciais), start_date)
+    guardado = memo.peek('fluxo_de_caixa')
+    if guardado is not None and guardado[0] == entradas and len(guardado[1]) > 0:
+        cash_flow = guardado[1]
+        fim_guardado = cash_flow.index[-1]
+        if end_date <= fim_guardado:
+            memo.hits += 1
+            return cash_flow.loc[:end_date]
+        memo.misses += 1
+        inicio_novo = fim_guardado + pd.Timedelta(days=1)
+        recebimentos, pagamentos = cube_daily_flows(cube, inicio_novo, end_date, regime, unidade_selecionada)
+        novos_dias = cash_flow_from_centavos(pd.date_range(start=inicio_novo, end=end_date, freq='D'),
+                                             recebimentos, pagamentos, cash_flow['Saldo Acumulado'].iloc[-1])
+        cash_flow = pd.concat([cash_flow, novos_dias])
+    else:
+        memo.misses += 1
+        cash_flow = cube_cash_flow(cube, start_date, end_date, regime, saldos_iniciais, unidade_selecionada)
+        if cash_flow is None:
+            return None
+    memo.put('fluxo_de_caixa', entradas, cash_flow)
     return cash_flow
 
-# Função para gerar relatório em PDF
-def generate_pdf(cash_flow, recebimentos_por_conta, pagamentos_por_conta, unidade_selecionada, regime):
-    pdf = FPDF()
+# Coluna de data usada por cada regime nas contas a receber e a pagar
+REGIME_COLUMNS = {'Caixa': 'Pagamento', 'Competência': 'Data', 'Caixa Projetado': 'Vencimento'}
+
+# Função para calcular os indicadores financeiros do período a partir do cubo (sem Streamlit).
+# maior_recebimento e maior_pagamento são (conta, valor), ou None se não houver lançamento no período.
+@profiled
+def compute_indicators(cube, unidade_selecionada, regime, start_date, end_date):
+    coluna_regime = REGIME_COLUMNS[regime]
+    # No regime "Caixa Projetado" o Relatório Caixa entra pelo vencimento, como no fluxo de caixa
+    coluna_data_caixa = 'Vencimento' if regime == 'Caixa Projetado' else 'Data'
+    total_recebimentos = (
+        cube_period_total(cube, 'receber', coluna_regime, unidade_selecionada, start_date, end_date) +
+        cube_period_total(cube, 'caixa', coluna_data_caixa, unidade_selecionada, start_date, end_date)
+    )
+    total_pagamentos = cube_period_total(cube, 'pagar', coluna_regime, unidade_selecionada, start_date, end_date)
+    dias_periodo = (end_date - start_date).days + 1
+    return {
+        'total_recebimentos': total_recebimentos,
+        'total_pagamentos': total_pagamentos,
+        'saldo_liquido': total_recebimentos - total_pagamentos,
+        'media_recebimentos': total_recebimentos / dias_periodo,
+        'media_pagamentos': total_pagamentos / dias_periodo,
+        'lancamentos_recebimentos': cube_row_count(cube, 'receber', unidade_selecionada),
+        'lancamentos_pagamentos': cube_row_count(cube, 'pagar', unidade_selecionada),
+        'maior_recebimento': cube_largest(cube, 'receber', coluna_regime, unidade_selecionada, start_date, end_date),
+        'maior_pagamento': cube_largest(cube, 'pagar', coluna_regime, unidade_selecionada, start_date, end_date),
+    }
+
+# Função para calcular tudo o que entra nos relatórios de uma unidade, regime e período (sem Streamlit)
+def compute_report(cube, unidade_selecionada, regime, start_date, end_date, saldos_iniciais):
+    return {
+        'cash_flow': cube_cash_flow(cube, start_date, end_date, regime, saldos_iniciais, unidade_selecionada),
+        'recebimentos_por_conta': cube_account_totals(cube, 'receber', unidade_selecionada),
+        'pagamentos_por_conta': cube_account_totals(cube, 'pagar', unidade_selecionada),
+        'indicadores': compute_indicators(cube, unidade_selecionada, regime, start_date, end_date),
+    }
+
+# Função para montar o índice de detalhamento por dia: para cada planilha e coluna de data, as posições das linhas
+# ordenadas por data (todas as unidades) e por unidade e data, com as datas ordenadas (int64, em nanossegundos) e
+# o início do bloco de cada unidade. As consultas de um dia ou período são feitas com searchsorted sobre esse índice.
+@profiled
+def build_drilldown_index(df_receivables, df_payables, df_cash_report):
+    frames = {'receber': df_receivables, 'pagar': df_payables, 'caixa': df_cash_report}
+    unidades = pd.Index(sorted(set().union(*(map(str, df['Unidade'].unique()) for df in frames.values()))))
+    indice = {'units': unidades, 'ledgers': {}}
+
+    for ledger, df in frames.items():
+        cod_unidade = _index_codes(unidades, df['Unidade'])
+        entry = {'centavos': ledger_centavos(df, CUBE_LEDGERS[ledger]), 'dates': {}}
+        for coluna in STORE_DATE_COLUMNS:
+            if coluna not in df.columns or not pd.api.types.is_datetime64_any_dtype(df[coluna]):
+                continue
+            datas = df[coluna].to_numpy(dtype='datetime64[ns]').view(np.int64)
+            # Linhas sem data (NaT) ficam fora do índice
+            linhas = np.flatnonzero((datas != np.iinfo(np.int64).min) & (cod_unidade >= 0))
+            por_data = linhas[np.argsort(datas[linhas], kind='stable')]
+            por_unidade = linhas[np.lexsort((datas[linhas], cod_unidade[linhas]))]
+            entry['dates'][coluna] = {
+                'order': por_data,
+                'keys': datas[por_data],
+                'unit_order': por_unidade,
+                'unit_keys': datas[por_unidade],
+                'unit_offsets': np.searchsorted(cod_unidade[por_unidade], np.arange(len(unidades) + 1)),
+            }
+        indice['ledgers'][ledger] = entry
+    return indice
+
+# Função para obter as posições (no DataFrame da planilha) das linhas de uma unidade com a coluna de data no
+# período [start_date, end_date], em ordem de data
+def drilldown_positions(indice, ledger, coluna, unidade_selecionada, start_date, end_date):
+    datas = indice['ledgers'][ledger]['dates'].get(coluna)
+    if datas is None:
+        return np.empty(0, dtype=np.int64)
+    if unidade_selecionada == "Todas as Unidades":
+        ordem, chaves, inicio, fim = datas['order'], datas['keys'], 0, len(datas['keys'])
+    else:
+        posicao = indice['units'].get_indexer([unidade_selecionada])[0]
+        if posicao < 0:
+            return np.empty(0, dtype=np.int64)
+        ordem, chaves = datas['unit_order'], datas['unit_keys']
+        inicio, fim = datas['unit_offsets'][posicao], datas['unit_offsets'][posicao + 1]
+    # Período até o fim do dia final
+    limites = np.array([pd.Timestamp(start_date).normalize().value,
+                        (pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)).value], dtype=np.int64)
+    primeira, ultima = inicio + np.searchsorted(chaves[inicio:fim], limites, side='left')
+    return ordem[primeira:ultima]
+
+# Função para detalhar os lançamentos que formam o fluxo de caixa de um dia ou período: devolve {'Recebimentos',
+# 'Pagamentos', 'Relatório Caixa'}, cada um com as linhas da planilha em ordem decrescente de valor (só as top_n
+# maiores, se informado). As colunas de data seguem o regime, como no fluxo de caixa.
+@profiled
+def drilldown_titles(indice, df_receivables, df_payables, df_cash_report, regime, unidade_selecionada,
+                     start_date, end_date, top_n=None):
+    coluna_regime = REGIME_COLUMNS[regime]
+    coluna_data_caixa = 'Vencimento' if regime == 'Caixa Projetado' else 'Data'
+    consultas = [
+        ('Recebimentos', 'receber', df_receivables, coluna_regime, 'Recebimentos'),
+        ('Pagamentos', 'pagar', df_payables, coluna_regime, 'Pagamentos'),
+        ('Relatório Caixa', 'caixa', df_cash_report, coluna_data_caixa, 'Entrada'),
+    ]
+    detalhes = {}
+    for nome, ledger, df, coluna, coluna_valor in consultas:
+        posicoes = drilldown_positions(indice, ledger, coluna, unidade_selecionada, start_date, end_date)
+        valores = indice['ledgers'][ledger]['centavos'][posicoes]
+        # Maiores valores primeiro; com top_n, só as top_n maiores são ordenadas
+        if top_n is not None and top_n < len(posicoes):
+            maiores = np.argpartition(-valores, top_n - 1)[:top_n]
+            posicoes, valores = posicoes[maiores], valores[maiores]
+        posicoes = posicoes[np.argsort(-valores, kind='stable')]
+        detalhes[nome] = ledger_display_frame(df.iloc[posicoes], coluna_valor)
+    return detalhes
+
+# Métodos de estimativa da projeção de caixa: média dos últimos meses quitados ou o mesmo mês do ano anterior
+FORECAST_METHODS = {
+    'Média móvel': "média dos últimos meses quitados",
+    'Sazonal ingênuo': "mesmo mês do ano anterior",
+}
+
+# Meses de histórico quitado usados na projeção, meses da média móvel e atraso máximo considerado (meses)
+FORECAST_HISTORY_MONTHS = 24
+FORECAST_WINDOW_MONTHS = 3
+FORECAST_MAX_DELAY_MONTHS = 3
+
+# Horizonte da projeção (meses)
+FORECAST_HORIZONS = (12, 24)
+
+# Função para converter datas em meses contados a partir do mês inicial; devolve os meses e a máscara de datas válidas
+def _month_offsets(datas, mes_inicial):
+    meses = datas.to_numpy(dtype='datetime64[ns]').astype('datetime64[M]')
+    validas = ~np.isnat(meses)
+    return (meses - np.datetime64(mes_inicial, 'M')).astype(np.int64), validas
+
+# Função para somar valores em uma grade mês × unidade × conta analítica (meses fora da grade são ignorados)
+def _month_grid(meses, cod_unidade, cod_conta, valores, mascara, forma):
+    n_meses, n_unidades, n_contas = forma
+    mascara = mascara & (meses >= 0) & (meses < n_meses) & (cod_unidade >= 0)
+    celula = (meses[mascara] * n_unidades + cod_unidade[mascara]) * n_contas + cod_conta[mascara]
+    somas = np.bincount(celula, weights=valores[mascara], minlength=n_meses * n_unidades * n_contas)
+    # Sem lançamentos na grade o bincount devolve inteiros
+    return np.asarray(somas, dtype=float).reshape(forma)
+
+# Função para estimar os próximos meses a partir do histórico (meses × unidades × contas, do mais antigo ao mais
+# recente): média dos últimos 'janela' meses, ou o mesmo mês do ano anterior (sazonal ingênuo)
+def _estimate_months(historico, metodo, n_meses, janela=FORECAST_WINDOW_MONTHS):
+    if metodo == 'Média móvel':
+        return np.broadcast_to(historico[-janela:].mean(axis=0), (n_meses,) + historico.shape[1:])
+    return historico[len(historico) - 12 + np.arange(n_meses) % 12]
+
+# Função para estimar, por unidade, a distribuição do atraso (em meses, de 0 a FORECAST_MAX_DELAY_MONTHS) entre o
+# vencimento e o pagamento dos títulos quitados. Unidades sem histórico usam a distribuição de todas as unidades.
+def delay_curves(atrasos, cod_unidade, n_unidades, mascara):
+    faixas = FORECAST_MAX_DELAY_MONTHS + 1
+    atrasos = np.clip(atrasos[mascara], 0, FORECAST_MAX_DELAY_MONTHS)
+    contagens = np.bincount(cod_unidade[mascara] * faixas + atrasos, minlength=n_unidades * faixas)
+    contagens = contagens.reshape(n_unidades, faixas).astype(float)
+    geral = contagens.sum(axis=0)
+    geral = geral / geral.sum() if geral.sum() > 0 else np.eye(faixas)[0]
+    totais = contagens.sum(axis=1, keepdims=True)
+    return np.where(totais > 0, contagens / np.maximum(totais, 1), geral)
+
+# Função com as curvas de atraso de cada cenário. Otimista: recebimentos no vencimento e pagamentos com o atraso
+# histórico; base: os dois com o atraso histórico; pessimista: recebimentos com um mês a mais de atraso que o
+# histórico e pagamentos no vencimento.
+def _scenario_curves(ledger, curvas):
+    em_dia = np.zeros_like(curvas)
+    em_dia[:, 0] = 1
+    atrasadas = np.zeros_like(curvas)
+    atrasadas[:, 1:] = curvas[:, :-1]
+    atrasadas[:, -1] += curvas[:, -1]
+    if ledger == 'receber':
+        return {'Otimista': em_dia, 'Base': curvas, 'Pessimista': atrasadas}
+    return {'Otimista': curvas, 'Base': curvas, 'Pessimista': em_dia}
+
+# Função para aplicar curvas de atraso (unidade × meses de atraso) a uma grade mês × unidade × conta, para todas as
+# unidades de uma vez (valores que passariam do horizonte ficam de fora)
+def _apply_delays(grade, curvas):
+    saida = np.zeros_like(grade)
+    for atraso in range(curvas.shape[1]):
+        saida[atraso:] += curvas[:, atraso][None, :, None] * grade[:len(grade) - atraso]
+    return saida
+
+# Função para projetar o caixa mês a mês de todas as unidades. Para cada unidade e conta analítica, o valor de um
+# mês é o maior entre os títulos em aberto que devem ser quitados no mês (vencimento deslocado pelas curvas de
+# atraso do cenário) e a estimativa feita a partir do histórico quitado (coluna 'Pagamento'; no Relatório Caixa,
+# 'Data'), que cobre os fluxos recorrentes ainda sem título. Devolve {cenário: {'Recebimentos', 'Pagamentos',
+# 'Saldo Acumulado'}}, cada um um DataFrame mês × unidade com a coluna "Todas as Unidades" ao final.
+@profiled
+def forecast_cash_flow(df_receivables, df_payables, df_cash_report, start_date, meses, metodo, saldos_iniciais):
+    mes_inicial = pd.Timestamp(start_date).to_period('M').to_timestamp()
+    frames = {'receber': df_receivables, 'pagar': df_payables, 'caixa': df_cash_report}
+    unidades = pd.Index(sorted(set().union(*(map(str, df['Unidade'].unique()) for df in frames.values()))))
+    sem_lancamentos = [unidade for unidade in saldos_iniciais if unidade not in unidades]
+    n_unidades = len(unidades)
+    historico_meses = FORECAST_HISTORY_MONTHS
+
+    fluxos = {'receber': {}, 'pagar': {}}
+    estimativa_caixa = np.zeros((meses, n_unidades))
+    for ledger, df in frames.items():
+        cod_unidade = _index_codes(unidades, df['Unidade'])
+        cod_conta, contas = pd.factorize(df['Conta Analítica'])
+        # Lançamentos sem conta analítica ficam em uma conta à parte
+        cod_conta = np.where(cod_conta >= 0, cod_conta, len(contas))
+        forma = (meses, n_unidades, len(contas) + 1)
+        centavos = ledger_centavos(df, CUBE_LEDGERS[ledger]).astype(float)
+
+        # Histórico quitado dos últimos meses antes do mês inicial
+        pagamento, pagos = _month_offsets(df['Data' if ledger == 'caixa' else 'Pagamento'], mes_inicial)
+        historico = _month_grid(pagamento + historico_meses, cod_unidade, cod_conta, centavos, pagos,
+                                (historico_meses,) + forma[1:])
+        estimativa = _estimate_months(historico, metodo, meses)
+        if ledger == 'caixa':
+            estimativa_caixa = estimativa.sum(axis=2)
+            continue
+
+        # Títulos em aberto pelo mês de vencimento (os já vencidos entram no mês inicial)
+        vencimento, com_vencimento = _month_offsets(df['Vencimento'], mes_inicial)
+        abertos = _month_grid(np.maximum(vencimento, 0), cod_unidade, cod_conta, centavos, com_vencimento & ~pagos, forma)
+        recentes = com_vencimento & pagos & (pagamento >= -historico_meses) & (pagamento < 0)
+        curvas = delay_curves(pagamento - vencimento, cod_unidade, n_unidades, recentes)
+        for cenario, curva in _scenario_curves(ledger, curvas).items():
+            fluxos[ledger][cenario] = np.maximum(_apply_delays(abertos, curva), estimativa).sum(axis=2)
+
+    # Consolidação: unidades do cadastro sem lançamentos e a coluna "Todas as Unidades"; saldo em centavos
+    colunas = list(unidades) + sem_lancamentos + ["Todas as Unidades"]
+    saldos = np.array([round(initial_balance(unidade, saldos_iniciais) * 100) for unidade in colunas], dtype=float)
+    indice = pd.date_range(mes_inicial, periods=meses, freq='MS')
+    vazias = np.zeros((meses, len(sem_lancamentos)))
+    projecao = {}
+    for cenario in fluxos['receber']:
+        recebimentos = np.rint(fluxos['receber'][cenario] + estimativa_caixa)
+        pagamentos = np.rint(fluxos['pagar'][cenario])
+        recebimentos = np.column_stack([recebimentos, vazias, recebimentos.sum(axis=1)])
+        pagamentos = np.column_stack([pagamentos, vazias, pagamentos.sum(axis=1)])
+        saldo_acumulado = np.cumsum(recebimentos - pagamentos, axis=0) + saldos
+        projecao[cenario] = {
+            nome: pd.DataFrame(valores / 100, index=indice, columns=colunas)
+            for nome, valores in [('Recebimentos', recebimentos), ('Pagamentos', pagamentos),
+                                  ('Saldo Acumulado', saldo_acumulado)]
+        }
+    return projecao
+
+# Função para obter a projeção de uma unidade: recebimentos e pagamentos do cenário base e o saldo acumulado de
+# cada cenário (unidade desconhecida fica zerada)
+def unit_forecast(projecao, unidade):
+    base = projecao['Base']
+    tabela = pd.DataFrame({nome: base[nome].get(unidade, 0.0) for nome in ['Recebimentos', 'Pagamentos']},
+                          index=base['Saldo Acumulado'].index)
+    for cenario, valores in projecao.items():
+        tabela[f"Saldo {cenario}"] = valores['Saldo Acumulado'].get(unidade, 0.0)
+    return tabela
+
+# Função para montar o gráfico da projeção: saldo do cenário base com a faixa entre o pessimista e o otimista
+@profiled
+def build_forecast_figure(tabela, unidade_selecionada, metodo):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=tabela.index, y=tabela['Saldo Pessimista'], name="Pessimista", mode='lines',
+                             line=dict(width=0.5, color='firebrick')))
+    fig.add_trace(go.Scatter(x=tabela.index, y=tabela['Saldo Otimista'], name="Otimista", mode='lines',
+                             line=dict(width=0.5, color='seagreen'), fill='tonexty',
+                             fillcolor='rgba(100, 149, 237, 0.2)'))
+    fig.add_trace(go.Scatter(x=tabela.index, y=tabela['Saldo Base'], name="Base", mode='lines+markers',
+                             line=dict(color='royalblue')))
+    fig.update_layout(title=f"Projeção do Saldo ({metodo}) - Unidade: {unidade_selecionada}",
+                      xaxis_title="Mês", yaxis_title="Valor (R$)")
+    return fig
+
+# Resumos da tabela do relatório em PDF: período do pandas para agrupar os dias (None = um dia por linha),
+# cabeçalho da primeira coluna e formato da data
+PDF_SUMMARIES = {
+    'Diário': (None, 'Data', '%d/%m/%Y'),
+    'Semanal': ('W', 'Semana (início)', '%d/%m/%Y'),
+    'Mensal': ('M', 'Mês', '%m/%Y'),
+}
+
+# Layout da tabela do relatório em PDF (mm)
+PDF_ROW_HEIGHT = 7
+PDF_COLUMN_WIDTH = 40
+PDF_FOOTER_SPACE = 20
+PDF_TABLE_COLUMNS = ['Recebimentos', 'Pagamentos', 'Saldo Acumulado']
+
+# Função para resumir o fluxo de caixa diário por semana ou mês: soma recebimentos, pagamentos e saldo,
+# e mantém o saldo acumulado do último dia. Cada linha recebe a data do seu primeiro dia no período
+# (rotulo='inicio') ou do último (rotulo='fim').
+def summarize_cash_flow(cash_flow, freq, rotulo='inicio'):
+    periodos = cash_flow.index.to_period(freq)
+    agrupado = cash_flow.groupby(periodos)
+    resumo = agrupado[['Recebimentos', 'Pagamentos', 'Saldo']].sum()
+    resumo['Saldo Acumulado'] = agrupado['Saldo Acumulado'].last()
+    datas = pd.Series(cash_flow.index).groupby(periodos)
+    resumo.index = pd.DatetimeIndex((datas.first() if rotulo == 'inicio' else datas.last()).to_numpy())
+    return resumo
+
+# PDF dos relatórios, com o título repetido no topo e o número da página no rodapé de cada página
+class ReportPDF(FPDF):
+    def __init__(self, titulo):
+        super().__init__()
+        self.titulo = titulo
+
+    def header(self):
+        self.set_font("helvetica", size=12)
+        self.cell(0, 10, txt=self.titulo, ln=True, align="C")
+        self.set_font("helvetica", size=10)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font("helvetica", size=8)
+        self.cell(0, 10, txt=f"Página {self.page_no()}/{{nb}}", align="C")
+        self.set_font("helvetica", size=10)
+
+# Função usada como progresso padrão dos relatórios (gerados fora de uma tarefa em segundo plano)
+def _ignore_progress(progresso, etapa=None):
+    pass
+
+# Função para desenhar uma tabela de textos já formatados, quebrando em páginas e repetindo o cabeçalho.
+# Cada página é desenhada em bloco (textos e depois as linhas da grade), sem uma célula com borda por valor.
+# progresso recebe a fração das linhas já desenhadas.
+def _pdf_table(pdf, cabecalho, linhas, progresso=_ignore_progress):
+    inicio = 0
+    while True:
+        x, y = pdf.l_margin, pdf.get_y()
+        capacidade = max(1, int((pdf.h - PDF_FOOTER_SPACE - y) // PDF_ROW_HEIGHT) - 1)
+        bloco = [cabecalho] + linhas[inicio:inicio + capacidade]
+        for i, linha in enumerate(bloco):
+            base = y + i * PDF_ROW_HEIGHT + PDF_ROW_HEIGHT * 0.65
+            for j, texto in enumerate(linha):
+                pdf.text(x + j * PDF_COLUMN_WIDTH + pdf.c_margin, base, texto)
+
+        largura = len(cabecalho) * PDF_COLUMN_WIDTH
+        altura = len(bloco) * PDF_ROW_HEIGHT
+        for i in range(len(bloco) + 1):
+            pdf.line(x, y + i * PDF_ROW_HEIGHT, x + largura, y + i * PDF_ROW_HEIGHT)
+        for j in range(len(cabecalho) + 1):
+            pdf.line(x + j * PDF_COLUMN_WIDTH, y, x + j * PDF_COLUMN_WIDTH, y + altura)
+        pdf.set_y(y + altura)
+
+        inicio += capacidade
+        progresso(min(inicio, len(linhas)) / max(len(linhas), 1), f"Página {pdf.page_no()}")
+        if inicio >= len(linhas):
+            break
+        pdf.add_page()
+
+# Função para gerar relatório em PDF. resumo é uma das chaves de PDF_SUMMARIES (tabela diária, semanal ou mensal).
+@profiled
+def generate_pdf(cash_flow, recebimentos_por_conta, pagamentos_por_conta, unidade_selecionada, regime, resumo='Diário',
+                 progresso=_ignore_progress):
+    progresso(0.0, "Formatando a tabela")
+    freq, coluna_data, formato_data = PDF_SUMMARIES[resumo]
+    tabela = cash_flow if freq is None else summarize_cash_flow(cash_flow, freq)
+
+    # Formatar todas as linhas de uma vez, antes de desenhar
+    colunas = [tabela.index.strftime(formato_data)] + [
+        pd.Series(tabela[coluna].to_numpy()).map('R$ {:,.2f}'.format) for coluna in PDF_TABLE_COLUMNS
+    ]
+    linhas = list(zip(*colunas))
+
+    pdf = ReportPDF(f"Relatório Financeiro - Unidade: {unidade_selecionada} - Regime: {regime}")
+    pdf.set_auto_page_break(False)
     pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    
-    # Título do Relatório
-    pdf.cell(200, 10, txt=f"Relatório Financeiro - Unidade: {unidade_selecionada} - Regime: {regime}", ln=True, align="C")
-    pdf.ln(10)
-    
-    # Adicionar tabela de fluxo de caixa
-    pdf.set_font("Arial", size=10)
-    pdf.cell(200, 10, txt="Fluxo de Caixa Diário", ln=True)
     pdf.ln(5)
-    
-    # Cabeçalho da tabela
-    pdf.cell(40, 10, txt="Data", border=1)
-    pdf.cell(40, 10, txt="Recebimentos", border=1)
-    pdf.cell(40, 10, txt="Pagamentos", border=1)
-    pdf.cell(40, 10, txt="Saldo Acumulado", border=1)
-    pdf.ln()
-    
-    # Dados da tabela
-    for index, row in cash_flow.iterrows():
-        pdf.cell(40, 10, txt=index.strftime('%d/%m/%Y'), border=1)
-        pdf.cell(40, 10, txt=f"R$ {row['Recebimentos']:,.2f}", border=1)
-        pdf.cell(40, 10, txt=f"R$ {row['Pagamentos']:,.2f}", border=1)
-        pdf.cell(40, 10, txt=f"R$ {row['Saldo Acumulado']:,.2f}", border=1)
-        pdf.ln()
-    
-    # Adicionar gráficos de recebimentos e pagamentos por conta analítica
+
+    # Adicionar tabela de fluxo de caixa
+    pdf.cell(200, 10, txt=f"Fluxo de Caixa {resumo}", ln=True)
+    # A tabela do fluxo de caixa é quase todo o trabalho: vai de 10% a 90% do progresso
+    _pdf_table(pdf, [coluna_data] + PDF_TABLE_COLUMNS, linhas,
+               lambda fracao, etapa=None: progresso(0.1 + 0.8 * fracao, etapa))
+    progresso(0.9, "Contas analíticas")
+
+    # Adicionar recebimentos e pagamentos por conta analítica (quebra de página automática)
+    pdf.set_auto_page_break(True, margin=PDF_FOOTER_SPACE)
     pdf.ln(10)
     pdf.cell(200, 10, txt="Recebimentos por Conta Analítica", ln=True)
     pdf.ln(5)
-    
-    for index, row in recebimentos_por_conta.iterrows():
-        pdf.cell(100, 10, txt=f"{row['Conta Analítica']}: R$ {row['Recebimentos']:,.2f}", ln=True)
-    
+
+    for conta, valor in zip(recebimentos_por_conta['Conta Analítica'], recebimentos_por_conta['Recebimentos']):
+        pdf.cell(100, 10, txt=f"{conta}: R$ {valor:,.2f}", ln=True)
+
     pdf.ln(10)
     pdf.cell(200, 10, txt="Pagamentos por Conta Analítica", ln=True)
     pdf.ln(5)
-    
-    for index, row in pagamentos_por_conta.iterrows():
-        pdf.cell(100, 10, txt=f"{row['Conta Analítica']}: R$ {row['Pagamentos']:,.2f}", ln=True)
-    
+
+    for conta, valor in zip(pagamentos_por_conta['Conta Analítica'], pagamentos_por_conta['Pagamentos']):
+        pdf.cell(100, 10, txt=f"{conta}: R$ {valor:,.2f}", ln=True)
+
     # Salvar o PDF
     pdf_output = pdf.output(dest='S')  # Retorna um bytearray
     return pdf_output
 
-# Função para criar um link de download
-def create_download_link(val, filename, file_type):
-    b64 = base64.b64encode(val)
-    return f'<a href="data:application/{file_type};base64,{b64.decode()}" download="{filename}">Baixar {filename}</a>'
+# Função para gerar, em paralelo, o relatório em PDF de cada unidade (um regime e período) e juntá-los em um .zip.
+# Os dados dos relatórios saem do cubo aqui; só os PDFs são montados nos processos (o fpdf não libera o GIL).
+@profiled
+def generate_unit_pdfs(cube, unidades, regime, start_date, end_date, saldos_iniciais, resumo='Diário',
+                       progresso=_ignore_progress, workers=None):
+    workers = REPORT_WORKERS if workers is None else workers
+    fluxos = cube_unit_cash_flows(cube, start_date, end_date, regime, saldos_iniciais)
+    argumentos = {
+        unidade: (unit_cash_flow(fluxos, unidade), cube_account_totals(cube, 'receber', unidade),
+                  cube_account_totals(cube, 'pagar', unidade), unidade, regime)
+        for unidade in unidades
+    }
+
+    pdfs = {}
+    progresso(0.0, f"0 de {len(argumentos)} unidades")
+    if workers <= 1 or len(argumentos) <= 1:
+        for unidade, args in argumentos.items():
+            pdfs[unidade] = generate_pdf(*args, resumo=resumo)
+            progresso(len(pdfs) / len(argumentos), f"{len(pdfs)} de {len(argumentos)} unidades")
+    else:
+        modulo = _importable_module()
+        pool = modulo.get_process_pool(workers)
+        tarefas = {pool.submit(modulo.generate_pdf, *args, resumo=resumo): unidade for unidade, args in argumentos.items()}
+        try:
+            for tarefa in as_completed(tarefas):
+                pdfs[tarefas[tarefa]] = tarefa.result()
+                progresso(len(pdfs) / len(argumentos), f"{len(pdfs)} de {len(argumentos)} unidades")
+        except BrokenProcessPool:
+            # Um processo morreu: o pool é descartado e recriado no próximo uso
+            modulo._process_pools.pop(workers, None)
+            raise
+
+    # Um PDF por unidade no .zip, na ordem pedida
+    saida = io.BytesIO()
+    with zipfile.ZipFile(saida, 'w', zipfile.ZIP_DEFLATED) as arquivo_zip:
+        for unidade in argumentos:
+            arquivo_zip.writestr(f"relatorio_{_batch_path_part(unidade)}.pdf", bytes(pdfs[unidade]))
+    return saida.getvalue()
+
+# Tempo (s) que o dashboard espera um relatório antes de deixá-lo terminando em segundo plano
+REPORT_WAIT_SECONDS = 1
+
+# Threads que geram os relatórios em segundo plano, relatórios prontos guardados entre as sessões e relatórios
+# listados em cada sessão
+REPORT_WORKERS = int(os.environ.get('FLUXO_REPORT_WORKERS', str(min(4, os.cpu_count() or 1))))
+REPORT_CACHE_SIZE = 32
+REPORT_SESSION_ITEMS = 5
+
+# Executor dos relatórios em segundo plano, reaproveitado entre as execuções do script
+_report_executor = None
+
+# Função para obter (ou criar) o executor dos relatórios em segundo plano
+def get_report_executor():
+    global _report_executor
+    if _report_executor is None:
+        _report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='relatorios')
+    return _report_executor
+
+# Tarefa de relatório: o Future com o resultado (bytes, ou o caminho de um arquivo temporário), o nome e o tipo do
+# arquivo baixado, e o progresso (0 a 1) e a etapa atual, atualizados pela função do relatório através de update
+class ReportJob:
+    def __init__(self, rotulo, nome_arquivo, mime):
+        self.rotulo = rotulo
+        self.nome_arquivo = nome_arquivo
+        self.mime = mime
+        self.future = Future()
+        self.progresso = 0.0
+        self.etapa = "Na fila"
+        self.inicio = time.time()
+        self.fim = None
+
+    def update(self, progresso, etapa=None):
+        self.progresso = min(max(float(progresso), 0.0), 1.0)
+        if etapa is not None:
+            self.etapa = etapa
+
+    def run(self, func, args, kwargs):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        self.update(0.0, "Gerando")
+        try:
+            resultado = func(*args, progresso=self.update, **kwargs)
+        except Exception as e:
+            self.fim = time.time()
+            self.future.set_exception(e)
+        else:
+            self.fim = time.time()
+            self.update(1.0, "Pronto")
+            self.future.set_result(resultado)
+
+    def failed(self):
+        return self.future.done() and self.future.exception() is not None
+
+    # Remove o arquivo temporário de um relatório pronto
+    def discard(self):
+        if self.future.done() and not self.failed():
+            resultado = self.future.result()
+            if isinstance(resultado, str) and os.path.exists(resultado):
+                os.remove(resultado)
+
+# Relatórios em segundo plano, compartilhados entre as sessões. Cada relatório é identificado por uma chave com
+# os dados (hash das planilhas), a unidade, o regime, o período e as opções: pedidos com a mesma chave recebem a
+# mesma tarefa, em andamento ou pronta, e tarefas com erro são refeitas. Acima de max_itens os relatórios prontos
+# usados há mais tempo são descartados (e os seus arquivos temporários removidos).
+class ReportJobs:
+    def __init__(self, max_itens=REPORT_CACHE_SIZE):
+        self.max_itens = max_itens
+        self.tarefas = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, chave, rotulo, nome_arquivo, mime, func, *args, background=True, **kwargs):
+        with self.lock:
+            tarefa = self.tarefas.get(chave)
+            if tarefa is not None and not tarefa.failed():
+                self.tarefas.move_to_end(chave)
+                return tarefa
+            tarefa = ReportJob(rotulo, nome_arquivo, mime)
+            self.tarefas[chave] = tarefa
+            self.tarefas.move_to_end(chave)
+            prontas = [c for c, t in self.tarefas.items() if t.future.done()]
+            while len(self.tarefas) > self.max_itens and prontas:
+                self.tarefas.pop(prontas.pop(0)).discard()
+        if background:
+            _importable_module().get_report_executor().submit(tarefa.run, func, args, kwargs)
+        else:
+            tarefa.run(func, args, kwargs)
+        return tarefa
+
+    def get(self, chave):
+        with self.lock:
+            return self.tarefas.get(chave)
+
+    def stats(self):
+        with self.lock:
+            tarefas = list(self.tarefas.values())
+        return {
+            'prontos': sum(t.future.done() and not t.failed() for t in tarefas),
+            'em_andamento': sum(not t.future.done() for t in tarefas),
+        }
+
+# Relatórios em segundo plano do servidor (um por processo)
+_report_jobs = None
+
+# Função para obter (ou criar) os relatórios em segundo plano do servidor
+def get_report_jobs():
+    global _report_jobs
+    if _report_jobs is None:
+        _report_jobs = ReportJobs()
+    return _report_jobs
+
+# Função para pedir um relatório em segundo plano, sem travar o dashboard; devolve a ReportJob. A função do
+# relatório recebe o parâmetro progresso. Com background=False o relatório é gerado na própria execução.
+def submit_report(chave, rotulo, nome_arquivo, mime, func, *args, background=True, **kwargs):
+    return _importable_module().get_report_jobs().submit(chave, rotulo, nome_arquivo, mime, func, *args,
+                                                         background=background, **kwargs)
+
+# Função para pedir um relatório pelo dashboard: a chave entra no topo da lista de relatórios da sessão e o
+# dashboard espera um pouco, para relatórios curtos já aparecerem prontos nesta mesma execução
+def request_report(chave, rotulo, nome_arquivo, mime, func, *args, background=True, **kwargs):
+    tarefa = submit_report(chave, rotulo, nome_arquivo, mime, func, *args, background=background, **kwargs)
+    relatorios = st.session_state.setdefault('report_jobs', [])
+    if chave in relatorios:
+        relatorios.remove(chave)
+    relatorios.insert(0, chave)
+    del relatorios[REPORT_SESSION_ITEMS:]
+    wait([tarefa.future], timeout=REPORT_WAIT_SECONDS)
+    return tarefa
+
+# Função para exibir os relatórios pedidos na sessão: progresso dos que estão sendo gerados, erros e os botões
+# de download dos prontos
+def show_report_jobs():
+    relatorios = st.session_state.get('report_jobs', [])
+    jobs = _importable_module().get_report_jobs()
+    em_andamento = False
+    for posicao, chave in enumerate(list(relatorios)):
+        tarefa = jobs.get(chave)
+        if tarefa is None:
+            # Relatório descartado do cache do servidor: precisa ser pedido de novo
+            relatorios.remove(chave)
+            continue
+        if not tarefa.future.done():
+            em_andamento = True
+            st.progress(tarefa.progresso, text=f"{tarefa.rotulo}: {tarefa.etapa} ({tarefa.progresso:.0%})")
+        elif tarefa.failed():
+            st.error(f"Erro ao gerar {tarefa.rotulo}: {tarefa.future.exception()}")
+        else:
+            resultado = tarefa.future.result()
+            rotulo = f"Baixar {tarefa.nome_arquivo} ({tarefa.rotulo}, {tarefa.fim - tarefa.inicio:.1f}s)"
+            if isinstance(resultado, str):
+                if not os.path.exists(resultado):
+                    continue
+                with open(resultado, 'rb') as f:
+                    st.download_button(rotulo, f, file_name=tarefa.nome_arquivo, mime=tarefa.mime,
+                                       key=f"relatorio_{posicao}")
+            else:
+                st.download_button(rotulo, bytes(resultado), file_name=tarefa.nome_arquivo, mime=tarefa.mime,
+                                   key=f"relatorio_{posicao}")
+    if em_andamento:
+        st.info("Gerando relatórios em segundo plano. Clique em Atualizar para ver o progresso.")
+        st.button("Atualizar")
+
+# Opções do xlsxwriter nos relatórios em Excel: com constant_memory cada linha vai para o disco assim que a
+# seguinte começa, então a memória não cresce com o relatório (as linhas de cada aba são escritas em ordem)
+EXCEL_OPTIONS = {'constant_memory': True, 'default_date_format': 'dd/mm/yyyy'}
+EXCEL_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Função para montar um nome de aba válido no Excel (até 31 caracteres, sem []:*?/\ e sem repetir)
+def _excel_sheet_name(nome, usados):
+    nome = ''.join('_' if c in '[]:*?/\\' else c for c in nome)[:31]
+    base, n = nome, 2
+    while nome.lower() in usados:
+        sufixo = f" ({n})"
+        nome = base[:31 - len(sufixo)] + sufixo
+        n += 1
+    usados.add(nome.lower())
+    return nome
+
+# Função para escrever um DataFrame em uma aba, linha por linha (datas e valores com formato brasileiro)
+def _write_excel_sheet(workbook, nome, df, formatos):
+    worksheet = workbook.add_worksheet(nome)
+    worksheet.set_column(0, max(len(df.columns) - 1, 0), 18)
+    worksheet.write_row(0, 0, list(df.columns), formatos['cabecalho'])
+    estilos = [
+        formatos['data'] if pd.api.types.is_datetime64_any_dtype(df[coluna]) else
+        formatos['valor'] if pd.api.types.is_float_dtype(df[coluna]) else None
+        for coluna in df.columns
+    ]
+    for linha, valores in enumerate(df.itertuples(index=False, name=None), start=1):
+        for coluna, valor in enumerate(valores):
+            # Células vazias (NaN/NaT) ficam em branco
+            if valor is None or valor != valor:
+                continue
+            worksheet.write(linha, coluna, valor, estilos[coluna])
+
+# Função para gravar um relatório em Excel em um caminho ou arquivo aberto. abas é uma sequência (ou gerador)
+# de (nome, DataFrame): cada aba é montada, escrita e descartada antes da próxima. Com total_abas, progresso
+# recebe a fração das abas já escritas.
+@profiled
+def write_excel_report(destino, abas, progresso=_ignore_progress, total_abas=None):
+    workbook = xlsxwriter.Workbook(destino, EXCEL_OPTIONS)
+    formatos = {
+        'cabecalho': workbook.add_format({'bold': True}),
+        'data': workbook.add_format({'num_format': 'dd/mm/yyyy'}),
+        'valor': workbook.add_format({'num_format': '#,##0.00'}),
+    }
+    usados = set()
+    for escritas, (nome, df) in enumerate(abas, start=1):
+        _write_excel_sheet(workbook, _excel_sheet_name(nome, usados), df, formatos)
+        if total_abas:
+            progresso(min(escritas / total_abas, 1.0), f"Aba {nome}")
+    progresso(1.0, "Gravando o arquivo")
+    workbook.close()
+
+# Função com as abas do relatório em Excel de uma unidade e regime
+def report_excel_sheets(cash_flow, recebimentos_por_conta, pagamentos_por_conta):
+    return [
+        ('Fluxo de Caixa', cash_flow.rename_axis('Data').reset_index()),
+        ('Recebimentos por Conta', recebimentos_por_conta),
+        ('Pagamentos por Conta', pagamentos_por_conta),
+    ]
+
+# Função com as abas do relatório em Excel de várias unidades e regimes, calculadas a partir do cubo: um índice,
+# uma aba de contas por unidade e uma aba de fluxo de caixa por unidade e regime. Como é um gerador, só uma
+# aba fica em memória por vez.
+def cube_excel_sheets(cube, unidades, regimes, start_date, end_date, saldos_iniciais):
+    # Os nomes das abas são definidos antes, para o índice mostrar os nomes já encurtados
+    usados = {'índice'}
+    nomes_contas = {unidade: _excel_sheet_name(f"Contas - {unidade}", usados) for unidade in unidades}
+    nomes_fluxo = {
+        (unidade, regime): _excel_sheet_name(f"{regime} - {unidade}", usados)
+        for unidade in unidades for regime in regimes
+    }
+    yield 'Índice', pd.DataFrame({
+        'Aba': list(nomes_fluxo.values()),
+        'Unidade': [unidade for unidade, _ in nomes_fluxo],
+        'Regime': [regime for _, regime in nomes_fluxo],
+        'Início': pd.Timestamp(start_date),
+        'Fim': pd.Timestamp(end_date),
+    })
+
+    # Fluxo de caixa de todas as unidades de cada regime, consolidado em uma passada pelo cubo
+    fluxos = {regime: cube_unit_cash_flows(cube, start_date, end_date, regime, saldos_iniciais) for regime in regimes}
+
+    for unidade in unidades:
+        recebimentos = cube_account_totals(cube, 'receber', unidade)
+        pagamentos = cube_account_totals(cube, 'pagar', unidade)
+        yield nomes_contas[unidade], pd.DataFrame({
+            'Tipo': ['Recebimentos'] * len(recebimentos) + ['Pagamentos'] * len(pagamentos),
+            'Conta Analítica': np.concatenate([recebimentos['Conta Analítica'].to_numpy(), pagamentos['Conta Analítica'].to_numpy()]),
+            'Valor': np.concatenate([recebimentos['Recebimentos'].to_numpy(), pagamentos['Pagamentos'].to_numpy()]),
+        })
+        for regime in regimes:
+            cash_flow = unit_cash_flow(fluxos[regime], unidade)
+            yield nomes_fluxo[(unidade, regime)], cash_flow.rename_axis('Data').reset_index()
+
+# Função com a quantidade de abas de cube_excel_sheets (índice, contas de cada unidade e um fluxo por regime)
+def cube_excel_sheet_count(unidades, regimes):
+    return 1 + len(unidades) * (1 + len(regimes))
+
+# Função para gravar um relatório em Excel em um arquivo temporário (servido pelo download_button); devolve o caminho
+def export_excel_tempfile(abas, progresso=_ignore_progress, total_abas=None):
+    fd, caminho = tempfile.mkstemp(prefix='relatorio_financeiro_', suffix='.xlsx')
+    with os.fdopen(fd, 'wb') as f:
+        write_excel_report(f, abas, progresso, total_abas)
+    return caminho
+
+# Quantidade máxima de pontos por série enviada ao navegador; acima disso os gráficos passam a semanais ou mensais
+CHART_MAX_POINTS = 800
+
+# Quantidade de figuras guardadas no cache de gráficos da sessão
+CHART_CACHE_SIZE = 32
+
+# Tipos de gráfico do fluxo de caixa
+CHART_TYPES = {'Linha': px.line, 'Barras': px.bar, 'Área': px.area}
+
+# Função para reduzir o fluxo de caixa a no máximo max_pontos linhas, resumindo por semana ou por mês.
+# Cada ponto fica no último dia do período, com o saldo acumulado desse dia (o saldo final não muda).
+# Devolve (tabela, resumo), com resumo em PDF_SUMMARIES ('Diário' quando não há redução).
+def downsample_cash_flow(cash_flow, max_pontos=CHART_MAX_POINTS):
+    for resumo, (freq, _, _) in PDF_SUMMARIES.items():
+        tabela = cash_flow if freq is None else summarize_cash_flow(cash_flow, freq, rotulo='fim')
+        if len(tabela) <= max_pontos:
+            break
+    return tabela, resumo
+
+# Função para resumir saldos acumulados (uma coluna por unidade) pelo último dia de cada semana ou mês,
+# com a mesma regra de downsample_cash_flow
+def downsample_balances(saldos, max_pontos=CHART_MAX_POINTS):
+    for resumo, (freq, _, _) in PDF_SUMMARIES.items():
+        if freq is None:
+            tabela = saldos
+        else:
+            periodos = saldos.index.to_period(freq)
+            tabela = saldos.groupby(periodos).last()
+            tabela.index = pd.DatetimeIndex(pd.Series(saldos.index).groupby(periodos).last().to_numpy())
+        if len(tabela) <= max_pontos:
+            break
+    return tabela, resumo
+
+# Função para montar o gráfico do fluxo de caixa (Linha, Barras ou Área)
+@profiled
+def build_cash_flow_figure(cash_flow, tipo_grafico, unidade_selecionada, regime, resumo='Diário'):
+    return CHART_TYPES[tipo_grafico](cash_flow, x=cash_flow.index, y=['Recebimentos', 'Pagamentos', 'Saldo Acumulado'],
+                                     title=f"Fluxo de Caixa {resumo} - Unidade: {unidade_selecionada} - Regime: {regime}",
+                                     labels={"value": "Valor (R$)", "variable": "Tipo", "index": "Data"})
+
+# Função para montar o gráfico de tendência do saldo acumulado
+@profiled
+def build_trend_figure(cash_flow, unidade_selecionada):
+    return px.line(cash_flow, x=cash_flow.index, y='Saldo Acumulado',
+                   title=f"Tendência do Saldo Acumulado - Unidade: {unidade_selecionada}",
+                   labels={"value": "Valor (R$)", "index": "Data"})
+
+# Função para montar o gráfico de pizza de recebimentos ou pagamentos por conta analítica
+@profiled
+def build_account_pie(totais_por_conta, coluna, titulo):
+    return px.pie(totais_por_conta, values=coluna, names='Conta Analítica', title=titulo, hover_data=[coluna])
 
-# Função principal
+# Função para obter uma figura do cache de gráficos da sessão, montando-a só na primeira vez. A chave deve
+# incluir tudo o que muda a figura (dados, unidade, regime, período, saldos, tipo de gráfico e resolução).
+def cached_figure(chave, construir):
+    cache = st.session_state.get('chart_cache')
+    if cache is None:
+        cache = st.session_state['chart_cache'] = OrderedDict()
+    if chave in cache:
+        cache.move_to_end(chave)
+        return cache[chave]
+    figura = construir()
+    cache[chave] = figura
+    while len(cache) > CHART_CACHE_SIZE:
+        cache.popitem(last=False)
+    return figura
+
+# Função principal. O perfil de depuração é desligado ao fim de qualquer execução (inclusive nas que param antes,
+# por falta de planilhas ou por erro): o perfil é guardado por thread, e a próxima execução do Streamlit pode
+# rodar em outra thread, sem como desligá-lo.
 def main():
+    try:
+        dashboard()
+    finally:
+        activate_profiler(None)
+
+# Função com o dashboard (executada por main)
+def dashboard():
     st.title("Dashboard Financeiro - Fortneer")
 
+    # Cadastro de unidades com os saldos iniciais (arquivo carregado, arquivo do servidor ou cadastro padrão).
+    # Os campos dos saldos ficam em um contêiner preenchido depois que as unidades dos dados são conhecidas.
+    st.sidebar.header("Saldos Bancários Iniciais")
+    arquivo_cadastro = st.sidebar.file_uploader("Carregar cadastro de unidades e saldos iniciais", type=["csv", "xlsx"])
+    chave_cadastro = file_content_hash(arquivo_cadastro) if arquivo_cadastro is not None else None
+    cadastro = get_stage_memo().get('cadastro', chave_cadastro, lambda: load_unit_registry(arquivo_cadastro))
+    unidade_padrao = default_unit(cadastro)
+    campos_saldos = st.sidebar.container()
+
     # Upload das planilhas
     st.sidebar.header("Upload das Planilhas")
     uploaded_file_receivables_quitadas = st.sidebar.file_uploader("Carregar Contas a Receber Quitadas", type=["xlsx"])
@@ -232,276 +2496,630 @@ def main():
     uploaded_file_payables_pendentes = st.sidebar.file_uploader("Carregar Contas a Pagar Pendentes", type=["xlsx"])
     uploaded_file_cash_report = st.sidebar.file_uploader("Carregar Relatório Caixa - Contas a Receber", type=["xlsx"])
 
-    if (uploaded_file_receivables_quitadas and uploaded_file_receivables_pendentes and 
-        uploaded_file_payables_quitadas and uploaded_file_payables_pendentes and uploaded_file_cash_report):
-        
-        df_receivables_quitadas = load_data(uploaded_file_receivables_quitadas)
-        df_receivables_pendentes = load_data(uploaded_file_receivables_pendentes)
-        df_payables_quitadas = load_data(uploaded_file_payables_quitadas)
-        df_payables_pendentes = load_data(uploaded_file_payables_pendentes)
-        df_cash_report = load_data(uploaded_file_cash_report)
-
-        if (df_receivables_quitadas is not None and df_receivables_pendentes is not None and 
-            df_payables_quitadas is not None and df_payables_pendentes is not None and df_cash_report is not None):
-            
-            # Processar as planilhas de contas a receber
-            df_receivables_quitadas = process_receivables(df_receivables_quitadas)
-            df_receivables_pendentes = process_receivables(df_receivables_pendentes)
-            
-            # Agregar as duas planilhas de contas a receber
-            df_receivables = pd.concat([df_receivables_quitadas, df_receivables_pendentes], ignore_index=True)
-            
-            # Processar as planilhas de contas a pagar
-            df_payables_quitadas = process_payables(df_payables_quitadas)
-            df_payables_pendentes = process_payables(df_payables_pendentes)
-            
-            # Agregar as duas planilhas de contas a pagar
-            df_payables = pd.concat([df_payables_quitadas, df_payables_pendentes], ignore_index=True)
-            
-            # Processar a planilha de relatório de caixa
-            df_cash_report = process_cash_report(df_cash_report)
-
-            # Exibir os dados processados das planilhas de contas a receber e a pagar
-            st.subheader("Dados Processados - Contas a Receber")
-            st.write(df_receivables)
-
-            st.subheader("Dados Processados - Contas a Pagar")
-            st.write(df_payables)
-
-            # Filtro por Unidade
-            st.sidebar.header("Filtros")
-            unidades_recebimentos = df_receivables['Unidade'].unique()
-            unidades_pagamentos = df_payables['Unidade'].unique()
-            unidades_cash_report = df_cash_report['Unidade'].unique()
-            
-            # Garantir que todas as unidades sejam strings e ordená-las
-            unidades_recebimentos = [str(u) for u in unidades_recebimentos]
-            unidades_pagamentos = [str(u) for u in unidades_pagamentos]
-            unidades_cash_report = [str(u) for u in unidades_cash_report]
-            todas_unidades = sorted(set(unidades_recebimentos + unidades_pagamentos + unidades_cash_report))
-            
-            # Adicionar a opção "Todas as Unidades"
-            todas_unidades = ["Todas as Unidades"] + todas_unidades
-            
-            unidade_selecionada = st.sidebar.selectbox(
-                "Selecione a Unidade",
-                options=todas_unidades
-            )
+    # Modo de leitura das planilhas: completa (pandas) ou em blocos, para arquivos muito grandes
+    modos_leitura = {"Completa": 'pandas', "Em blocos (openpyxl)": 'openpyxl'}
+    if 'calamine' in EXCEL_READERS:
+        modos_leitura["Em blocos (calamine, mais rápido)"] = 'calamine'
+    leitor = modos_leitura[st.sidebar.selectbox("Leitura das planilhas", options=list(modos_leitura))]
 
-            # Filtrar dados por unidade selecionada
-            if unidade_selecionada == "Todas as Unidades":
-                df_receivables_filtrado = df_receivables
-                df_payables_filtrado = df_payables
-                df_cash_report_filtrado = df_cash_report
-            else:
-                df_receivables_filtrado = df_receivables[df_receivables['Unidade'] == unidade_selecionada]
-                df_payables_filtrado = df_payables[df_payables['Unidade'] == unidade_selecionada]
-                df_cash_report_filtrado = df_cash_report[df_cash_report['Unidade'] == unidade_selecionada]
-
-            # Selecionar o regime (Competência, Caixa ou Caixa Projetado)
-            regime = st.sidebar.selectbox(
-                "Selecione o Regime",
-                options=["Caixa", "Competência", "Caixa Projetado"]  # Adicionar "Caixa Projetado"
-            )
+    # Quantidade de processos usados para ler as planilhas em paralelo
+    processos = st.sidebar.number_input("Processos de leitura em paralelo", min_value=1, max_value=16, value=INGESTION_WORKERS)
 
-            # Verificar se a coluna correta existe no DataFrame
-            if regime == 'Caixa':
-                coluna_regime = 'Pagamento'
-            elif regime == 'Competência':
-                coluna_regime = 'Data'
-            elif regime == 'Caixa Projetado':
-                coluna_regime = 'Vencimento'
-            else:
-                st.error("Regime inválido selecionado.")
-                return
-
-            if coluna_regime not in df_receivables_filtrado.columns or coluna_regime not in df_payables_filtrado.columns:
-                st.error(f"A coluna '{coluna_regime}' não foi encontrada nos dados. Verifique o arquivo carregado.")
-                return
-
-            # Selecionar o período de análise
-            st.sidebar.header("Período de Análise")
-            start_date = st.sidebar.date_input("Data Inicial", datetime.today())
-            end_date = st.sidebar.date_input("Data Final", datetime.today() + timedelta(days=30))
-
-            # Converter start_date e end_date para datetime64[ns]
-            start_date = pd.to_datetime(start_date)
-            end_date = pd.to_datetime(end_date)
-
-            # Calcular o fluxo de caixa
-            cash_flow = calculate_cash_flow(df_receivables_filtrado, df_payables_filtrado, df_cash_report_filtrado, start_date, end_date, regime, saldo_sombrio, saldo_fumaca, unidade_selecionada)
-
-            # Exibir o fluxo de caixa
-            st.subheader(f"Fluxo de Caixa Diário - Unidade: {unidade_selecionada} - Regime: {regime}")
-            
-            # Selecionar o tipo de gráfico
-            tipo_grafico = st.selectbox(
-                "Selecione o Tipo de Gráfico",
-                options=["Linha", "Barras", "Área"]
-            )
+    # Histórico local em Parquet: cada upload acrescenta apenas as linhas novas ao histórico
+    usar_historico = st.sidebar.checkbox("Usar histórico local (Parquet)", value=False)
 
-            # Criar o gráfico conforme a seleção
-            if tipo_grafico == "Linha":
-                fig_fluxo = px.line(cash_flow, x=cash_flow.index, y=['Recebimentos', 'Pagamentos', 'Saldo Acumulado'],
-                                    title=f"Fluxo de Caixa Diário - Unidade: {unidade_selecionada} - Regime: {regime}",
-                                    labels={"value": "Valor (R$)", "variable": "Tipo", "index": "Data"})
-            elif tipo_grafico == "Barras":
-                fig_fluxo = px.bar(cash_flow, x=cash_flow.index, y=['Recebimentos', 'Pagamentos', 'Saldo Acumulado'],
-                                   title=f"Fluxo de Caixa Diário - Unidade: {unidade_selecionada} - Regime: {regime}",
-                                   labels={"value": "Valor (R$)", "variable": "Tipo", "index": "Data"})
-            elif tipo_grafico == "Área":
-                fig_fluxo = px.area(cash_flow, x=cash_flow.index, y=['Recebimentos', 'Pagamentos', 'Saldo Acumulado'],
-                                    title=f"Fluxo de Caixa Diário - Unidade: {unidade_selecionada} - Regime: {regime}",
-                                    labels={"value": "Valor (R$)", "variable": "Tipo", "index": "Data"})
-
-            # Exibir o gráfico
-            st.plotly_chart(fig_fluxo)
-
-            # Adicionar um filtro de dia específico
-            dia_especifico = st.date_input(
-                "Selecione um dia para visualizar os valores",
-                min_value=start_date,
-                max_value=end_date,
-                value=start_date
-            )
+    # Perfil de desempenho (depuração): tempo, linhas e pico de memória de cada etapa desta execução
+    depuracao = st.sidebar.checkbox("Depuração: medir as etapas", value=False)
+    profiler = StageProfiler() if depuracao else None
+    activate_profiler(profiler)
 
-            # Converter o dia_especifico para o mesmo formato do índice do cash_flow
-            dia_especifico = pd.to_datetime(dia_especifico)
+    planilhas = {
+        'receber_quitadas': (uploaded_file_receivables_quitadas, process_receivables),
+        'receber_pendentes': (uploaded_file_receivables_pendentes, process_receivables),
+        'pagar_quitadas': (uploaded_file_payables_quitadas, process_payables),
+        'pagar_pendentes': (uploaded_file_payables_pendentes, process_payables),
+        'relatorio_caixa': (uploaded_file_cash_report, process_cash_report),
+    }
 
-            # Filtrar os dados para o dia específico
-            if dia_especifico in cash_flow.index:
-                dados_dia = cash_flow.loc[cash_flow.index == dia_especifico]
-                st.write(f"Valores para o dia {dia_especifico.strftime('%d/%m/%Y')}:")
-                st.write(dados_dia)
-            else:
-                st.write(f"Não há dados disponíveis para o dia {dia_especifico.strftime('%d/%m/%Y')}.")
-
-            # Análise de Contas Analíticas
-            st.subheader(f"Análise de Contas Analíticas - Unidade: {unidade_selecionada} - Regime: {regime}")
-            
-            # Gráfico de Pizza - Recebimentos por Conta Analítica
-            recebimentos_por_conta = df_receivables_filtrado.groupby('Conta Analítica')['Recebimentos'].sum().reset_index()
-            fig_pizza_recebimentos = px.pie(recebimentos_por_conta, values='Recebimentos', names='Conta Analítica',
-                                            title=f"Distribuição dos Recebimentos por Conta Analítica - Unidade: {unidade_selecionada}",
-                                            hover_data=['Recebimentos'])
-            st.plotly_chart(fig_pizza_recebimentos)
-
-            # Gráfico de Pizza - Pagamentos por Conta Analítica
-            pagamentos_por_conta = df_payables_filtrado.groupby('Conta Analítica')['Pagamentos'].sum().reset_index()
-            fig_pizza_pagamentos = px.pie(pagamentos_por_conta, values='Pagamentos', names='Conta Analítica',
-                                          title=f"Distribuição dos Pagamentos por Conta Analítica - Unidade: {unidade_selecionada}",
-                                          hover_data=['Pagamentos'])
-            st.plotly_chart(fig_pizza_pagamentos)
-
-            # Indicadores Financeiros
-            st.subheader(f"Indicadores Financeiros - Unidade: {unidade_selecionada} - Regime: {regime}")
-
-            # Filtrar os dados com base no regime
-            if regime == 'Caixa':
-                coluna_regime = 'Pagamento'
-            elif regime == 'Competência':
-                coluna_regime = 'Data'
-            elif regime == 'Caixa Projetado':
-                coluna_regime = 'Vencimento'
-
-            # Calcular totais com base no regime
-            total_recebimentos = (
-                df_receivables_filtrado[df_receivables_filtrado[coluna_regime].between(start_date, end_date)]['Recebimentos'].sum() +
-                df_cash_report_filtrado[df_cash_report_filtrado['Data'].between(start_date, end_date)]['Recebimentos'].sum()
-            )
+    # Etapas do cálculo guardadas entre as execuções do script
+    memo = get_stage_memo()
 
-            total_pagamentos = df_payables_filtrado[df_payables_filtrado[coluna_regime].between(start_date, end_date)]['Pagamentos'].sum()
-            saldo_liquido = total_recebimentos - total_pagamentos
-
-            # Exibir indicadores em colunas
-            col1, col2, col3 = st.columns(3)
-            col1.metric("Total de Recebimentos", f"R$ {total_recebimentos:,.2f}")
-            col2.metric("Total de Pagamentos", f"R$ {total_pagamentos:,.2f}")
-            col3.metric("Saldo Líquido", f"R$ {saldo_liquido:,.2f}")
-
-            # Média Diária de Recebimentos e Pagamentos
-            dias_periodo = (end_date - start_date).days + 1
-            media_recebimentos = total_recebimentos / dias_periodo
-            media_pagamentos = total_pagamentos / dias_periodo
-
-            col4, col5 = st.columns(2)
-            col4.metric("Média Diária de Recebimentos", f"R$ {media_recebimentos:,.2f}")
-            col5.metric("Média Diária de Pagamentos", f"R$ {media_pagamentos:,.2f}")
-
-            # Maior Recebimento e Pagamento
-            if not df_receivables_filtrado.empty:
-                df_receivables_filtrado_periodo = df_receivables_filtrado[df_receivables_filtrado[coluna_regime].between(start_date, end_date)]
-                if not df_receivables_filtrado_periodo.empty:
-                    maior_recebimento = df_receivables_filtrado_periodo.loc[df_receivables_filtrado_periodo['Recebimentos'].idxmax()]
-                    st.write(f"**Maior Recebimento:** {maior_recebimento['Conta Analítica']} - R$ {maior_recebimento['Recebimentos']:,.2f}")
-                else:
-                    st.write("**Maior Recebimento:** Nenhum recebimento no período selecionado.")
-            else:
-                st.write("**Maior Recebimento:** Nenhum dado disponível para a unidade selecionada.")
-
-            if not df_payables_filtrado.empty:
-                df_payables_filtrado_periodo = df_payables_filtrado[df_payables_filtrado[coluna_regime].between(start_date, end_date)]
-                if not df_payables_filtrado_periodo.empty:
-                    maior_pagamento = df_payables_filtrado_periodo.loc[df_payables_filtrado_periodo['Pagamentos'].idxmax()]
-                    st.write(f"**Maior Pagamento:** {maior_pagamento['Conta Analítica']} - R$ {maior_pagamento['Pagamentos']:,.2f}")
-                else:
-                    st.write("**Maior Pagamento:** Nenhum pagamento no período selecionado.")
-            else:
-                st.write("**Maior Pagamento:** Nenhum dado disponível para a unidade selecionada.")
-
-            # Análise Temporal
-            st.subheader(f"Análise Temporal - Unidade: {unidade_selecionada} - Regime: {regime}")
-            fig_tendencia = px.line(cash_flow, x=cash_flow.index, y='Saldo Acumulado',
-                                    title=f"Tendência do Saldo Acumulado - Unidade: {unidade_selecionada}",
-                                    labels={"value": "Valor (R$)", "index": "Data"})
-            st.plotly_chart(fig_tendencia)
-
-            # Análise por Unidade (se "Todas as Unidades" for selecionada)
-            if unidade_selecionada == "Todas as Unidades":
-                st.subheader("Análise por Unidade")
+    if usar_historico:
+        # Gravar no histórico as planilhas carregadas (cada arquivo é gravado uma única vez por sessão)
+        arquivos_gravados = st.session_state.setdefault('historico_gravado', set())
+        novas_planilhas = {
+            ledger: (uploaded_file, process_func)
+            for ledger, (uploaded_file, process_func) in planilhas.items()
+            if uploaded_file is not None and (ledger, file_content_hash(uploaded_file)) not in arquivos_gravados
+        }
+        for ledger, df in load_processed_parallel(novas_planilhas, workers=processos, reader=leitor).items():
+            if df is not None:
+                uploaded_file = novas_planilhas[ledger][0]
+                if ledger == 'relatorio_caixa':
+                    df = assign_default_unit(df, unidade_padrao)
+                linhas_novas = append_to_ledger_store(df, ledger)
+                st.sidebar.caption(f"{uploaded_file.name}: {linhas_novas} linhas novas gravadas no histórico.")
+                arquivos_gravados.add((ledger, file_content_hash(uploaded_file)))
+
+        todas_unidades = ledger_store_units()
+        if not todas_unidades:
+            st.info("O histórico local está vazio. Carregue as planilhas para preenchê-lo.")
+            return
+    else:
+        if not (uploaded_file_receivables_quitadas and uploaded_file_receivables_pendentes and 
+                uploaded_file_payables_quitadas and uploaded_file_payables_pendentes and uploaded_file_cash_report):
+            return
+
+        # Carregar e processar as planilhas em paralelo (arquivos sem alteração vêm do cache de ingestão)
+        # e agregar as duas planilhas de contas a receber e as duas de contas a pagar. Enquanto os arquivos
+        # não mudam, a etapa inteira é reaproveitada. A unidade padrão do Relatório Caixa faz parte da chave.
+        chave_dados = tuple(file_content_hash(uploaded_file) for uploaded_file, _ in planilhas.values()) + (unidade_padrao,)
+        # Com o cache compartilhado, outra sessão que carregou os mesmos arquivos já deixou o resultado pronto
+        dados = memo.get('dados', (chave_dados, leitor), lambda: shared_cached(
+            ('dados', chave_dados, leitor),
+            lambda: load_all_parallel(planilhas, workers=processos, reader=leitor, unidade_padrao=unidade_padrao)))
+        if dados is None:
+            return
+        df_receivables, df_payables, df_cash_report = dados
+
+        # Garantir que todas as unidades sejam strings e ordená-las
+        def listar_unidades():
+            unidades_recebimentos = [str(u) for u in df_receivables['Unidade'].unique()]
+            unidades_pagamentos = [str(u) for u in df_payables['Unidade'].unique()]
+            unidades_cash_report = [str(u) for u in df_cash_report['Unidade'].unique()]
+            return sorted(set(unidades_recebimentos + unidades_pagamentos + unidades_cash_report))
+        todas_unidades = memo.get('unidades', chave_dados, listar_unidades)
+
+    # Estatísticas do cache de ingestão
+    estatisticas_cache = get_ingestion_cache().stats()
+    st.sidebar.caption(
+        f"Cache de ingestão: {estatisticas_cache['hits']} acertos, {estatisticas_cache['misses']} faltas, "
+        f"{estatisticas_cache['bytes'] / 1024 ** 2:,.1f} MB"
+    )
+    cache_compartilhado = _importable_module().get_shared_cache()
+    if cache_compartilhado is not None:
+        estatisticas_compartilhado = cache_compartilhado.stats()
+        st.sidebar.caption(
+            f"Cache compartilhado ({'memória' if estatisticas_compartilhado['backend'] == 'memory' else 'disco'}): "
+            f"{estatisticas_compartilhado['hits']} acertos, {estatisticas_compartilhado['misses']} faltas, "
+            f"{estatisticas_compartilhado['entries']} entradas, {estatisticas_compartilhado['bytes'] / 1024 ** 2:,.1f} MB"
+        )
+
+    # Saldo inicial de cada unidade: as do cadastro, na ordem do arquivo, e depois as encontradas apenas nos dados
+    saldos_iniciais = {
+        unidade: campos_saldos.number_input(f"Saldo Inicial - {unidade}", value=float(cadastro.get(unidade, 0.0)))
+        for unidade in list(cadastro) + [u for u in todas_unidades if u not in cadastro]
+    }
+    chave_saldos = tuple(saldos_iniciais.items())
+
+    # Filtro por Unidade
+    st.sidebar.header("Filtros")
+
+    # Adicionar a opção "Todas as Unidades"
+    todas_unidades = ["Todas as Unidades"] + todas_unidades
+    
+    unidade_selecionada = st.sidebar.selectbox(
+        "Selecione a Unidade",
+        options=todas_unidades
+    )
+
+    # Selecionar o regime (Competência, Caixa ou Caixa Projetado)
+    regime = st.sidebar.selectbox(
+        "Selecione o Regime",
+        options=["Caixa", "Competência", "Caixa Projetado"]  # Adicionar "Caixa Projetado"
+    )
+
+    # Verificar se a coluna correta existe no DataFrame
+    if regime == 'Caixa':
+        coluna_regime = 'Pagamento'
+    elif regime == 'Competência':
+        coluna_regime = 'Data'
+    elif regime == 'Caixa Projetado':
+        coluna_regime = 'Vencimento'
+    else:
+        st.error("Regime inválido selecionado.")
+        return
+
+    # Selecionar o período de análise
+    st.sidebar.header("Período de Análise")
+    start_date = st.sidebar.date_input("Data Inicial", datetime.today())
+    end_date = st.sidebar.date_input("Data Final", datetime.today() + timedelta(days=30))
+
+    # Converter start_date e end_date para datetime64[ns]
+    start_date = pd.to_datetime(start_date)
+    end_date = pd.to_datetime(end_date)
+
+    if usar_historico:
+        # Ler do histórico apenas as partições da unidade e do período selecionados
+        colunas_caixa = ['Data', 'Vencimento'] if regime == 'Caixa Projetado' else ['Data']
+        chave_dados = ('historico', ledger_store_signature(), unidade_selecionada, start_date, end_date, regime)
+        df_receivables, df_payables, df_cash_report = memo.get('dados_historico', chave_dados, lambda: (
+            read_ledger_store(['receber_quitadas', 'receber_pendentes'], unidade_selecionada, start_date, end_date, [coluna_regime]),
+            read_ledger_store(['pagar_quitadas', 'pagar_pendentes'], unidade_selecionada, start_date, end_date, [coluna_regime]),
+            read_ledger_store(['relatorio_caixa'], unidade_selecionada, start_date, end_date, colunas_caixa),
+        ))
+
+        if df_receivables is None or df_payables is None or df_cash_report is None:
+            st.error("O histórico local não contém todas as planilhas. Carregue as planilhas que faltam.")
+            return
+
+    # Exibir os dados processados das planilhas de contas a receber e a pagar
+    st.subheader("Dados Processados - Contas a Receber")
+    st.write(ledger_display_frame(df_receivables, 'Recebimentos'))
+
+    st.subheader("Dados Processados - Contas a Pagar")
+    st.write(ledger_display_frame(df_payables, 'Pagamentos'))
+
+    if coluna_regime not in df_receivables.columns or coluna_regime not in df_payables.columns:
+        st.error(f"A coluna '{coluna_regime}' não foi encontrada nos dados. Verifique o arquivo carregado.")
+        return
+
+    # Cubo diário de agregados, montado uma vez por conjunto de dados (no histórico, por unidade e período lidos)
+    cube = get_aggregate_cube(chave_dados, df_receivables, df_payables, df_cash_report)
+
+    # Calcular o fluxo de caixa (ao mudar só a data final, apenas os dias novos são calculados)
+    cash_flow = incremental_cash_flow(memo, chave_dados, cube, start_date, end_date, regime, saldos_iniciais, unidade_selecionada)
+
+    # Exibir o fluxo de caixa
+    st.subheader(f"Fluxo de Caixa Diário - Unidade: {unidade_selecionada} - Regime: {regime}")
+    
+    # Selecionar o tipo de gráfico
+    tipo_grafico = st.selectbox(
+        "Selecione o Tipo de Gráfico",
+        options=["Linha", "Barras", "Área"]
+    )
+
+    # Séries longas são resumidas por semana ou mês, a menos que a resolução máxima seja pedida
+    resolucao_maxima = st.checkbox("Gráficos em resolução máxima (todos os dias)")
+    if resolucao_maxima:
+        cash_flow_grafico, resumo_grafico = cash_flow, 'Diário'
+    else:
+        cash_flow_grafico, resumo_grafico = downsample_cash_flow(cash_flow)
+    chave_graficos = (chave_dados, unidade_selecionada, regime, start_date, end_date, chave_saldos, resolucao_maxima)
+
+    # Criar o gráfico conforme a seleção
+    fig_fluxo = cached_figure(
+        ('fluxo', tipo_grafico) + chave_graficos,
+        lambda: build_cash_flow_figure(cash_flow_grafico, tipo_grafico, unidade_selecionada, regime, resumo_grafico),
+    )
+
+    # Exibir o gráfico
+    st.plotly_chart(fig_fluxo)
+
+    # Adicionar um filtro de dia específico
+    dia_especifico = st.date_input(
+        "Selecione um dia para visualizar os valores",
+        min_value=start_date,
+        max_value=end_date,
+        value=start_date
+    )
+
+    # Converter o dia_especifico para o mesmo formato do índice do cash_flow
+    dia_especifico = pd.to_datetime(dia_especifico)
+
+    # Filtrar os dados para o dia específico
+    if dia_especifico in cash_flow.index:
+        dados_dia = cash_flow.loc[cash_flow.index == dia_especifico]
+        st.write(f"Valores para o dia {dia_especifico.strftime('%d/%m/%Y')}:")
+        st.write(dados_dia)
+    else:
+        st.write(f"Não há dados disponíveis para o dia {dia_especifico.strftime('%d/%m/%Y')}.")
+
+    # Lançamentos que formam o dia (ou o período inteiro), lidos pelo índice de datas montado uma vez por conjunto
+    # de dados
+    with st.expander("Detalhar lançamentos"):
+        periodo_inteiro = st.checkbox("Detalhar todo o período selecionado")
+        top_n = st.number_input("Maiores lançamentos exibidos (0 = todos)", min_value=0, value=20, step=10)
+        indice_dias = memo.get('indice_dias', chave_dados, lambda: shared_cached(
+            ('indice_dias', chave_dados),
+            lambda: build_drilldown_index(df_receivables, df_payables, df_cash_report)))
+        inicio_detalhe, fim_detalhe = (start_date, end_date) if periodo_inteiro else (dia_especifico, dia_especifico)
+        detalhes = drilldown_titles(indice_dias, df_receivables, df_payables, df_cash_report, regime,
+                                    unidade_selecionada, inicio_detalhe, fim_detalhe, top_n=int(top_n) or None)
+        for nome, linhas in detalhes.items():
+            st.write(f"**{nome}** ({len(linhas)} lançamentos)")
+            st.dataframe(linhas)
+
+    # Análise de Contas Analíticas
+    st.subheader(f"Análise de Contas Analíticas - Unidade: {unidade_selecionada} - Regime: {regime}")
+    
+    # Gráfico de Pizza - Recebimentos por Conta Analítica
+    recebimentos_por_conta = memo.get('contas_receber', (chave_dados, unidade_selecionada),
+                                      lambda: cube_account_totals(cube, 'receber', unidade_selecionada))
+    fig_pizza_recebimentos = cached_figure(
+        ('pizza_recebimentos', chave_dados, unidade_selecionada),
+        lambda: build_account_pie(recebimentos_por_conta, 'Recebimentos',
+                                  f"Distribuição dos Recebimentos por Conta Analítica - Unidade: {unidade_selecionada}"),
+    )
+    st.plotly_chart(fig_pizza_recebimentos)
+
+    # Gráfico de Pizza - Pagamentos por Conta Analítica
+    pagamentos_por_conta = memo.get('contas_pagar', (chave_dados, unidade_selecionada),
+                                    lambda: cube_account_totals(cube, 'pagar', unidade_selecionada))
+    fig_pizza_pagamentos = cached_figure(
+        ('pizza_pagamentos', chave_dados, unidade_selecionada),
+        lambda: build_account_pie(pagamentos_por_conta, 'Pagamentos',
+                                  f"Distribuição dos Pagamentos por Conta Analítica - Unidade: {unidade_selecionada}"),
+    )
+    st.plotly_chart(fig_pizza_pagamentos)
+
+    # Indicadores Financeiros
+    st.subheader(f"Indicadores Financeiros - Unidade: {unidade_selecionada} - Regime: {regime}")
+
+    # Calcular indicadores com base no regime
+    indicadores = memo.get('indicadores', (chave_dados, unidade_selecionada, regime, start_date, end_date),
+                           lambda: compute_indicators(cube, unidade_selecionada, regime, start_date, end_date))
+
+    # Exibir indicadores em colunas
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Total de Recebimentos", f"R$ {indicadores['total_recebimentos']:,.2f}")
+    col2.metric("Total de Pagamentos", f"R$ {indicadores['total_pagamentos']:,.2f}")
+    col3.metric("Saldo Líquido", f"R$ {indicadores['saldo_liquido']:,.2f}")
+
+    # Média Diária de Recebimentos e Pagamentos
+    col4, col5 = st.columns(2)
+    col4.metric("Média Diária de Recebimentos", f"R$ {indicadores['media_recebimentos']:,.2f}")
+    col5.metric("Média Diária de Pagamentos", f"R$ {indicadores['media_pagamentos']:,.2f}")
+
+    # Maior Recebimento e Pagamento
+    if indicadores['lancamentos_recebimentos'] > 0:
+        maior_recebimento = indicadores['maior_recebimento']
+        if maior_recebimento is not None:
+            st.write(f"**Maior Recebimento:** {maior_recebimento[0]} - R$ {maior_recebimento[1]:,.2f}")
+        else:
+            st.write("**Maior Recebimento:** Nenhum recebimento no período selecionado.")
+    else:
+        st.write("**Maior Recebimento:** Nenhum dado disponível para a unidade selecionada.")
+
+    if indicadores['lancamentos_pagamentos'] > 0:
+        maior_pagamento = indicadores['maior_pagamento']
+        if maior_pagamento is not None:
+            st.write(f"**Maior Pagamento:** {maior_pagamento[0]} - R$ {maior_pagamento[1]:,.2f}")
+        else:
+            st.write("**Maior Pagamento:** Nenhum pagamento no período selecionado.")
+    else:
+        st.write("**Maior Pagamento:** Nenhum dado disponível para a unidade selecionada.")
+
+    # Análise Temporal
+    st.subheader(f"Análise Temporal - Unidade: {unidade_selecionada} - Regime: {regime}")
+    fig_tendencia = cached_figure(('tendencia',) + chave_graficos,
+                                  lambda: build_trend_figure(cash_flow_grafico, unidade_selecionada))
+    st.plotly_chart(fig_tendencia)
+
+    # Projeção de Caixa: títulos em aberto e fluxos estimados pelo histórico quitado, mês a mês, com a faixa entre
+    # os cenários pessimista e otimista
+    if regime == 'Caixa Projetado':
+        st.subheader(f"Projeção de Caixa - Unidade: {unidade_selecionada}")
+        metodo = st.selectbox("Método de estimativa", options=list(FORECAST_METHODS),
+                              format_func=lambda nome: f"{nome} ({FORECAST_METHODS[nome]})")
+        horizonte = st.slider("Horizonte (meses)", min_value=FORECAST_HORIZONS[0], max_value=FORECAST_HORIZONS[1],
+                              value=FORECAST_HORIZONS[0])
+        mes_inicial = start_date.to_period('M').to_timestamp()
+
+        dados_projecao = (df_receivables, df_payables, df_cash_report)
+        chave_projecao = chave_dados
+        if usar_historico:
+            # O período lido do histórico não cobre os meses quitados usados nas estimativas: ler a janela da projeção
+            inicio_historico = mes_inicial - pd.DateOffset(months=FORECAST_HISTORY_MONTHS)
+            fim_projecao = mes_inicial + pd.DateOffset(months=horizonte)
+            chave_projecao = ('historico', ledger_store_signature(), unidade_selecionada, inicio_historico, fim_projecao)
+            dados_projecao = memo.get('dados_projecao', chave_projecao, lambda: (
+                read_ledger_store(['receber_quitadas', 'receber_pendentes'], unidade_selecionada,
+                                  inicio_historico, fim_projecao, ['Pagamento', 'Vencimento']),
+                read_ledger_store(['pagar_quitadas', 'pagar_pendentes'], unidade_selecionada,
+                                  inicio_historico, fim_projecao, ['Pagamento', 'Vencimento']),
+                read_ledger_store(['relatorio_caixa'], unidade_selecionada, inicio_historico, fim_projecao, ['Data']),
+            ))
+
+        projecao = memo.get('projecao', (chave_projecao, metodo, horizonte, mes_inicial, chave_saldos),
+                            lambda: forecast_cash_flow(*dados_projecao, mes_inicial, horizonte, metodo, saldos_iniciais))
+        tabela_projecao = unit_forecast(projecao, unidade_selecionada)
+        fig_projecao = cached_figure(
+            ('projecao', chave_projecao, unidade_selecionada, metodo, horizonte, mes_inicial, chave_saldos),
+            lambda: build_forecast_figure(tabela_projecao, unidade_selecionada, metodo),
+        )
+        st.plotly_chart(fig_projecao)
+        st.write(tabela_projecao.set_axis(tabela_projecao.index.strftime('%m/%Y')))
+
+    # Análise por Unidade (se "Todas as Unidades" for selecionada)
+    if unidade_selecionada == "Todas as Unidades":
+        st.subheader("Análise por Unidade")
     
-                # Filtrar os dados com base no regime
-                if regime == 'Caixa':
-                    coluna_regime = 'Pagamento'
-                elif regime == 'Competência':
-                    coluna_regime = 'Data'
-                elif regime == 'Caixa Projetado':
-                    coluna_regime = 'Vencimento'
-
-                # Calcular recebimentos e pagamentos por unidade com base no regime
-                recebimentos_por_unidade = df_receivables[df_receivables[coluna_regime].between(start_date, end_date)].groupby('Unidade')['Recebimentos'].sum().reset_index()
-                pagamentos_por_unidade = df_payables[df_payables[coluna_regime].between(start_date, end_date)].groupby('Unidade')['Pagamentos'].sum().reset_index()
-
-                # Renomear as colunas para evitar duplicação
-                recebimentos_por_unidade = recebimentos_por_unidade.rename(columns={'Recebimentos': 'Recebimentos'})
-                pagamentos_por_unidade = pagamentos_por_unidade.rename(columns={'Pagamentos': 'Pagamentos'})
-
-                # Concatenar os DataFrames
-                tabela_resumida_unidades = pd.merge(recebimentos_por_unidade, pagamentos_por_unidade, on='Unidade', how='outer')
-
-                # Preencher valores NaN com 0 (caso haja unidades sem recebimentos ou pagamentos)
-                tabela_resumida_unidades = tabela_resumida_unidades.fillna(0)
-
-                # Gráfico de Barras - Recebimentos e Pagamentos por Unidade
-                fig_unidades = px.bar(tabela_resumida_unidades, x='Unidade', y=['Recebimentos', 'Pagamentos'],
-                              title="Recebimentos e Pagamentos por Unidade",
-                              labels={"value": "Valor (R$)", "variable": "Tipo", "Unidade": "Unidade"})
-                st.plotly_chart(fig_unidades)
-
-            # Botão para gerar relatório em PDF
-            if st.button("Gerar Relatório em PDF"):
-                pdf_output = generate_pdf(cash_flow, recebimentos_por_conta, pagamentos_por_conta, unidade_selecionada, regime)
-                st.markdown(create_download_link(pdf_output, "relatorio_financeiro.pdf", "pdf"), unsafe_allow_html=True)
-
-            # Botão para gerar relatório em Excel
-            if st.button("Gerar Relatório em Excel"):
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    cash_flow.to_excel(writer, sheet_name='Fluxo de Caixa')
-                    recebimentos_por_conta.to_excel(writer, sheet_name='Recebimentos por Conta')
-                    pagamentos_por_conta.to_excel(writer, sheet_name='Pagamentos por Conta')
-                output.seek(0)
-                st.markdown(create_download_link(output.getvalue(), "relatorio_financeiro.xlsx", "vnd.openxmlformats-officedocument.spreadsheetml.sheet"), unsafe_allow_html=True)
+        # Calcular recebimentos e pagamentos por unidade com base no regime (somas acumuladas do cubo)
+        tabela_resumida_unidades = memo.get('totais_unidades', (chave_dados, coluna_regime, start_date, end_date),
+                                            lambda: cube_unit_totals(cube, coluna_regime, start_date, end_date))
+
+        # Gráfico de Barras - Recebimentos e Pagamentos por Unidade
+        fig_unidades = cached_figure(
+            ('unidades', chave_dados, coluna_regime, start_date, end_date),
+            lambda: px.bar(tabela_resumida_unidades, x='Unidade', y=['Recebimentos', 'Pagamentos'],
+                           title="Recebimentos e Pagamentos por Unidade",
+                           labels={"value": "Valor (R$)", "variable": "Tipo", "Unidade": "Unidade"}),
+        )
+        st.plotly_chart(fig_unidades)
+
+        # Saldo acumulado de cada unidade e do consolidado, calculados juntos a partir do cubo
+        fluxos_unidades = memo.get('fluxo_unidades', (chave_dados, regime, start_date, end_date, chave_saldos),
+                                   lambda: cube_unit_cash_flows(cube, start_date, end_date, regime, saldos_iniciais))
+        fig_saldos = cached_figure(
+            ('saldos_unidades', resolucao_maxima) + (chave_dados, regime, start_date, end_date, chave_saldos),
+            lambda: px.line(
+                fluxos_unidades['Saldo Acumulado'] if resolucao_maxima else downsample_balances(fluxos_unidades['Saldo Acumulado'])[0],
+                title="Saldo Acumulado por Unidade",
+                labels={"value": "Valor (R$)", "variable": "Unidade", "index": "Data"},
+            ),
+        )
+        st.plotly_chart(fig_saldos)
+
+    # Estatísticas da memória das etapas
+    estatisticas_etapas = memo.stats()
+    st.sidebar.caption(
+        f"Etapas reaproveitadas: {estatisticas_etapas['hits']} de "
+        f"{estatisticas_etapas['hits'] + estatisticas_etapas['misses']}"
+    )
+
+    # Relatórios em segundo plano, com progresso. Relatórios com os mesmos dados, unidade, regime, período e opções
+    # são reaproveitados entre pedidos e sessões; com a depuração ligada são gerados nesta execução, para entrar
+    # no perfil.
+    st.subheader("Relatórios")
+    em_segundo_plano = profiler is None
+
+    # Relatório em PDF da unidade selecionada
+    resumo_pdf = st.selectbox("Tabela do relatório em PDF", options=list(PDF_SUMMARIES))
+    if st.button("Gerar Relatório em PDF"):
+        request_report(
+            ('pdf', chave_dados, unidade_selecionada, regime, start_date, end_date, chave_saldos, resumo_pdf),
+            f"PDF - {unidade_selecionada} - {regime}", "relatorio_financeiro.pdf", "application/pdf",
+            generate_pdf, cash_flow, recebimentos_por_conta, pagamentos_por_conta, unidade_selecionada, regime,
+            resumo=resumo_pdf, background=em_segundo_plano,
+        )
+
+    # Relatórios em PDF de várias unidades, gerados em paralelo e baixados em um .zip
+    unidades_pdf = st.multiselect("Unidades dos relatórios em PDF por unidade", options=list(cube['units']))
+    if st.button("Gerar PDFs por Unidade") and unidades_pdf:
+        request_report(
+            ('pdf_unidades', chave_dados, tuple(unidades_pdf), regime, start_date, end_date, chave_saldos, resumo_pdf),
+            f"PDFs por unidade - {len(unidades_pdf)} unidades - {regime}", "relatorios_unidades.zip", "application/zip",
+            generate_unit_pdfs, cube, unidades_pdf, regime, start_date, end_date, saldos_iniciais,
+            resumo=resumo_pdf, background=em_segundo_plano,
+        )
 
+    # Relatório em Excel (gravado em arquivo temporário e servido pelo download_button)
+    excel_completo = st.checkbox("Excel com uma aba por unidade e regime")
+    if st.button("Gerar Relatório em Excel"):
+        if excel_completo:
+            unidades_excel = ["Todas as Unidades"] + list(cube['units'])
+            request_report(
+                ('excel_unidades', chave_dados, start_date, end_date, chave_saldos),
+                "Excel - todas as unidades e regimes", "relatorio_financeiro.xlsx", EXCEL_MIME,
+                export_excel_tempfile,
+                cube_excel_sheets(cube, unidades_excel, list(REGIME_COLUMNS), start_date, end_date, saldos_iniciais),
+                total_abas=cube_excel_sheet_count(unidades_excel, REGIME_COLUMNS), background=em_segundo_plano,
+            )
+        else:
+            abas = report_excel_sheets(cash_flow, recebimentos_por_conta, pagamentos_por_conta)
+            request_report(
+                ('excel', chave_dados, unidade_selecionada, regime, start_date, end_date, chave_saldos),
+                f"Excel - {unidade_selecionada} - {regime}", "relatorio_financeiro.xlsx", EXCEL_MIME,
+                export_excel_tempfile, abas, total_abas=len(abas), background=em_segundo_plano,
+            )
+
+    show_report_jobs()
+    estatisticas_relatorios = _importable_module().get_report_jobs().stats()
+    st.sidebar.caption(
+        f"Relatórios no servidor: {estatisticas_relatorios['prontos']} prontos, "
+        f"{estatisticas_relatorios['em_andamento']} em andamento"
+    )
+
+    # Painel de depuração com as etapas medidas nesta execução (etapas reaproveitadas da memória não aparecem)
+    if profiler is not None:
+        activate_profiler(None)
+        with st.sidebar.expander("Depuração: etapas desta execução", expanded=True):
+            st.dataframe(profiler.stats_frame())
+            contexto = {
+                'unidade': unidade_selecionada,
+                'regime': regime,
+                'inicio': start_date.strftime('%Y-%m-%d'),
+                'fim': end_date.strftime('%Y-%m-%d'),
+                'leitor': leitor,
+                'processos': processos,
+                'etapas_reaproveitadas': memo.stats(),
+            }
+            st.download_button("Exportar perfil (JSON)", profiler.to_json(contexto), file_name="perfil_fluxo.json",
+                               mime="application/json")
+
+        # Memória das planilhas carregadas no esquema compacto, comparada ao esquema anterior
+        with st.sidebar.expander("Depuração: memória das planilhas", expanded=True):
+            st.dataframe(ledger_memory_report({
+                "Contas a Receber": df_receivables,
+                "Contas a Pagar": df_payables,
+                "Relatório Caixa": df_cash_report,
+            }))
+
+# Planilhas de entrada do modo em lote: opção da linha de comando, chave em load_all_parallel e função de processamento
+BATCH_INPUTS = [
+    ('receber_quitadas', 'Contas a receber quitadas', process_receivables),
+    ('receber_pendentes', 'Contas a receber pendentes', process_receivables),
+    ('pagar_quitadas', 'Contas a pagar quitadas', process_payables),
+    ('pagar_pendentes', 'Contas a pagar pendentes', process_payables),
+    ('relatorio_caixa', 'Relatório de caixa', process_cash_report),
+]
+
+# Formatos de saída do modo em lote
+BATCH_FORMATS = ['csv', 'json', 'pdf', 'xlsx']
+
+# Função para converter os indicadores em um dicionário serializável em JSON
+def indicators_to_json(indicadores):
+    dados = {}
+    for nome, valor in indicadores.items():
+        if nome.startswith('maior_'):
+            valor = None if valor is None else {
+                'conta': None if pd.isna(valor[0]) else str(valor[0]),
+                'valor': round(float(valor[1]), 2),
+            }
+        elif nome.startswith('lancamentos_'):
+            valor = int(valor)
+        else:
+            valor = round(float(valor), 2)
+        dados[nome] = valor
+    return dados
+
+# Função para montar um nome de diretório seguro a partir de uma unidade ou regime
+def _batch_path_part(nome):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in nome)
+
+# Função para gerar os relatórios de várias unidades, regimes e períodos sem Streamlit.
+# As planilhas são lidas e o cubo é montado uma única vez; cada combinação vai para
+# saida/<unidade>/<regime>/<início>_<fim>/ (com excel_unidades, também um Excel por período com uma aba por
+# unidade e regime). Devolve a lista de caminhos gerados, ou None se a leitura falhar.
+def run_batch(arquivos, unidades, regimes, periodos, saldos_iniciais, saida,
+              formatos=BATCH_FORMATS, reader='pandas', workers=INGESTION_WORKERS, resumo_pdf='Diário',
+              excel_unidades=False):
+    planilhas = {chave: (arquivos[chave], process_func) for chave, _, process_func in BATCH_INPUTS}
+    unidade_padrao = default_unit(saldos_iniciais)
+    # Com o cache compartilhado em disco, execuções seguidas com os mesmos arquivos reaproveitam planilhas e cubo
+    chave_dados = tuple(file_content_hash(arquivo) for arquivo, _ in planilhas.values()) + (unidade_padrao,)
+    dados = shared_cached(('dados', chave_dados, reader), lambda: load_all_parallel(
+        planilhas, workers=workers, reader=reader, cache=IngestionCache(), unidade_padrao=unidade_padrao))
+    if dados is None:
+        return None
+    cube = shared_cached(('cubo', chave_dados), lambda: build_aggregate_cube(*dados))
+
+    if '*' in unidades:
+        unidades = ["Todas as Unidades"] + list(cube['units'])
+
+    # Os PDFs (a parte mais lenta) são montados em paralelo nos processos, enquanto os outros relatórios são gerados
+    modulo = _importable_module()
+    pool = modulo.get_process_pool(workers) if 'pdf' in formatos and workers > 1 else None
+    pdfs = []
+
+    gerados = []
+    for unidade_selecionada in unidades:
+        for regime in regimes:
+            for start_date, end_date in periodos:
+                relatorio = compute_report(cube, unidade_selecionada, regime, start_date, end_date, saldos_iniciais)
+                destino = os.path.join(saida, _batch_path_part(unidade_selecionada), _batch_path_part(regime),
+                                       f"{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}")
+                os.makedirs(destino, exist_ok=True)
+
+                cash_flow = relatorio['cash_flow']
+                if 'csv' in formatos:
+                    cash_flow.to_csv(os.path.join(destino, 'fluxo_de_caixa.csv'), index_label='Data')
+                if 'json' in formatos:
+                    with open(os.path.join(destino, 'indicadores.json'), 'w', encoding='utf-8') as f:
+                        json.dump(indicators_to_json(relatorio['indicadores']), f, ensure_ascii=False, indent=2)
+                if 'pdf' in formatos:
+                    argumentos = (cash_flow, relatorio['recebimentos_por_conta'], relatorio['pagamentos_por_conta'], unidade_selecionada, regime)
+                    caminho_pdf = os.path.join(destino, 'relatorio_financeiro.pdf')
+                    if pool is None:
+                        with open(caminho_pdf, 'wb') as f:
+                            f.write(generate_pdf(*argumentos, resumo=resumo_pdf))
+                    else:
+                        pdfs.append((caminho_pdf, pool.submit(modulo.generate_pdf, *argumentos, resumo=resumo_pdf)))
+                if 'xlsx' in formatos:
+                    write_excel_report(os.path.join(destino, 'relatorio_financeiro.xlsx'),
+                                       report_excel_sheets(cash_flow, relatorio['recebimentos_por_conta'], relatorio['pagamentos_por_conta']))
+                gerados.append(destino)
+
+    for caminho_pdf, tarefa in pdfs:
+        try:
+            conteudo = tarefa.result()
+        except BrokenProcessPool:
+            # Um processo morreu: o pool é descartado e recriado no próximo uso
+            modulo._process_pools.pop(workers, None)
+            raise
+        with open(caminho_pdf, 'wb') as f:
+            f.write(conteudo)
+
+    # Um Excel por período com todas as unidades e regimes, escrito em uma passada pelo cubo
+    if excel_unidades:
+        for start_date, end_date in periodos:
+            destino = os.path.join(saida, f"relatorio_unidades_{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}.xlsx")
+            write_excel_report(destino, cube_excel_sheets(cube, unidades, regimes, start_date, end_date, saldos_iniciais))
+            gerados.append(destino)
+    return gerados
+
+# Função para interpretar um período no formato AAAA-MM-DD:AAAA-MM-DD
+def _parse_period(texto):
+    try:
+        inicio, fim = (datetime.strptime(parte.strip(), '%Y-%m-%d').date() for parte in texto.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"período inválido '{texto}' (use AAAA-MM-DD:AAAA-MM-DD)")
+    if fim < inicio:
+        raise argparse.ArgumentTypeError(f"período '{texto}' termina antes de começar")
+    return inicio, fim
+
+# Função para interpretar um saldo inicial no formato UNIDADE=VALOR
+def _parse_balance(texto):
+    unidade, separador, valor = texto.rpartition('=')
+    try:
+        if not separador or not unidade.strip():
+            raise ValueError
+        return unidade.strip(), float(valor)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"saldo inválido '{texto}' (use UNIDADE=VALOR, ex.: \"UNIDADE SOMBRIO=1500.00\")")
+
+# Função principal do modo em lote (python fluxo.py --receber-quitadas ... --saida relatorios)
+def cli_main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Gera fluxo de caixa, indicadores e relatórios (PDF/Excel) sem abrir o dashboard.")
+    for chave, descricao, _ in BATCH_INPUTS:
+        parser.add_argument(f"--{chave.replace('_', '-')}", dest=chave, required=True, metavar='XLSX',
+                            help=f"{descricao} (.xlsx)")
+    parser.add_argument('--unidade', action='append', dest='unidades',
+                        help='Unidade a analisar (pode repetir; "*" gera todas as unidades). Padrão: "Todas as Unidades"')
+    parser.add_argument('--regime', action='append', dest='regimes', choices=list(REGIME_COLUMNS),
+                        help='Regime (pode repetir). Padrão: Caixa')
+    parser.add_argument('--periodo', action='append', dest='periodos', type=_parse_period,
+                        help='Período AAAA-MM-DD:AAAA-MM-DD (pode repetir). Padrão: hoje e os próximos 30 dias')
+    parser.add_argument('--cadastro-unidades', metavar='ARQ',
+                        help=f'Cadastro de unidades e saldos iniciais (.csv ou .xlsx). Padrão: {UNIT_REGISTRY_FILE}, se existir')
+    parser.add_argument('--saldo', action='append', dest='saldos', type=_parse_balance, default=[], metavar='UNIDADE=VALOR',
+                        help='Saldo inicial de uma unidade, substituindo o do cadastro (pode repetir)')
+    parser.add_argument('--saida', default='relatorios', help='Diretório de saída (padrão: relatorios)')
+    parser.add_argument('--formatos', nargs='+', choices=BATCH_FORMATS, default=BATCH_FORMATS,
+                        help='Arquivos a gerar em cada relatório')
+    parser.add_argument('--resumo-pdf', choices=list(PDF_SUMMARIES), default='Diário',
+                        help='Tabela do relatório em PDF: diária, semanal ou mensal')
+    parser.add_argument('--excel-unidades', action='store_true',
+                        help='Gera também um Excel por período com uma aba por unidade e regime')
+    parser.add_argument('--perfil', metavar='JSON',
+                        help='Grava o tempo, as linhas e o pico de memória de cada etapa neste arquivo JSON')
+    parser.add_argument('--leitor', choices=['pandas'] + EXCEL_READERS, default='pandas',
+                        help='Leitura das planilhas: pandas (completa) ou em blocos')
+    parser.add_argument('--processos', type=int, default=INGESTION_WORKERS,
+                        help='Processos de leitura em paralelo')
+    args = parser.parse_args(argv)
+
+    profiler = StageProfiler() if args.perfil else None
+    activate_profiler(profiler)
+
+    saldos_iniciais = load_unit_registry(args.cadastro_unidades)
+    saldos_iniciais.update(args.saldos)
+
+    hoje = datetime.today().date()
+    gerados = run_batch(
+        {chave: getattr(args, chave) for chave, _, _ in BATCH_INPUTS},
+        args.unidades or ["Todas as Unidades"],
+        args.regimes or ['Caixa'],
+        args.periodos or [(hoje, hoje + timedelta(days=30))],
+        saldos_iniciais, args.saida,
+        formatos=args.formatos, reader=args.leitor, workers=max(1, args.processos), resumo_pdf=args.resumo_pdf,
+        excel_unidades=args.excel_unidades,
+    )
+    if profiler is not None:
+        activate_profiler(None)
+        with open(args.perfil, 'w', encoding='utf-8') as f:
+            f.write(profiler.to_json({'argumentos': sys.argv[1:] if argv is None else list(argv)}))
+    if gerados is None:
+        return 1
+    for destino in gerados:
+        print(destino)
+    return 0
+
+# No "streamlit run" o script também roda como __main__; fora do Streamlit, vale o modo em lote
 if __name__ == "__main__":
-    main()
+    if st.runtime.exists():
+        main()
+    else:
+        sys.exit(cli_main())
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+import fluxo
+
+
+# Uma data digitada errada (2203 em vez de 2023) não pode esticar o eixo de dias do cubo por séculos
+def test_cube_ignores_implausible_dates_in_daily_series():
+    linhas = 52
+    df = pd.DataFrame({
+        'Centavos': np.arange(linhas, dtype=np.int64) * 100,
+        'Pagamento': pd.date_range('2023-01-01', periods=linhas, freq='D'),
+        'Data': pd.date_range('2023-01-01', periods=linhas, freq='D'),
+        'Vencimento': pd.date_range('2023-01-01', periods=linhas, freq='D'),
+        'Unidade': [f"UNIDADE {i % 50:02d}" for i in range(linhas)],
+        'Conta Analítica': 'Outros',
+    })
+    df.loc[0, 'Vencimento'] = pd.Timestamp('2203-01-01')
+
+    cube = fluxo.build_aggregate_cube(df, df, df.drop(columns='Pagamento'))
+
+    assert cube['start'] == pd.Timestamp('2023-01-01')
+    assert cube['days'] == linhas
+    # A linha com a data implausível fica fora da série por vencimento, mas continua nos totais por conta
+    total = fluxo.cube_period_total(cube, 'receber', 'Vencimento', "Todas as Unidades",
+                                    pd.Timestamp('2023-01-01'), pd.Timestamp('2023-12-31'))
+    assert round(total * 100) == df['Centavos'].iloc[1:].sum()
+    contas = fluxo.cube_account_totals(cube, 'receber', "Todas as Unidades")
+    assert round(contas['Recebimentos'].sum() * 100) == df['Centavos'].sum()
@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import fluxo
+
+UNIDADES = ["UNIDADE SOMBRIO", "UNIDADE MORRO DA FUMAÇA"]
+SALDO_SOMBRIO = 1500.25
+SALDO_FUMACA = -300.10
+INICIO = pd.Timestamp('2024-01-10')
+FIM = pd.Timestamp('2024-03-20')
+REGIMES = ['Caixa', 'Competência', 'Caixa Projetado']
+COLUNAS_REGIME = {'Caixa': 'Pagamento', 'Competência': 'Data', 'Caixa Projetado': 'Vencimento'}
+
+
+# Implementação anterior (iterrows + .loc por linha), mantida como referência do resultado esperado
+def reference_cash_flow(df_receivables, df_payables, df_cash_report, start_date, end_date, regime, saldo_sombrio, saldo_fumaca, unidade_selecionada):
+    date_range = pd.date_range(start=start_date, end=end_date, freq='D')
+    cash_flow = pd.DataFrame(index=date_range, columns=['Recebimentos', 'Pagamentos', 'Saldo'])
+    cash_flow = cash_flow.fillna(0)
+
+    coluna_data = COLUNAS_REGIME[regime]
+
+    for index, row in df_receivables.iterrows():
+        if row[coluna_data] in cash_flow.index:
+            cash_flow.loc[row[coluna_data], 'Recebimentos'] += row['Recebimentos']
+
+    for index, row in df_cash_report.iterrows():
+        if regime == 'Caixa Projetado':
+            if 'Vencimento' in df_cash_report.columns:
+                if row['Vencimento'] in cash_flow.index:
+                    cash_flow.loc[row['Vencimento'], 'Recebimentos'] += row['Recebimentos']
+        else:
+            if row['Data'] in cash_flow.index:
+                cash_flow.loc[row['Data'], 'Recebimentos'] += row['Recebimentos']
+
+    for index, row in df_payables.iterrows():
+        if row[coluna_data] in cash_flow.index:
+            cash_flow.loc[row[coluna_data], 'Pagamentos'] += row['Pagamentos']
+
+    cash_flow['Saldo'] = cash_flow['Recebimentos'] - cash_flow['Pagamentos']
+
+    if unidade_selecionada == "Todas as Unidades":
+        saldo_inicial = saldo_sombrio + saldo_fumaca
+    elif unidade_selecionada == "UNIDADE SOMBRIO":
+        saldo_inicial = saldo_sombrio
+    elif unidade_selecionada == "UNIDADE MORRO DA FUMAÇA":
+        saldo_inicial = saldo_fumaca
+    else:
+        saldo_inicial = 0
+
+    cash_flow['Saldo Acumulado'] = cash_flow['Saldo'].cumsum() + saldo_inicial
+    return cash_flow
+
+
+# Função para gerar valores em reais e datas em texto, como nas planilhas exportadas (com células vazias).
+# O Relatório Caixa traz os valores sem o "R$".
+def _planilha(rng, linhas, coluna_valor, colunas_data, prefixo='R$ '):
+    centavos = rng.integers(-50_000, 2_000_000, linhas)
+    valores = [prefixo + f"{c / 100:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.') for c in centavos]
+    dias = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 100, linhas), unit='D')
+    df = pd.DataFrame({coluna_valor: valores})
+    for coluna in colunas_data:
+        datas = pd.Series(dias + pd.to_timedelta(rng.integers(-5, 6, linhas), unit='D')).dt.strftime('%d/%m/%Y')
+        df[coluna] = datas.where(rng.random(linhas) > 0.1, '')
+    df['Unidade'] = np.array(UNIDADES)[rng.integers(0, len(UNIDADES), linhas)]
+    df['Conta Analítica'] = np.array(['Aluguel', 'Vendas', 'Outros'])[rng.integers(0, 3, linhas)]
+    return df
+
+
+# Planilhas processadas pelo dashboard e as mesmas planilhas com os valores em reais (entrada da referência)
+@pytest.fixture(scope='module')
+def planilhas():
+    rng = np.random.default_rng(7)
+    df_receivables = fluxo.process_receivables(_planilha(rng, 300, 'Valor', ['Pagamento', 'Data', 'Vencimento']))
+    df_payables = fluxo.process_payables(_planilha(rng, 300, 'Valor', ['Pagamento', 'Data', 'Vencimento']))
+    df_cash_report = fluxo.process_cash_report(_planilha(rng, 150, 'Entrada', ['Data', 'Vencimento'], prefixo=''))
+    return {
+        'processadas': (df_receivables, df_payables, df_cash_report),
+        'reais': (
+            fluxo.ledger_display_frame(df_receivables, 'Recebimentos'),
+            fluxo.ledger_display_frame(df_payables, 'Pagamentos'),
+            fluxo.ledger_display_frame(df_cash_report, 'Recebimentos'),
+        ),
+    }
+
+
+# Função para filtrar as planilhas pela unidade selecionada
+def _filtrar(frames, unidade_selecionada):
+    if unidade_selecionada == "Todas as Unidades":
+        return frames
+    return tuple(df[df['Unidade'].astype(str) == unidade_selecionada] for df in frames)
+
+
+@pytest.mark.parametrize('regime', REGIMES)
+@pytest.mark.parametrize('unidade_selecionada', ["Todas as Unidades"] + UNIDADES)
+def test_calculate_cash_flow_matches_reference(planilhas, regime, unidade_selecionada):
+    saldos = {"UNIDADE SOMBRIO": SALDO_SOMBRIO, "UNIDADE MORRO DA FUMAÇA": SALDO_FUMACA}
+    esperado = reference_cash_flow(*_filtrar(planilhas['reais'], unidade_selecionada), INICIO, FIM, regime,
+                                   SALDO_SOMBRIO, SALDO_FUMACA, unidade_selecionada)
+    obtido = fluxo.calculate_cash_flow(*_filtrar(planilhas['processadas'], unidade_selecionada), INICIO, FIM, regime,
+                                       saldos, unidade_selecionada)
+
+    assert list(obtido.index) == list(esperado.index)
+    for coluna in ['Recebimentos', 'Pagamentos', 'Saldo', 'Saldo Acumulado']:
+        centavos_esperados = np.rint(esperado[coluna].to_numpy(dtype=float) * 100).astype(np.int64)
+        centavos_obtidos = np.rint(obtido[coluna].to_numpy(dtype=float) * 100).astype(np.int64)
+        np.testing.assert_array_equal(centavos_obtidos, centavos_esperados, err_msg=coluna)
+
+
+# O Relatório Caixa com o 'Vencimento' ainda em texto (dd/mm/aaaa) não pode quebrar o regime "Caixa Projetado"
+def test_calculate_cash_flow_with_text_due_dates(planilhas):
+    df_receivables, df_payables, df_cash_report = planilhas['processadas']
+    # Com o primeiro dia até 12 o pandas deduziria o formato mês/dia e falharia nos dias acima de 12
+    df_cash_report = df_cash_report.copy()
+    df_cash_report.loc[df_cash_report.index[0], 'Vencimento'] = pd.Timestamp('2024-02-05')
+    em_texto = df_cash_report.assign(Vencimento=df_cash_report['Vencimento'].dt.strftime('%d/%m/%Y'))
+    esperado = fluxo.calculate_cash_flow(df_receivables, df_payables, df_cash_report, INICIO, FIM, 'Caixa Projetado',
+                                         {}, "Todas as Unidades")
+    obtido = fluxo.calculate_cash_flow(df_receivables, df_payables, em_texto, INICIO, FIM, 'Caixa Projetado',
+                                       {}, "Todas as Unidades")
+    pd.testing.assert_frame_equal(obtido, esperado)
+
+
+# Fora do Streamlit (modo em lote) o regime inválido é informado na saída de erro, sem chamar o Streamlit
+def test_calculate_cash_flow_reports_invalid_regime(planilhas, capsys):
+    assert fluxo.calculate_cash_flow(*planilhas['processadas'], INICIO, FIM, 'Regime', {}, "Todas as Unidades") is None
+    assert "Regime inválido selecionado." in capsys.readouterr().err
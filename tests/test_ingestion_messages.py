@@ -0,0 +1,46 @@
+import io
+import threading
+
+import pandas as pd
+
+import fluxo
+
+
+# Função para montar uma planilha .xlsx de contas a receber com a quantidade pedida de valores inválidos
+def _planilha_xlsx(invalidos, linhas=20):
+    df = pd.DataFrame({
+        'Valor': ['R$ 10,00'] * linhas,
+        'Pagamento': ['01/02/2024'] * linhas,
+        'Data': ['01/01/2024'] * linhas,
+        'Vencimento': ['05/02/2024'] * linhas,
+        'Unidade': ['UNIDADE SOMBRIO'] * linhas,
+        'Conta Analítica': ['Aluguel'] * linhas,
+    })
+    df.loc[:invalidos - 1, 'Valor'] = 'abc'
+    arquivo = io.BytesIO()
+    df.to_excel(arquivo, index=False)
+    return arquivo.getvalue()
+
+
+# Ingestões simultâneas (sessões diferentes do Streamlit) não podem misturar nem apagar as mensagens umas das outras
+def test_ingestion_messages_stay_in_their_thread():
+    planilhas = {'uma': _planilha_xlsx(1), 'duas': _planilha_xlsx(2)}
+    resultados = {}
+    barreira = threading.Barrier(len(planilhas))
+
+    def ingerir(nome):
+        barreira.wait()
+        for _ in range(20):
+            _, mensagens, _ = fluxo._ingest_worker(planilhas[nome], 'process_receivables', 'pandas')
+            resultados.setdefault(nome, []).append(mensagens)
+
+    threads = [threading.Thread(target=ingerir, args=(nome,)) for nome in planilhas]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(mensagens == resultados['uma'][0] for mensagens in resultados['uma'])
+    assert all(mensagens == resultados['duas'][0] for mensagens in resultados['duas'])
+    assert resultados['uma'][0] != resultados['duas'][0]
+    assert getattr(fluxo._message_state, 'sink', None) is None
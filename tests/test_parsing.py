@@ -0,0 +1,57 @@
+import datetime
+import io
+
+import pandas as pd
+import pytest
+
+import fluxo
+
+
+# Números numa coluna de data são datas seriais do Excel; fora da faixa válida a célula é inválida
+def test_parse_br_dates_reads_excel_serials():
+    df = pd.DataFrame({'Vencimento': pd.Series(
+        ['13/03/2023', 45000, 45000.5, datetime.datetime(2024, 1, 2), '', -3, 'abc'], dtype=object)})
+
+    convertidas, invalidas = fluxo.parse_br_dates(df, ['Vencimento'])
+
+    assert convertidas['Vencimento'].tolist()[:4] == [
+        pd.Timestamp('2023-03-13'), pd.Timestamp('2023-03-15'),
+        pd.Timestamp('2023-03-15 12:00'), pd.Timestamp('2024-01-02'),
+    ]
+    assert convertidas['Vencimento'].iloc[4:].isna().all()
+    assert invalidas['Vencimento'].tolist() == [False, False, False, False, False, True, True]
+
+
+# Só um sinal de negativo é aceito: "--5,00" e "(-5,00)" não podem virar -5,00 nem 5,00
+def test_parse_brl_centavos_rejects_doubled_sign():
+    valores = pd.Series(['--5,00', '(-5,00)', '-R$-5', '-R$ 5,00', 'R$ -5,00', '5,00-', '(5,00)', 'R$ 1.234,56'],
+                        dtype=object)
+
+    centavos, _, invalidas = fluxo.parse_brl_centavos(valores)
+
+    assert invalidas.tolist() == [True, True, True, False, False, False, False, False]
+    assert centavos[3:].tolist() == [-500, -500, -500, -500, 123456]
+
+
+# As linhas vazias ignoradas na leitura contam na numeração usada nos avisos de células inválidas
+@pytest.mark.parametrize('reader', ['openpyxl', 'calamine'])
+def test_invalid_cells_point_to_the_excel_row_after_blank_rows(reader):
+    if reader == 'calamine':
+        pytest.importorskip('python_calamine')
+    assert reader in fluxo.EXCEL_READERS
+
+    linhas = [
+        ['Valor', 'Pagamento', 'Data', 'Vencimento', 'Unidade', 'Conta Analítica'],
+        ['R$ 1,00', '01/02/2024', '01/01/2024', '05/02/2024', 'UNIDADE SOMBRIO', 'Aluguel'],
+        [None] * 6,
+        [None] * 6,
+        ['abc', '01/02/2024', '01/01/2024', '05/02/2024', 'UNIDADE SOMBRIO', 'Aluguel'],
+    ]
+    arquivo = io.BytesIO()
+    pd.DataFrame(linhas[1:], columns=linhas[0]).to_excel(arquivo, index=False)
+
+    blocos = list(fluxo.iter_excel_chunks(io.BytesIO(arquivo.getvalue()), chunk_rows=1, reader=reader))
+    relatorios = [fluxo.normalize_ledger(bloco, 'Valor', fluxo.LEDGER_DATE_COLUMNS)[1] for bloco in blocos]
+
+    assert [len(bloco) for bloco in blocos] == [1, 1]
+    assert pd.concat(relatorios)['Linha'].tolist() == [5]
@@ -0,0 +1,19 @@
+import pandas as pd
+
+import fluxo
+
+
+# Os saldos iniciais do cadastro chegam em reais, tanto como números quanto como texto no formato brasileiro
+def test_load_unit_registry_reads_numeric_and_brl_balances(tmp_path):
+    esperado = {'UNIDADE A': 1500.5, 'UNIDADE B': 1500.5, 'UNIDADE C': -20.0}
+
+    planilha = tmp_path / 'unidades.xlsx'
+    pd.DataFrame({
+        'Unidade': ['UNIDADE A', 'UNIDADE B', 'UNIDADE C'],
+        'Saldo Inicial': [1500.5, 'R$ 1.500,50', -20],
+    }).to_excel(planilha, index=False)
+    assert fluxo.load_unit_registry(str(planilha)) == esperado
+
+    texto = tmp_path / 'unidades.csv'
+    texto.write_text("Unidade;Saldo Inicial\nUNIDADE A;1500,5\nUNIDADE B;R$ 1.500,50\nUNIDADE C;-20\n", encoding='utf-8')
+    assert fluxo.load_unit_registry(str(texto)) == esperado